@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+Benchmark of per request latency: the old style module level requests.get
+(new connection every call, token in the query string) against the pooled
+club_client session. Runs against a small local mock server, so no token or
+workspace is needed.
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+import http.server
+import json
+import statistics
+import sys
+import threading
+import time
+
+import requests
+
+import club_client
+
+g_usage_string_0_s = """
+Compares request latency of unpooled requests.get against the pooled
+club_client session using a local mock server.
+
+Usage: prompt$ """
+
+g_usage_string_1_s = ''' [request_count]'''
+
+g_request_count_n = 500
+
+# Minimal keep-alive capable stand in for the labels endpoint
+class MockHandler_c(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+  body_s = json.dumps([ { 'id': i, 'name': 'label_' + str(i) } for i in range(20) ]).encode()
+
+  def do_GET(self):
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(self.body_s)))
+    self.end_headers()
+    self.wfile.write(self.body_s)
+
+  def log_message(self, *p_args_l):
+    pass
+
+def start_server_c():
+  r_server_c = http.server.ThreadingHTTPServer(('127.0.0.1', 0), MockHandler_c)
+  threading.Thread(target=r_server_c.serve_forever, daemon=True).start()
+  return r_server_c
+
+def time_calls_l(p_call_c, p_count_n):
+  r_latency_l = []
+  for i in range(p_count_n):
+    l_start_n = time.perf_counter()
+    p_call_c()
+    r_latency_l.append((time.perf_counter() - l_start_n) * 1000.0)
+  return r_latency_l
+
+def report(p_name_s, p_latency_l):
+  l_sorted_l = sorted(p_latency_l)
+  l_p95_n = l_sorted_l[int(len(l_sorted_l) * 0.95) - 1]
+  print('%-10s mean %7.3f ms  p50 %7.3f ms  p95 %7.3f ms  total %8.1f ms' % (
+    p_name_s, statistics.mean(p_latency_l), statistics.median(p_latency_l), l_p95_n, sum(p_latency_l)))
+
+def main():
+
+  if (2 < len(sys.argv)) or (2 == len(sys.argv) and '--help' == sys.argv[1]):
+    print(g_usage_string_0_s + sys.argv[0] + g_usage_string_1_s)
+    sys.exit(1)
+
+  l_count_n = int(sys.argv[1]) if 2 == len(sys.argv) else g_request_count_n
+
+  l_server_c = start_server_c()
+  l_root_s = 'http://127.0.0.1:' + str(l_server_c.server_address[1])
+
+  club_client.init_session('bench-token', p_url_root_s=l_root_s)
+  club_client.init_rate(0) # Only the connection handling is being timed
+
+  l_old_url_s = l_root_s + club_client.g_api_s + 'labels?token=bench-token'
+  l_unpooled_l = time_calls_l(lambda: requests.get(l_old_url_s).json(), l_count_n)
+  l_pooled_l = time_calls_l(lambda: club_client.get_clubhouse_l('labels'), l_count_n)
+
+  print('Requests per client:', l_count_n)
+  report('unpooled', l_unpooled_l)
+  report('pooled', l_pooled_l)
+  print('Speedup (mean): %.2fx' % (statistics.mean(l_unpooled_l) / statistics.mean(l_pooled_l)))
+
+  l_server_c.shutdown()
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+End to end benchmark of the scripts against club_mock.py. For each
+workspace size a fresh mock server is started and the scripts are run
+against it one after the other, each in its own process:
+
+- backup: club_back.py --shards --format jsonl
+- trello: trello_to_clubhouse.py with a synthetic board (bench_trello.py)
+  of the same number of cards
+- create: create_by_label.py bench_template (one story per template)
+- delete: delete_by_label.py bench_half (half of the synthetic stories)
+
+Reported per run: wall time, requests the mock served, requests per second
+and the peak RSS of the script's process. No token or network needed.
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+import bench_trello
+import club_client
+
+g_usage_string_0_s = """
+Times backup, Trello import, create-by-label and delete-by-label against a
+local mock server with 1k, 10k and 100k stories (or the sizes given).
+
+Options:
+--latency MS      Latency the mock adds to every request (default 0)
+--rate-limit N    Mock answers 429 past N requests per minute (default none)
+--only NAMES      Comma separated subset of backup,trello,create,delete
+--keep            Keep the temporary directory with the outputs and logs
+
+Usage: prompt$ """
+
+g_usage_string_1_s = ''' [--latency MS] [--rate-limit N] [--only NAMES] [--keep] [story_count ...]'''
+
+g_story_count_l = [1000, 10000, 100000]
+g_bench_l       = ['backup', 'trello', 'create', 'delete']
+g_script_dir_s  = os.path.dirname(os.path.abspath(__file__))
+
+# name => arguments after the interpreter, given the working directory
+def bench_args_d(p_dir_s):
+  return {
+    'backup' : ['club_back.py', '--shards', '--format', 'jsonl', os.path.join(p_dir_s, 'back')],
+    'trello' : ['trello_to_clubhouse.py', 'Project 0', os.path.join(p_dir_s, 'board.json')],
+    'create' : ['create_by_label.py', 'bench_template'],
+    'delete' : ['delete_by_label.py', 'bench_half'],
+  }
+
+# Starts club_mock.py on a free port. Returns (process, url root) once it is
+# listening.
+def start_mock_t(p_story_n, p_latency_n, p_rate_limit_n):
+  l_process_c = subprocess.Popen([sys.executable, os.path.join(g_script_dir_s, 'club_mock.py'), '--port', '0',
+    '--stories', str(p_story_n), '--latency', str(p_latency_n), '--rate-limit', str(p_rate_limit_n)],
+    stdout=subprocess.PIPE, universal_newlines=True)
+  l_line_s = l_process_c.stdout.readline()
+  if 'http://' not in l_line_s:
+    l_process_c.kill()
+    raise RuntimeError('Mock server did not start')
+  return (l_process_c, l_line_s[l_line_s.index('http://'):].strip())
+
+def request_count_n(p_url_root_s):
+  return requests.get(p_url_root_s + '/__stats').json()['requests']
+
+# Runs one script to completion. Returns (exit code, seconds, peak RSS in
+# MB). The output goes to p_log_s.
+def run_script_t(p_arg_l, p_env_d, p_log_s):
+  with open(p_log_s, 'w') as l_log_c:
+    l_start_n = time.perf_counter()
+    l_process_c = subprocess.Popen([sys.executable] + p_arg_l, cwd=g_script_dir_s, env=p_env_d,
+                                   stdout=l_log_c, stderr=subprocess.STDOUT)
+    # wait4 rather than wait to get the child's resource usage
+    l_pid_n, l_status_n, l_usage_c = os.wait4(l_process_c.pid, 0)
+    l_seconds_n = time.perf_counter() - l_start_n
+  l_process_c.returncode = os.waitstatus_to_exitcode(l_status_n)
+  return (l_process_c.returncode, l_seconds_n, l_usage_c.ru_maxrss / 1024.0) # ru_maxrss is KB on Linux
+
+def write_board(p_card_n, p_path_s):
+  with open(p_path_s, 'w') as l_file_c:
+    json.dump(bench_trello.synthetic_board_d(p_card_n), l_file_c)
+
+def run_size_l(p_story_n, p_bench_l, p_dir_s, p_latency_n, p_rate_limit_n):
+  print('Workspace of ' + str(p_story_n) + ' stories', flush=True)
+  l_dir_s = os.path.join(p_dir_s, str(p_story_n))
+  os.makedirs(l_dir_s)
+  if 'trello' in p_bench_l:
+    # In its own process, a child's peak RSS starts from the parent's at fork
+    l_process_c = multiprocessing.Process(target=write_board, args=(p_story_n, os.path.join(l_dir_s, 'board.json')))
+    l_process_c.start()
+    l_process_c.join()
+
+  l_mock_c, l_url_root_s = start_mock_t(p_story_n, p_latency_n, p_rate_limit_n)
+  l_env_d = dict(os.environ)
+  l_env_d.update({
+    'CLUBHOUSE_URL_ROOT'   : l_url_root_s,
+    'CLUBHOUSE_API_TOKEN'  : 'bench',
+    'CLUBHOUSE_RATE_LIMIT' : '0',   # Only the mock's own limit, if any
+    'CLUBHOUSE_RATE_FILE'  : '-',
+    'CLUBHOUSE_CACHE_DIR'  : os.path.join(l_dir_s, 'cache'),
+  })
+
+  r_result_l = []
+  try:
+    for l_name_s in p_bench_l:
+      l_before_n = request_count_n(l_url_root_s)
+      l_code_n, l_seconds_n, l_rss_n = run_script_t(bench_args_d(l_dir_s)[l_name_s], l_env_d, os.path.join(l_dir_s, l_name_s + '.log'))
+      l_request_n = request_count_n(l_url_root_s) - l_before_n
+      r_result_l.append((p_story_n, l_name_s, l_code_n, l_seconds_n, l_request_n, l_rss_n))
+      report(r_result_l[-1])
+  finally:
+    l_mock_c.kill()
+    l_mock_c.wait()
+  return r_result_l
+
+def report(p_result_t):
+  l_story_n, l_name_s, l_code_n, l_seconds_n, l_request_n, l_rss_n = p_result_t
+  print('  %-8s %8d stories %9.2f s %8d requests %9.1f req/s %8.1f MB peak RSS%s' % (
+    l_name_s, l_story_n, l_seconds_n, l_request_n, l_request_n / l_seconds_n, l_rss_n,
+    '' if 0 == l_code_n else '  FAILED (exit ' + str(l_code_n) + ')'), flush=True)
+
+def main():
+
+  l_argv_l = list(sys.argv)
+  l_keep_b = club_client.pop_flag_b(l_argv_l, '--keep')
+  l_bench_l = club_client.pop_option_s(l_argv_l, '--only', ','.join(g_bench_l)).split(',')
+  try:
+    l_latency_n = float(club_client.pop_option_s(l_argv_l, '--latency', '0'))
+    l_rate_limit_n = int(club_client.pop_option_s(l_argv_l, '--rate-limit', '0'))
+    l_count_l = [ int(l_arg_s) for l_arg_s in l_argv_l[1:] ] or g_story_count_l
+  except ValueError:
+    l_bench_l = []
+
+  if not l_bench_l or [ l_name_s for l_name_s in l_bench_l if l_name_s not in g_bench_l ]:
+    print(g_usage_string_0_s + sys.argv[0] + g_usage_string_1_s)
+    sys.exit(1)
+
+  l_dir_s = tempfile.mkdtemp(prefix='bench_suite_')
+  l_result_l = []
+  for l_story_n in l_count_l:
+    l_result_l += run_size_l(l_story_n, [ l_name_s for l_name_s in g_bench_l if l_name_s in l_bench_l ], l_dir_s, l_latency_n, l_rate_limit_n)
+
+  l_failed_n = len([ l_result_t for l_result_t in l_result_l if 0 != l_result_t[2] ])
+  if l_keep_b or l_failed_n:
+    print('Outputs and logs are in ' + l_dir_s)
+  else:
+    shutil.rmtree(l_dir_s)
+  sys.exit(1 if l_failed_n else 0)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+Benchmark of the Trello card => story translation on synthetic boards.
+Compares the indexed translate_cards_l in trello_to_clubhouse.py against the
+original scan of every action (and checklist) for every card. No network or
+token needed.
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+import random
+import sys
+import time
+
+import club_client
+import trello_to_clubhouse
+
+g_usage_string_0_s = """
+Times the Trello translation on synthetic boards of 1k, 10k and 100k cards
+(or the sizes given). The original nested loop version is only run up to
+--old-max cards (default 1000) since it is quadratic.
+
+Usage: prompt$ """
+
+g_usage_string_1_s = ''' [--old-max N] [card_count ...]'''
+
+g_card_count_l     = [1000, 10000, 100000]
+g_old_max_n        = 1000
+g_comments_per_n   = 3  # Average comment actions per card
+g_other_per_n      = 5  # Average non-comment actions per card
+
+def synthetic_board_d(p_card_n, p_seed_n=1):
+  l_random_c = random.Random(p_seed_n)
+  r_board_d = { 'name': 'Bench Board', 'lists': [], 'cards': [], 'checklists': [], 'actions': [] }
+
+  for i in range(10):
+    r_board_d['lists'].append({ 'id': 'list' + str(i), 'name': 'List ' + str(i) })
+
+  for i in range(p_card_n):
+    l_card_id_s = 'card' + str(i)
+    l_checklist_id_l = []
+    for j in range(l_random_c.choice([0, 0, 1, 1, 2])):
+      l_checklist_id_s = l_card_id_s + '_cl' + str(j)
+      l_checklist_id_l.append(l_checklist_id_s)
+      r_board_d['checklists'].append({
+        'id': l_checklist_id_s, 'idCard': l_card_id_s, 'name': 'Checklist ' + str(j),
+        'checkItems': [ { 'name': 'item ' + str(k) } for k in range(l_random_c.randint(1, 6)) ],
+      })
+    r_board_d['cards'].append({
+      'id': l_card_id_s, 'name': 'Card ' + str(i), 'desc': 'Description of card ' + str(i),
+      'idList': 'list' + str(i % 10), 'idChecklists': l_checklist_id_l,
+    })
+
+  for i in range(p_card_n * (g_comments_per_n + g_other_per_n)):
+    l_card_id_s = 'card' + str(l_random_c.randrange(p_card_n))
+    if l_random_c.random() < g_comments_per_n / (g_comments_per_n + g_other_per_n):
+      r_board_d['actions'].append({ 'type': 'commentCard', 'data': { 'card': { 'id': l_card_id_s }, 'text': 'comment ' + str(i) } })
+    else:
+      r_board_d['actions'].append({ 'type': 'updateCard', 'data': { 'card': { 'id': l_card_id_s } } })
+
+  l_random_c.shuffle(r_board_d['checklists'])
+  return r_board_d
+
+# The translation loop as it was before the indexes were added
+def translate_cards_old_l(p_trello_db_d):
+  r_story_l = []
+  for l_card_d in p_trello_db_d['cards']:
+    l_trello_comment_l = []
+    for l_action_d in p_trello_db_d['actions']:
+      if 'commentCard' != l_action_d['type']:
+        continue
+      if l_action_d['data']['card']['id'] == l_card_d['id']:
+        l_trello_comment_l.append(l_action_d)
+
+    if [] == l_card_d['idChecklists']:
+      r_story_l.append(trello_to_clubhouse.create_story_d(l_card_d, l_trello_comment_l))
+    else:
+      for l_checklist_id_s in l_card_d['idChecklists']:
+        for l_checklist_d in p_trello_db_d['checklists']:
+          if  l_checklist_id_s == l_checklist_d['id']:
+            r_story_l.append(trello_to_clubhouse.create_story_d(l_card_d, l_trello_comment_l, l_checklist_d))
+            l_trello_comment_l = []
+  return r_story_l
+
+def time_call_t(p_call_c):
+  l_start_n = time.perf_counter()
+  r_result_c = p_call_c()
+  return (r_result_c, time.perf_counter() - l_start_n)
+
+def main():
+
+  l_argv_l = list(sys.argv)
+  try:
+    l_old_max_n = int(club_client.pop_option_s(l_argv_l, '--old-max', str(g_old_max_n)))
+    l_count_l = [ int(l_arg_s) for l_arg_s in l_argv_l[1:] ] or g_card_count_l
+  except ValueError:
+    print(g_usage_string_0_s + sys.argv[0] + g_usage_string_1_s)
+    sys.exit(1)
+
+  # create_story_d reads these
+  trello_to_clubhouse.g_project_d = { 'id': 1, 'name': 'Bench' }
+  trello_to_clubhouse.g_translation_label_s = 'from_trello_bench'
+
+  print('%8s %9s %9s %12s %12s' % ('cards', 'actions', 'stories', 'indexed', 'original'))
+  for l_card_n in l_count_l:
+    l_board_d = synthetic_board_d(l_card_n)
+    l_story_l, l_new_n = time_call_t(lambda: trello_to_clubhouse.translate_cards_l(l_board_d))
+
+    l_old_s = 'skipped'
+    if l_card_n <= l_old_max_n:
+      l_old_story_l, l_old_n = time_call_t(lambda: translate_cards_old_l(l_board_d))
+      if l_old_story_l != l_story_l:
+        print('Mismatch between indexed and original translation!')
+        sys.exit(1)
+      l_old_s = '%10.3fs' % l_old_n
+
+    print('%8d %9d %9d %11.3fs %12s' % (l_card_n, len(l_board_d['actions']), len(l_story_l), l_new_n, l_old_s))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,449 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+Asyncio backend for club_client.py.
+
+One event loop in a background thread does all of the network I/O, so
+hundreds of requests can be in flight without a thread each. The HTTP/1.1
+client is a small one on asyncio streams (keep-alive connections are pooled
+per host, responses may be chunked and gzip'ed) so nothing beyond the
+standard library and requests is needed.
+
+With club_client.g_async_b set (CLUBHOUSE_ASYNC=1 or a script's --async)
+club_client.send_request_c hands every request to the loop and waits for
+it, so the sync entry points work unchanged from any thread. The callers
+that have lots of independent requests (the club_back.py collections,
+shards and deep backup, delete_by_label.py) use run_map and
+sharded_query_pages to put them all in flight at once.
+
+Requests are bounded by a semaphore (CLUBHOUSE_ASYNC_JOBS, default 100)
+and by the same adaptive concurrency limit as the sync path. They draw on
+the shared club_client rate budget, so at the default 180 requests/minute
+it is the budget and not the concurrency that sets the pace.
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, wait
+from datetime import date, timedelta
+import gzip
+import json
+import os
+import queue
+import ssl
+import threading
+import time
+import urllib.parse
+import zlib
+
+import requests
+import requests.structures
+
+import club_client
+import club_metrics
+import club_pool
+import club_rate
+import club_search
+
+g_jobs_n      = int(os.getenv('CLUBHOUSE_ASYNC_JOBS', '100'))
+g_no_body_l   = [204, 304]
+
+g_loop_c      = None
+g_loop_lock_c = threading.Lock()
+g_client_c    = None
+
+# What send_request_c returns. Enough of requests.Response for the callers
+# and for club_rate.
+class Response_c:
+
+  def __init__(self, p_url_s, p_status_n, p_reason_s, p_headers_c, p_content_b, p_sent_n):
+    self.url         = p_url_s
+    self.status_code = p_status_n
+    self.reason      = p_reason_s
+    self.headers     = p_headers_c
+    self.content     = p_content_b
+    self.sent_n      = p_sent_n
+
+  def json(self):
+    return json.loads(self.content)
+
+  def raise_for_status(self):
+    if 400 <= self.status_code:
+      l_kind_s = 'Client' if self.status_code < 500 else 'Server'
+      raise requests.exceptions.HTTPError('%d %s Error: %s for url: %s' % (self.status_code, l_kind_s, self.reason, self.url), response=self)
+
+# Waits club_client.g_timeout_n for p_coro_c, like the sync session's
+# timeout. Raises asyncio.TimeoutError.
+async def timed_c(p_coro_c):
+  return await asyncio.wait_for(p_coro_c, club_client.g_timeout_n)
+
+# Pooled keep-alive connections and the limits, one per loop
+class Client_c:
+
+  def __init__(self, p_jobs_n):
+    self.idle_d  = {}   # (scheme, host, port) => [(reader, writer)]
+    self.slots_c = asyncio.Semaphore(p_jobs_n)
+    self.limit_c = club_rate.ConcurrencyLimit_c(p_jobs_n)
+    self.cond_c  = asyncio.Condition()
+    self.ssl_c   = ssl.create_default_context()
+
+  async def connection_t(self, p_key_t):
+    l_idle_l = self.idle_d.get(p_key_t, [])
+    while l_idle_l:
+      l_reader_c, l_writer_c = l_idle_l.pop()
+      if not l_reader_c.at_eof() and not l_writer_c.is_closing():
+        return (l_reader_c, l_writer_c, True)
+      l_writer_c.close()
+    l_scheme_s, l_host_s, l_port_n = p_key_t
+    try:
+      l_reader_c, l_writer_c = await timed_c(asyncio.open_connection(l_host_s, l_port_n,
+        ssl=self.ssl_c if 'https' == l_scheme_s else None))
+    except asyncio.TimeoutError:
+      raise requests.exceptions.ConnectTimeout('Timed out connecting to ' + l_host_s)
+    except OSError as l_e_c:
+      raise requests.exceptions.ConnectionError(str(l_e_c) or type(l_e_c).__name__)
+    return (l_reader_c, l_writer_c, False)
+
+  # One request and response on one connection. Returns (Response_c,
+  # keep-alive).
+  async def exchange_t(self, p_reader_c, p_writer_c, p_method_s, p_url_s, p_target_s, p_header_d, p_body_b):
+    l_head_s = p_method_s + ' ' + p_target_s + ' HTTP/1.1\r\n' + ''.join( l_key_s + ': ' + l_value_s + '\r\n' for l_key_s, l_value_s in p_header_d.items() ) + '\r\n'
+    p_writer_c.write(l_head_s.encode('latin-1') + p_body_b)
+    await timed_c(p_writer_c.drain())
+
+    l_status_l = (await timed_c(p_reader_c.readline())).decode('latin-1').split(' ', 2)
+    if len(l_status_l) < 2:
+      raise ConnectionResetError('Connection closed before the response')
+    l_version_s, l_status_n, l_reason_s = l_status_l[0], int(l_status_l[1]), (l_status_l[2] if 2 < len(l_status_l) else '').strip()
+
+    l_headers_c = requests.structures.CaseInsensitiveDict()
+    while True:
+      l_line_s = (await timed_c(p_reader_c.readline())).decode('latin-1')
+      if l_line_s in ['\r\n', '\n', '']:
+        break
+      l_key_s, l_colon_s, l_value_s = l_line_s.partition(':')
+      l_key_s, l_value_s = l_key_s.strip(), l_value_s.strip()
+      l_headers_c[l_key_s] = (l_headers_c[l_key_s] + ', ' + l_value_s) if l_key_s in l_headers_c else l_value_s
+
+    l_keep_b = 'HTTP/1.1' == l_version_s and 'close' != l_headers_c.get('Connection', '').lower()
+    if 'HEAD' == p_method_s or l_status_n in g_no_body_l or l_status_n < 200:
+      l_body_b = b''
+    elif 'chunked' in l_headers_c.get('Transfer-Encoding', '').lower():
+      l_part_l = []
+      while True:
+        l_size_n = int((await timed_c(p_reader_c.readline())).split(b';')[0].strip() or b'0', 16)
+        if 0 == l_size_n:
+          while (await timed_c(p_reader_c.readline())) not in [b'\r\n', b'\n', b'']: # Trailers
+            pass
+          break
+        l_part_l.append(await timed_c(p_reader_c.readexactly(l_size_n)))
+        await timed_c(p_reader_c.readline())
+      l_body_b = b''.join(l_part_l)
+    elif 'Content-Length' in l_headers_c:
+      l_body_b = await timed_c(p_reader_c.readexactly(int(l_headers_c['Content-Length'])))
+    else:
+      l_body_b = await timed_c(p_reader_c.read())
+      l_keep_b = False
+
+    l_encoding_s = l_headers_c.get('Content-Encoding', '').lower()
+    if 'gzip' == l_encoding_s:
+      l_body_b = gzip.decompress(l_body_b)
+    elif 'deflate' == l_encoding_s:
+      l_body_b = zlib.decompress(l_body_b)
+    return (Response_c(p_url_s, l_status_n, l_reason_s, l_headers_c, l_body_b, len(p_body_b)), l_keep_b)
+
+  # Raises requests.exceptions.ConnectionError when there is no response, or
+  # Timeout when a connect or read takes longer than club_client.g_timeout_n,
+  # like the sync path. A kept-alive connection the server has since closed
+  # is retried once on a new one.
+  async def request_c(self, p_method_s, p_url_s, p_json_d=None, p_params_d=None, p_headers_d=None):
+    l_url_c = urllib.parse.urlsplit(p_url_s)
+    l_target_s = l_url_c.path or '/'
+    l_query_l = [ l_q for l_q in [l_url_c.query, urllib.parse.urlencode(p_params_d or {})] if l_q ]
+    if l_query_l:
+      l_target_s += '?' + '&'.join(l_query_l)
+    l_port_n = l_url_c.port or (443 if 'https' == l_url_c.scheme else 80)
+    l_key_t = (l_url_c.scheme, l_url_c.hostname, l_port_n)
+
+    l_body_b = b'' if p_json_d is None else json.dumps(p_json_d).encode('utf-8')
+    l_header_d = { 'Host': l_url_c.netloc }
+    l_header_d.update(club_client.get_session_c().headers)
+    l_header_d.update(p_headers_d or {})
+    l_header_d['Accept-Encoding'] = 'gzip, deflate'
+    if l_body_b or p_method_s in ['POST', 'PUT', 'PATCH']:
+      l_header_d['Content-Length'] = str(len(l_body_b))
+
+    async with self.slots_c:
+      for l_try_n in range(2):
+        l_reader_c, l_writer_c, l_reused_b = await self.connection_t(l_key_t)
+        try:
+          r_response_c, l_keep_b = await self.exchange_t(l_reader_c, l_writer_c, p_method_s, p_url_s, l_target_s, l_header_d, l_body_b)
+        except asyncio.TimeoutError: # Before OSError, which it is a kind of
+          l_writer_c.close()
+          raise requests.exceptions.ReadTimeout('Read timed out for url: ' + p_url_s)
+        except (OSError, asyncio.IncompleteReadError, ValueError) as l_e_c:
+          l_writer_c.close()
+          if l_reused_b and 0 == l_try_n:
+            continue
+          raise requests.exceptions.ConnectionError(str(l_e_c) or type(l_e_c).__name__)
+        except BaseException: # Cancelled part way, the connection is unusable
+          l_writer_c.close()
+          raise
+        if l_keep_b:
+          self.idle_d.setdefault(l_key_t, []).append((l_reader_c, l_writer_c))
+        else:
+          l_writer_c.close()
+        return r_response_c
+
+  # The adaptive limit is club_rate's, waited on here without blocking the
+  # loop. The start time comes from the shared budget.
+  async def acquire(self):
+    async with self.cond_c:
+      await self.cond_c.wait_for(self.limit_c.try_acquire_b)
+    try:
+      l_wait_n = club_client.g_rate_c.start_wait_n()
+      if l_wait_n > 0:
+        await asyncio.sleep(l_wait_n)
+    except BaseException:
+      await self.release(False)
+      raise
+
+  async def release(self, p_throttled_b, p_failed_b=False):
+    self.limit_c.release(p_throttled_b, p_failed_b)
+    async with self.cond_c:
+      self.cond_c.notify_all()
+
+def loop_c():
+  global g_loop_c
+  with g_loop_lock_c:
+    if g_loop_c is None:
+      g_loop_c = asyncio.new_event_loop()
+      threading.Thread(target=g_loop_c.run_forever, name='club_async', daemon=True).start()
+    return g_loop_c
+
+def client_c():
+  global g_client_c
+  if g_client_c is None:
+    g_client_c = Client_c(g_jobs_n)
+  return g_client_c
+
+# Runs p_coro_c on the loop and waits for the result, from any thread but
+# the loop's own.
+def run(p_coro_c):
+  return asyncio.run_coroutine_threadsafe(p_coro_c, loop_c()).result()
+
+# Sends p_coro_c to the loop without waiting, returns a
+# concurrent.futures.Future
+def submit_c(p_coro_c):
+  return asyncio.run_coroutine_threadsafe(p_coro_c, loop_c())
+
+# Same pacing, retries and metrics as club_client.send_paced_c
+async def send_request_c(p_method_s, p_url_s, p_json_d=None, p_params_d=None, p_headers_d=None):
+  l_client_c = client_c()
+  l_attempt_n = 0
+  while True:
+    await l_client_c.acquire()
+    l_start_n = time.perf_counter()
+    try:
+      r_response_c = await l_client_c.request_c(p_method_s, p_url_s, p_json_d, p_params_d, p_headers_d)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+      club_metrics.record_request(p_method_s, p_url_s, None, time.perf_counter() - l_start_n, 0, 0)
+      club_client.g_rate_c.settle_n(None)
+      await l_client_c.release(False, True)
+      # A POST may have gone through, only repeat what is safe to
+      if p_method_s not in club_client.g_idempotent_l or l_attempt_n >= club_client.g_retry_n:
+        raise
+      club_metrics.record_retry(p_url_s, 'connection')
+      await asyncio.sleep(club_rate.backoff_n(l_attempt_n))
+      l_attempt_n += 1
+      continue
+    except asyncio.CancelledError: # Not the server's doing
+      await l_client_c.release(False)
+      raise
+    except BaseException:
+      await l_client_c.release(False, True)
+      raise
+    club_metrics.record_request(p_method_s, p_url_s, r_response_c.status_code, time.perf_counter() - l_start_n,
+                                r_response_c.sent_n, len(r_response_c.content))
+
+    l_wait_n = club_client.g_rate_c.settle_n(r_response_c)
+    await l_client_c.release(l_wait_n is not None, club_rate.failed_b(r_response_c))
+    if l_wait_n is not None:
+      print( 'To Many Requests Error, waiting %.1f seconds ...' % l_wait_n )
+      club_metrics.record_retry(p_url_s, '429')
+      await asyncio.sleep(l_wait_n)
+      continue
+    if r_response_c.status_code in club_client.g_retry_status_l and l_attempt_n < club_client.g_retry_n:
+      club_metrics.record_retry(p_url_s, '5xx')
+      await asyncio.sleep(club_rate.backoff_n(l_attempt_n))
+      l_attempt_n += 1
+      continue
+    r_response_c.raise_for_status()
+    return r_response_c
+
+async def fetch_json_d(p_method_s, p_url_s, p_json_d=None, p_params_d=None):
+  return club_client.response_json_d(await send_request_c(p_method_s, p_url_s, p_json_d, p_params_d))
+
+async def fetch_clubhouse_l(p_source_s, p_params_d=None):
+  return await fetch_json_d('GET', club_client.api_url_s(p_source_s), p_params_d=p_params_d)
+
+# Every page of one search. The pages of one query have to come one after
+# the other (each has the next one's cursor), it's separate queries that
+# run side by side.
+async def query_pages_l(p_type_s, p_query_d):
+  l_d = await fetch_clubhouse_l('search/' + p_type_s, p_query_d)
+  r_page_l = [l_d['data']]
+  while l_d['next'] is not None:
+    l_d = await fetch_json_d('GET', club_client.g_url_root_s + l_d['next'])
+    r_page_l.append(l_d['data'])
+  return r_page_l
+
+# Sync generator over the pages of one search. The next page is requested
+# as soon as its cursor is known, so it is on its way while the caller uses
+# this one.
+def query_pages(p_type_s, p_query_d):
+  l_future_c = submit_c(fetch_clubhouse_l('search/' + p_type_s, p_query_d))
+  try:
+    while l_future_c is not None:
+      l_d = l_future_c.result()
+      l_future_c = None
+      if l_d['next'] is not None:
+        l_future_c = submit_c(fetch_json_d('GET', club_client.g_url_root_s + l_d['next']))
+      yield l_d['data']
+  finally:
+    if l_future_c is not None:
+      l_future_c.cancel()
+
+# p_work_c(item) is a coroutine function. Runs it for every item with at
+# most p_jobs_n (default g_jobs_n) at once and returns [(item, result,
+# error)] in the order of p_item_l, error is None or the exception.
+async def map_l(p_work_c, p_item_l, p_jobs_n=None):
+  l_item_l = list(p_item_l)
+  r_result_l = [None] * len(l_item_l)
+  l_index_c = iter(range(len(l_item_l)))
+
+  async def worker():
+    for i in l_index_c:
+      try:
+        r_result_l[i] = (l_item_l[i], await p_work_c(l_item_l[i]), None)
+      except Exception as l_e_c:
+        r_result_l[i] = (l_item_l[i], None, l_e_c)
+
+  await asyncio.gather(*[ worker() for i in range(min(p_jobs_n or g_jobs_n, len(l_item_l))) ])
+  return r_result_l
+
+# club_search.search_shard_t with the shard's pages fetched on the loop
+async def search_shard_t(p_type_s, p_query_s, p_shard_t, p_params_d=None):
+  l_query_d = club_search.shard_query_d(p_query_s, p_shard_t, p_params_d)
+  l_d = await fetch_clubhouse_l('search/' + p_type_s, l_query_d)
+
+  if club_search.capped_b(l_d):
+    if p_shard_t[0] < p_shard_t[1]:
+      return ('split', club_search.split_shard_l(p_shard_t))
+    print('Warning: more than ' + str(club_search.g_search_cap_n) + ' ' + p_type_s + ' created on ' + p_shard_t[0].isoformat() + ', results may be incomplete')
+
+  r_l = list(l_d['data'])
+  while l_d['next'] is not None:
+    l_d = await fetch_json_d('GET', club_client.g_url_root_s + l_d['next'])
+    r_l += l_d['data']
+  return ('data', r_l)
+
+# club_search.sharded_query_pages with every shard in flight at once.
+# p_put_c(records) is called with each shard's records as it completes.
+async def sharded_query(p_put_c, p_type_s, p_query_s, p_start_s=None, p_params_d=None):
+  l_start_c = date.fromisoformat(p_start_s or club_search.g_shard_start_s)
+  l_end_c = date.today() + timedelta(days=1) # Clock skew between here and there
+
+  l_pending_s = set( asyncio.ensure_future(search_shard_t(p_type_s, p_query_s, l_shard_t, p_params_d))
+                     for l_shard_t in club_search.split_shard_l((l_start_c, l_end_c), club_search.g_shard_count_n) )
+  try:
+    while l_pending_s:
+      l_done_s, l_pending_s = await asyncio.wait(l_pending_s, return_when=asyncio.FIRST_COMPLETED)
+      for l_task_c in l_done_s:
+        l_kind_s, l_value_l = l_task_c.result()
+        if 'split' == l_kind_s:
+          l_pending_s.update( asyncio.ensure_future(search_shard_t(p_type_s, p_query_s, l_shard_t, p_params_d)) for l_shard_t in l_value_l )
+        else:
+          p_put_c(l_value_l)
+  finally:
+    for l_task_c in l_pending_s:
+      l_task_c.cancel()
+
+# Sync generator over the shards' records as they complete. Raises the
+# first failure.
+def sharded_query_pages(p_type_s, p_query_s, p_start_s=None, p_params_d=None):
+  l_queue_c = queue.Queue()
+  l_future_c = submit_c(sharded_query(l_queue_c.put, p_type_s, p_query_s, p_start_s, p_params_d))
+  l_future_c.add_done_callback(lambda p_future_c: l_queue_c.put(None))
+  try:
+    while True:
+      l_page_l = l_queue_c.get()
+      if l_page_l is None:
+        break
+      yield l_page_l
+    l_future_c.result()
+  finally:
+    l_future_c.cancel()
+
+# Sync counterpart of map_l for the scripts, like club_pool.run_adaptive:
+# p_item_l (any iterable) is read only as items finish, with at most
+# p_jobs_n (default g_jobs_n) on the loop at once. Yields (item, result,
+# error) in completion order. Failed items are retried the same way too,
+# club_pool.g_retry_n times when p_retry_c(exception) is None or true.
+def run_map(p_work_c, p_item_l, p_jobs_n=None, p_retry_c=None):
+  l_jobs_n = p_jobs_n or g_jobs_n
+  l_item_iter = iter(p_item_l)
+  l_retry_l = []
+  l_more_b = True
+  l_pending_d = {}
+  try:
+    while l_more_b or l_retry_l or l_pending_d:
+      while len(l_pending_d) < l_jobs_n:
+        if l_retry_l:
+          l_item_c, l_tries_n = l_retry_l.pop(0)
+        else:
+          try:
+            l_item_c, l_tries_n = next(l_item_iter), 0
+          except StopIteration:
+            l_more_b = False
+            break
+        l_pending_d[submit_c(p_work_c(l_item_c))] = (l_item_c, l_tries_n)
+
+      if not l_pending_d:
+        continue
+
+      l_done_l, _ = wait(l_pending_d, return_when=FIRST_COMPLETED)
+      for l_future_c in l_done_l:
+        l_item_c, l_tries_n = l_pending_d.pop(l_future_c)
+        try:
+          l_result_c = l_future_c.result()
+        except Exception as l_e_c:
+          if l_tries_n < club_pool.g_retry_n and (p_retry_c is None or p_retry_c(l_e_c)):
+            l_retry_l.append((l_item_c, l_tries_n + 1))
+          else:
+            yield (l_item_c, None, l_e_c)
+          continue
+        yield (l_item_c, l_result_c, None)
+  finally:
+    for l_future_c in l_pending_d:
+      l_future_c.cancel()
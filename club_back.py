@@ -25,12 +25,22 @@ s - String
 
 '''
 
-import json
-import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+import itertools
 import pathlib
-import requests
 import sys
 import time
+import traceback
+
+import club_async
+import club_client
+import club_index
+import club_metrics
+import club_pool
+import club_search
+import club_store
+from club_client import fetch_clubhouse_l, fetch_query_l
 
 g_usage_string_0_s = """
 This script backs up a workspace to a set of json files. Hoping to use 
@@ -40,140 +50,394 @@ batch methods, backups are necessary.
 By default, this will create and use a subdirectory named: 'back'
 The lone parameter overrides the subdirectory name.
 
+Options:
+--jobs N   Fetch and write up to N collections at a time (default 1)
+--shards   Split the epic and story searches into created-date ranges
+           and page through them in parallel (uses --jobs threads)
+--shard-start YYYY-MM-DD
+           Oldest created date searched in --shards mode (default 2014-01-01)
+--format json|jsonl|entities
+           json (default) is one <name>.json file per collection, built in
+           memory. jsonl streams one record per line to <name>.jsonl as the
+           pages arrive and writes a <name>.manifest.json alongside it.
+           entities saves each record as <name>/<id>.json and only rewrites
+           the ones whose content hash changed (see <name>/index.json).
+--incremental
+           Only download epics and stories updated since the last backup
+           and merge them into the saved copy. backup.manifest.json keeps
+           the high-water mark (largest updated_at) for each collection.
+--full-every DAYS
+           With --incremental, do a full download anyway when the last one
+           is more than DAYS old so deletions get picked up (default 7)
+--deep     After the searches, fetch the full record (comments, tasks,
+           branches, ...) of every story into the story-details collection.
+           Stories whose updated_at hasn't changed since the last deep
+           backup are carried over instead of being fetched again.
+--deep-jobs N
+           Most story fetches in flight during --deep (default 8). The
+           actual number adapts to errors and latency.
+--async    Use the asyncio backend (club_async.py): the collections are
+           all fetched at once, and the shards and --deep story fetches
+           are all in flight together (up to CLUBHOUSE_ASYNC_JOBS, default
+           100) from one thread instead of --jobs / --deep-jobs threads.
+--index FILE
+           After the backup, bring the SQLite index FILE up to date with it
+           (see club_index.py)
+
 Usage: prompt$ """
 
-g_usage_string_1_s = ''' [destination_subdirectory]
+g_usage_string_1_s = ''' [--jobs N] [--shards [--shard-start YYYY-MM-DD]] [--format json|jsonl|entities]
+    [--incremental [--full-every DAYS]] [--deep [--deep-jobs N]] [--async] [--index FILE] [destination_subdirectory]
+
+Run reports: [--metrics report.json] [--prom metrics.prom] [--profile run.prof]
 
 Note: This script requires that the environment variable "CLUBHOUSE_API_TOKEN" 
 is set to a valid Clubhouse token.'''
 
-g_env_usage_message_s = '''
-This script requires that the environment variable "CLUBHOUSE_API_TOKEN" is
-set to a valid Clubhouse token.
-'''
-
-g_url_root_s = 'https://api.clubhouse.io'
-g_api_s      = '/api/v3/'
-g_token_s    = 'token='
-
 g_dirpath_s = "back"
-
-def get_clubhouse_l(p_source_s):
-  while True:
-    try:
-      l_url_s = g_url_root_s + g_api_s + p_source_s + '?' + g_token_s
-      r_response_d = requests.get(l_url_s)
-      r_response_d.raise_for_status()
-    except requests.exceptions.RequestException as l_e_c:
-      print(l_e_c)
-      if 429 == l_e_c.errno: 
-        print( 'To Many Requests Error, waiting 10 seconds ...' )
-        sleep(10)
-        continue
-      sys.exit(1)
-    return r_response_d.json()
-
-def post_clubhouse_l(p_source_s, p_json_s):
-  while True:
-    try:
-      l_url_s = g_url_root_s + g_api_s + p_source_s + '?' + g_token_s
-      r_response_d = requests.post(l_url_s, json=p_json_s)
-      r_response_d.raise_for_status()
-    except requests.exceptions.RequestException as l_e_c:
-      print(l_e_c)
-      if 429 == l_e_c.errno: 
-        print( 'To Many Requests Error, waiting 10 seconds ...' )
-        sleep(10)
-        continue
-      sys.exit(1)
-    return r_response_d.json()
-
-def next_query_d(p_next_s):
-  while True:
-    try:
-      l_url_s = g_url_root_s + p_next_s + '&' + g_token_s
-      r_response_d = requests.get(l_url_s)
-      r_response_d.raise_for_status()
-    except requests.exceptions.RequestException as l_e_c:
-      print(l_e_c)
-      if 429 == l_e_c.errno: 
-        print( 'To Many Requests Error, waiting 10 seconds ...' )
-        sleep(10)
-        continue
-      sys.exit(1)
-    return r_response_d.json()
-
-def first_query_d(p_type_s, p_query_d):
-  while True:
-    try:
-      l_url_s = g_url_root_s + g_api_s + 'search/' + p_type_s + '?' + g_token_s
-      r_response_d = requests.get(l_url_s, params=p_query_d)
-      r_response_d.raise_for_status()
-    except requests.exceptions.RequestException as l_e_c:
-      print(l_e_c)
-      if 429 == l_e_c.errno: 
-        print( 'To Many Requests Error, waiting 10 seconds ...' )
-        sleep(10)
-        continue
-      sys.exit(1)
-    return r_response_d.json()
-
-def query_clubhouse_l(p_type_s, p_query_d):
-  r_l = []
-
-  l_d = first_query_d(p_type_s, p_query_d)
-  while l_d['next'] is not None:
-    r_l += l_d['data']
-    l_d = next_query_d(l_d['next'])
-  else:
-    r_l += l_d['data']
-
-  return r_l
+g_jobs_n    = 1
+g_shards_b  = False
+g_shard_start_s = None
+g_format_s  = 'json'
+g_incremental_b = False
+g_full_every_n  = 7
+
+g_deep_b        = False
+g_deep_jobs_n   = 8
+
+g_index_s       = None
+
+g_backup_manifest_d = None
+
+g_search_query_l = ['!is:archived', 'is:archived']
+
+# The simple gets, same list as exporter.sh. Each one is:
+# "https://api.clubhouse.io/api/v3/<endpoint>?token=$CLUBHOUSE_API_TOKEN"
+g_endpoint_l = [
+  'categories',
+  'entity-templates',
+  'epic-workflow',
+  'files',
+  'groups',
+  'iterations',
+  'labels',
+  'linked-files',
+  'members',
+  'milestones',
+  'projects',
+  'repositories',
+  'teams',
+  'workflows',
+]
 
 def save_json_list(p_name_s, p_l):
   if not p_l: # ignore cases where none exist
     return
-  l_filename_s = g_dirpath_s + '/' + p_name_s + '.json'
+  l_filename_s = club_store.json_path_s(g_dirpath_s, p_name_s)
   print( 'creating file: ' + l_filename_s)
-  with open(l_filename_s, 'w') as json_file:
-    json.dump({ p_name_s : p_l }, json_file)    
-
-def save_clubhouse_get(p_source_s):
-  r_source_l = get_clubhouse_l(p_source_s)
-  save_json_list(p_source_s, r_source_l)
+  club_store.write_json_atomic(l_filename_s, { p_name_s : p_l })
+
+# Streams the pages straight to disk in jsonl or entities format
+def save_pages(p_name_s, p_page_iter):
+  l_writer_c = club_store.open_writer_c(g_dirpath_s, p_name_s, g_format_s)
+  print( 'creating file: ' + l_writer_c.filename_s)
+  try:
+    for l_page_l in p_page_iter:
+      l_writer_c.write_l(l_page_l)
+  except:
+    l_writer_c.abort()
+    raise
+  return l_writer_c.close()
+
+# p_fetched_t is (records, error) when the records were already fetched
+def save_clubhouse_get(p_source_s, p_fetched_t=None):
+  if p_fetched_t is None:
+    r_source_l = fetch_clubhouse_l(p_source_s)
+  elif p_fetched_t[1] is not None:
+    raise p_fetched_t[1]
+  else:
+    r_source_l = p_fetched_t[0]
+  if 'json' != g_format_s:
+    # A few endpoints (epic-workflow) return a single record
+    save_pages(p_source_s, [r_source_l if isinstance(r_source_l, list) else [r_source_l]])
+  else:
+    save_json_list(p_source_s, r_source_l)
   return r_source_l
 
+# Yields pages of search results for both archived and unarchived records,
+# p_since_s limits the search to records updated on or after that date.
+def search_pages(p_type_s, p_since_s=None):
+  l_query_l = g_search_query_l
+  if p_since_s:
+    l_query_l = [ l_query_s + ' updated:' + p_since_s + '..*' for l_query_s in g_search_query_l ]
+
+  if g_shards_b:
+    l_seen_d = {}
+    for l_query_s in l_query_l:
+      for l_page_l in club_search.sharded_query_pages(p_type_s, l_query_s, g_jobs_n, g_shard_start_s):
+        with club_metrics.phase('transform'):
+          l_new_l = [ l_item_d for l_item_d in l_page_l if l_item_d['id'] not in l_seen_d ]
+          for l_item_d in l_new_l:
+            l_seen_d[l_item_d['id']] = True
+        yield l_new_l
+  else:
+    for l_query_s in l_query_l:
+      yield from club_client.fetch_query_pages(p_type_s, {'query': l_query_s})
+
+# Passes the pages through, keeping the largest updated_at in p_mark_d
+def track_pages(p_page_iter, p_mark_d):
+  for l_page_l in p_page_iter:
+    with club_metrics.phase('transform'):
+      for l_item_d in l_page_l:
+        if l_item_d.get('updated_at') and (p_mark_d['high_water'] is None or l_item_d['updated_at'] > p_mark_d['high_water']):
+          p_mark_d['high_water'] = l_item_d['updated_at']
+    yield l_page_l
+
+# Returns the date to search from when p_type_s can be updated
+# incrementally, None when it needs a full download.
+def incremental_since_s(p_type_s):
+  if not g_incremental_b:
+    return None
+  if not club_store.collection_exists_b(g_dirpath_s, p_type_s, g_format_s):
+    return None
+  l_saved_d = g_backup_manifest_d['collections'].get(p_type_s)
+  if not l_saved_d or not l_saved_d.get('high_water') or g_format_s != l_saved_d.get('format'):
+    return None
+  l_last_full_c = datetime.fromisoformat(l_saved_d['last_full'])
+  if datetime.now(timezone.utc) - l_last_full_c > timedelta(days=g_full_every_n):
+    print('Last full download of ' + p_type_s + ' was ' + l_saved_d['last_full'] + ', doing a full resync')
+    return None
+  # Search is by day, back up one more for time zones. Merging is by id so
+  # anything seen twice is harmless.
+  l_since_c = datetime.fromisoformat(l_saved_d['high_water'].replace('Z', '+00:00')) - timedelta(days=1)
+  return l_since_c.date().isoformat()
+
+# Sharded mode: both archived and unarchived searches run across the date
+# shards, everything is merged and de-duplicated by id.
+def get_sharded_l(p_type_s):
+  l_record_d = {}
+  for l_query_s in g_search_query_l:
+    l_item_l = club_search.fetch_sharded_query_l(p_type_s, l_query_s, g_jobs_n, g_shard_start_s)
+    with club_metrics.phase('transform'):
+      for l_item_d in l_item_l:
+        l_record_d[l_item_d['id']] = l_item_d
+  with club_metrics.phase('transform'):
+    return [ l_record_d[l_id_n] for l_id_n in sorted(l_record_d) ]
+
 def get_epics_l():
+  if g_shards_b:
+    return get_sharded_l('epics')
+
   r_epic_l = []
 
-  l_query_d = {'query': '!is:archived', 'page_size': 25}
-  r_epic_l = query_clubhouse_l('epics', l_query_d)
+  l_query_d = {'query': '!is:archived'}
+  r_epic_l = fetch_query_l('epics', l_query_d)
 
-  l_query_d = {'query': 'is:archived', 'page_size': 25}
-  r_epic_l += query_clubhouse_l('epics', l_query_d)
+  l_query_d = {'query': 'is:archived'}
+  r_epic_l += fetch_query_l('epics', l_query_d)
 
   return r_epic_l
 
 def get_stories_l():
+  if g_shards_b:
+    return get_sharded_l('stories')
+
   r_story_l = []
 
-  l_query_d = {'query': '!is:archived', 'page_size': 25}
-  r_story_l = query_clubhouse_l('stories', l_query_d)
+  l_query_d = {'query': '!is:archived'}
+  r_story_l = fetch_query_l('stories', l_query_d)
 
-  l_query_d = {'query': 'is:archived', 'page_size': 25}
-  r_story_l += query_clubhouse_l('stories', l_query_d)
+  l_query_d = {'query': 'is:archived'}
+  r_story_l += fetch_query_l('stories', l_query_d)
 
   return r_story_l
 
+def save_search(p_type_s, p_get_c):
+  l_mark_d = { 'high_water': None }
+  l_now_s = datetime.now(timezone.utc).isoformat()
+  l_saved_d = g_backup_manifest_d['collections'].get(p_type_s, {})
+  l_since_s = incremental_since_s(p_type_s)
+
+  if l_since_s:
+    print('Incremental ' + p_type_s + ' updated since ' + l_since_s)
+    l_update_d = {}
+    for l_page_l in track_pages(search_pages(p_type_s, l_since_s), l_mark_d):
+      for l_item_d in l_page_l:
+        l_update_d[l_item_d['id']] = l_item_d
+    l_count_n = club_store.merge_collection_n(g_dirpath_s, p_type_s, g_format_s, l_update_d)
+    print('Merged ' + str(len(l_update_d)) + ' updated ' + p_type_s)
+    l_last_full_s = l_saved_d['last_full']
+    l_mark_d['high_water'] = max(l_mark_d['high_water'] or '', l_saved_d['high_water'])
+  elif 'json' != g_format_s:
+    l_count_n = save_pages(p_type_s, track_pages(search_pages(p_type_s), l_mark_d))['count']
+    l_last_full_s = l_now_s
+  else:
+    l_record_l = p_get_c()
+    list(track_pages([l_record_l], l_mark_d))
+    save_json_list(p_type_s, l_record_l)
+    l_count_n = len(l_record_l)
+    l_last_full_s = l_now_s
+
+  g_backup_manifest_d['collections'][p_type_s] = {
+    'format'     : g_format_s,
+    'count'      : l_count_n,
+    'high_water' : l_mark_d['high_water'],
+    'last_full'  : l_last_full_s,
+    'last_run'   : l_now_s,
+  }
+
+def save_epics():
+  save_search('epics', get_epics_l)
+
+def save_stories():
+  save_search('stories', get_stories_l)
+
+def fetch_story_detail_d(p_id_n):
+  return fetch_clubhouse_l('stories/' + str(p_id_n))
+
+# Deep backup. The search results are slim records, this fetches
+# stories/{id} for each story that changed since the last deep backup and
+# carries the rest over from the saved story-details.
+def save_story_details():
+  l_name_s = 'story-details'
+  l_start_n = time.time()
+
+  l_current_d = {}
+  for l_story_d in club_store.read_collection(g_dirpath_s, 'stories', g_format_s):
+    l_current_d[l_story_d['id']] = l_story_d.get('updated_at')
+
+  l_saved_d = {}
+  for l_story_d in club_store.read_collection(g_dirpath_s, l_name_s, g_format_s):
+    l_saved_d[l_story_d['id']] = l_story_d.get('updated_at')
+
+  l_todo_l = [ l_id_n for l_id_n in l_current_d if l_current_d[l_id_n] is None or l_saved_d.get(l_id_n) != l_current_d[l_id_n] ]
+  l_todo_s = set(l_todo_l)
+  print('Deep backup: ' + str(len(l_todo_l)) + ' stories to fetch, ' + str(len(l_current_d) - len(l_todo_l)) + ' unchanged')
+
+  # Exactly the stories that aren't fetched again, a story without an
+  # updated_at is always fetched
+  def kept_pages():
+    for l_story_d in club_store.read_collection(g_dirpath_s, l_name_s, g_format_s):
+      if l_story_d['id'] in l_current_d and l_story_d['id'] not in l_todo_s:
+        yield [l_story_d]
+
+  l_failed_l = []
+  def fetched_pages():
+    if club_client.g_async_b:
+      l_run_c = club_async.run_map(lambda p_id_n: club_async.fetch_clubhouse_l('stories/' + str(p_id_n)), l_todo_l)
+    else:
+      l_run_c = club_pool.run_adaptive(l_todo_l, fetch_story_detail_d, g_deep_jobs_n)
+    for l_id_n, l_story_d, l_error_c in l_run_c:
+      if l_error_c is None:
+        yield [l_story_d]
+      else:
+        l_failed_l.append(l_id_n)
+        print('Could not fetch story ' + str(l_id_n) + ': ' + str(l_error_c))
+
+  if 'json' == g_format_s:
+    l_record_l = []
+    for l_page_l in itertools.chain(kept_pages(), fetched_pages()):
+      l_record_l += l_page_l
+    save_json_list(l_name_s, l_record_l)
+    l_count_n = len(l_record_l)
+  else:
+    l_count_n = save_pages(l_name_s, itertools.chain(kept_pages(), fetched_pages()))['count']
+
+  l_seconds_n = time.time() - l_start_n
+  l_fetched_n = len(l_todo_l) - len(l_failed_l)
+  print('Deep backup: fetched %d stories in %.1fs (%.1f stories/sec)' % (l_fetched_n, l_seconds_n, l_fetched_n / max(l_seconds_n, 0.001)))
+
+  g_backup_manifest_d['collections'][l_name_s] = {
+    'format'   : g_format_s,
+    'count'    : l_count_n,
+    'last_run' : datetime.now(timezone.utc).isoformat(),
+  }
+
+  # Anything missing is picked up by the next run
+  if l_failed_l:
+    raise Exception(str(len(l_failed_l)) + ' story details could not be fetched')
+
+# Every collection in the backup, keyed by name. They are independent of one
+# another so any of them can run in parallel. p_fetched_d has the endpoints
+# that were already fetched, name => (records, error).
+def backup_job_d(p_fetched_d=None):
+  r_job_d = {}
+  for l_endpoint_s in g_endpoint_l:
+    l_fetched_t = (p_fetched_d or {}).get(l_endpoint_s)
+    r_job_d[l_endpoint_s] = (lambda p_source_s=l_endpoint_s, p_fetched_t=l_fetched_t: save_clubhouse_get(p_source_s, p_fetched_t))
+  r_job_d['epics']   = save_epics
+  r_job_d['stories'] = save_stories
+  return r_job_d
+
+def update_index():
+  l_conn_c = club_index.connect_c(g_index_s)
+  try:
+    club_index.ingest_d(l_conn_c, g_dirpath_s)
+  finally:
+    l_conn_c.close()
+
+# Runs one job and returns (name, error string or None, seconds). Errors are
+# caught here so one bad endpoint doesn't stop the rest of the backup.
+def run_job_t(p_name_s, p_job_c):
+  l_start_n = time.time()
+  try:
+    p_job_c()
+  except Exception as l_e_c:
+    return (p_name_s, str(l_e_c) or traceback.format_exc(), time.time() - l_start_n)
+  return (p_name_s, None, time.time() - l_start_n)
+
+# Runs the jobs through a bounded pool. The results come back in the same
+# order as p_job_d no matter which job finished first.
+def run_jobs_l(p_job_d, p_jobs_n):
+  with ThreadPoolExecutor(max_workers=p_jobs_n) as l_pool_c:
+    l_future_l = [ l_pool_c.submit(run_job_t, l_name_s, l_job_c) for l_name_s, l_job_c in p_job_d.items() ]
+    return [ l_future_c.result() for l_future_c in l_future_l ]
+
+# Prints the per collection report, returns the number of failures
+def report_jobs_n(p_result_l):
+  r_failed_n = 0
+  print('')
+  print('Backup report:')
+  for l_name_s, l_error_s, l_seconds_n in p_result_l:
+    if l_error_s is None:
+      print('  %-18s ok      %6.2fs' % (l_name_s, l_seconds_n))
+    else:
+      r_failed_n += 1
+      print('  %-18s FAILED  %6.2fs  %s' % (l_name_s, l_seconds_n, l_error_s))
+  if r_failed_n:
+    print(str(r_failed_n) + ' of ' + str(len(p_result_l)) + ' collections failed.')
+  return r_failed_n
+
 def main():
 
-  if (2 < len(sys.argv)) or (2 == len(sys.argv) and '--help' == sys.argv[1]):
+  l_argv_l = list(sys.argv)
+
+  global g_jobs_n, g_shards_b, g_shard_start_s, g_format_s, g_incremental_b, g_full_every_n, g_deep_b, g_deep_jobs_n, g_index_s
+  g_deep_b = club_client.pop_flag_b(l_argv_l, '--deep')
+  if club_client.pop_flag_b(l_argv_l, '--async'):
+    club_client.g_async_b = True
+  g_shards_b = club_client.pop_flag_b(l_argv_l, '--shards')
+  g_shard_start_s = club_client.pop_option_s(l_argv_l, '--shard-start')
+  g_format_s = club_client.pop_option_s(l_argv_l, '--format', g_format_s)
+  g_incremental_b = club_client.pop_flag_b(l_argv_l, '--incremental')
+  g_index_s = club_client.pop_option_s(l_argv_l, '--index')
+  l_bad_option_b = g_format_s not in club_store.g_format_l
+  try:
+    g_full_every_n = float(club_client.pop_option_s(l_argv_l, '--full-every', str(g_full_every_n)))
+    g_jobs_n = int(club_client.pop_option_s(l_argv_l, '--jobs', str(g_jobs_n)))
+    g_deep_jobs_n = int(club_client.pop_option_s(l_argv_l, '--deep-jobs', str(g_deep_jobs_n)))
+    if g_shard_start_s:
+      date.fromisoformat(g_shard_start_s)
+  except ValueError:
+    l_bad_option_b = True
+
+  if (2 < len(l_argv_l)) or (2 == len(l_argv_l) and '--help' == l_argv_l[1]) or l_bad_option_b or (1 > g_jobs_n) or (1 > g_deep_jobs_n):
     print(g_usage_string_0_s + sys.argv[0] + g_usage_string_1_s)
     sys.exit(1)
 
-  if 2 == len(sys.argv):
+  if 2 == len(l_argv_l):
     global g_dirpath_s
-    g_dirpath_s = sys.argv[1]
+    g_dirpath_s = l_argv_l[1]
     try:
       pathlib.Path(g_dirpath_s).mkdir(parents=True, exist_ok=True)
     except:
@@ -181,66 +445,48 @@ def main():
       print(g_usage_string_0_s + sys.argv[0] + g_usage_string_1_s)
       sys.exit(1)
 
-  if not os.getenv('CLUBHOUSE_API_TOKEN'):
-    print(g_env_usage_message_s)
-    sys.exit(1)
+  club_client.init_from_env()
 
-  global g_token_s
-  g_token_s += os.getenv('CLUBHOUSE_API_TOKEN')
+  # Every worker needs its own pooled connection, shard workers run inside
+  # the collection workers.
+  l_pool_size_n = g_jobs_n * 2 if g_shards_b else g_jobs_n
+  if g_deep_b:
+    l_pool_size_n = max(l_pool_size_n, g_deep_jobs_n)
+  if l_pool_size_n > club_client.g_pool_size_n:
+    club_client.init_session(p_pool_size_n=l_pool_size_n)
 
   # Defaults to 'back'. Make sure it exists.
   pathlib.Path(g_dirpath_s).mkdir(parents=True, exist_ok=True)
 
-  # Gets
+  global g_backup_manifest_d
+  g_backup_manifest_d = club_store.read_backup_manifest_d(g_dirpath_s)
 
-  # "https://api.clubhouse.io/api/v3/categories?token=$CLUBHOUSE_API_TOKEN"
-  save_clubhouse_get('categories')
+  # The endpoints are one request each, with the async backend they all go
+  # out together before the jobs start
+  l_fetched_d = None
+  if club_client.g_async_b:
+    l_fetched_d = { l_source_s: (l_record_c, l_error_c) for l_source_s, l_record_c, l_error_c in
+                    club_async.run_map(club_async.fetch_clubhouse_l, g_endpoint_l) }
 
-  # "https://api.clubhouse.io/api/v3/entity-templates?token=$CLUBHOUSE_API_TOKEN"
-  save_clubhouse_get('entity-templates')
+  l_result_l = run_jobs_l(backup_job_d(l_fetched_d), g_jobs_n)
 
-  # "https://api.clubhouse.io/api/v3/epic-workflow?token=$CLUBHOUSE_API_TOKEN"
-  save_clubhouse_get('epic-workflow')
+  # The deep backup works from the saved stories
+  if g_deep_b:
+    if [ l_result_t for l_result_t in l_result_l if 'stories' == l_result_t[0] and l_result_t[1] is None ]:
+      l_result_l.append(run_job_t('story-details', save_story_details))
+    else:
+      l_result_l.append(('story-details', 'skipped, stories failed', 0.0))
 
-  l_epic_l = get_epics_l()
-  save_json_list('epics', l_epic_l)
-  
-  # "https://api.clubhouse.io/api/v3/files?token=$CLUBHOUSE_API_TOKEN"
-  save_clubhouse_get('files')
+  # Collections that failed keep their old entries
+  club_store.write_backup_manifest(g_dirpath_s, g_backup_manifest_d)
 
-  # "https://api.clubhouse.io/api/v3/groups?token=$CLUBHOUSE_API_TOKEN"
-  save_clubhouse_get('groups')
+  # Whatever was saved goes into the index, failed collections are skipped
+  # there as unchanged
+  if g_index_s:
+    l_result_l.append(run_job_t('index', update_index))
 
-  # "https://api.clubhouse.io/api/v3/iterations?token=$CLUBHOUSE_API_TOKEN"
-  save_clubhouse_get('iterations')
-
-  # "https://api.clubhouse.io/api/v3/labels?token=$CLUBHOUSE_API_TOKEN"
-  save_clubhouse_get('labels')
-
-  # "https://api.clubhouse.io/api/v3/linked-files?token=$CLUBHOUSE_API_TOKEN"
-  save_clubhouse_get('linked-files')
-
-  # "https://api.clubhouse.io/api/v3/members?token=$CLUBHOUSE_API_TOKEN"
-  save_clubhouse_get('members')
-
-  # "https://api.clubhouse.io/api/v3/milestones?token=$CLUBHOUSE_API_TOKEN"
-  save_clubhouse_get('milestones')
-
-  # "https://api.clubhouse.io/api/v3/projects?token=$CLUBHOUSE_API_TOKEN"
-  save_clubhouse_get('projects')
-
-  # "https://api.clubhouse.io/api/v3/repositories?token=$CLUBHOUSE_API_TOKEN"
-  save_clubhouse_get('repositories')
-
-  # "https://api.clubhouse.io/api/v3/teams?token=$CLUBHOUSE_API_TOKEN"
-  save_clubhouse_get('teams')
-
-  # "https://api.clubhouse.io/api/v3/workflows?token=$CLUBHOUSE_API_TOKEN"
-  save_clubhouse_get('workflows')
-
-  # Story Searches
-  l_story_l = get_stories_l()
-  save_json_list('stories', l_story_l)
+  if report_jobs_n(l_result_l):
+    sys.exit(1)
 
 if __name__ == "__main__":
-  main()
\ No newline at end of file
+  club_metrics.run_main(main)
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+Batched story creation through stories/bulk.
+
+Posting every story in one request runs into the endpoint's per request
+story limit and body size limit. Stories are split into batches capped by
+both count and serialized size (comments and tasks make sizes very uneven),
+several batches are kept in flight, and only the batches that fail are
+retried. Each batch's latency and the overall throughput are printed.
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+import json
+import time
+
+import club_client
+import club_pool
+
+g_max_count_n = 100          # Stories per request
+g_max_bytes_n = 512 * 1024   # Serialized stories per request
+g_jobs_n      = 4            # Batches in flight
+
+# Groups items into lists of at most p_max_count_n items whose payloads
+# serialize to at most p_max_bytes_n. A single item bigger than that goes in
+# a batch of its own. p_payload_c picks the payload out of an item.
+def batches(p_item_iter, p_max_count_n=None, p_max_bytes_n=None, p_payload_c=None):
+  l_max_count_n = p_max_count_n or g_max_count_n
+  l_max_bytes_n = p_max_bytes_n or g_max_bytes_n
+  l_batch_l = []
+  l_bytes_n = 0
+
+  for l_item_c in p_item_iter:
+    l_payload_c = p_payload_c(l_item_c) if p_payload_c else l_item_c
+    l_size_n = len(json.dumps(l_payload_c).encode('utf-8')) + 1 # The comma
+    if l_batch_l and (len(l_batch_l) >= l_max_count_n or l_bytes_n + l_size_n > l_max_bytes_n):
+      yield l_batch_l
+      l_batch_l = []
+      l_bytes_n = 0
+    l_batch_l.append(l_item_c)
+    l_bytes_n += l_size_n
+
+  if l_batch_l:
+    yield l_batch_l
+
+# {external_id: story} for those of p_external_id_l that already exist, one
+# stories/search request each. For finding out whether a batch whose
+# response was lost got created. Raises the first failure.
+def existing_stories_d(p_external_id_l, p_jobs_n=None):
+  l_jobs_n = p_jobs_n or g_jobs_n
+  r_story_d = {}
+  l_work_c = lambda p_id_s: club_client.fetch_json_d('POST', club_client.api_url_s('stories/search'), { 'external_id': p_id_s })
+  for l_id_s, l_story_l, l_error_c in club_pool.run_adaptive(p_external_id_l, l_work_c, l_jobs_n, l_jobs_n):
+    if l_error_c is not None:
+      raise l_error_c
+    for l_story_d in l_story_l or []:
+      if l_story_d.get('external_id') == l_id_s:
+        r_story_d[l_id_s] = l_story_d
+  return r_story_d
+
+def post_batch_t(p_story_l):
+  l_start_n = time.perf_counter()
+  r_created_l = club_client.fetch_json_d('POST', club_client.api_url_s('stories/bulk'), { 'stories': p_story_l })
+  return (r_created_l, time.perf_counter() - l_start_n)
+
+# Creates p_story_l in batches. Returns (created stories in the same order as
+# p_story_l with None for any that failed, number of failed batches).
+# p_done_c(batch stories, created stories) is called from this thread as
+# each batch succeeds, p_sending_c(batch stories) just before a batch is
+# first sent.
+def create_stories_t(p_story_l, p_jobs_n=None, p_max_count_n=None, p_max_bytes_n=None, p_done_c=None, p_sending_c=None):
+  l_jobs_n = p_jobs_n or g_jobs_n
+  l_batch_l = list(enumerate(batches(p_story_l, p_max_count_n, p_max_bytes_n)))
+  l_offset_l = []
+  l_offset_n = 0
+  for l_index_n, l_stories_l in l_batch_l:
+    l_offset_l.append(l_offset_n)
+    l_offset_n += len(l_stories_l)
+
+  r_created_l = [None] * len(p_story_l)
+  r_failed_n = 0
+  l_done_n = 0
+  l_start_n = time.perf_counter()
+
+  # run_adaptive pulls the next batch in this thread
+  def sending():
+    for l_batch_t in l_batch_l:
+      if p_sending_c:
+        p_sending_c(l_batch_t[1])
+      yield l_batch_t
+
+  l_work_c = lambda p_batch_t: post_batch_t(p_batch_t[1])
+  # A batch that timed out may have been created, so it isn't sent again
+  l_run_c = club_pool.run_adaptive(sending(), l_work_c, l_jobs_n, l_jobs_n, club_client.resend_safe_b)
+  for l_batch_t, l_result_t, l_error_c in l_run_c:
+    l_index_n, l_stories_l = l_batch_t
+    if l_error_c is not None:
+      r_failed_n += 1
+      print('Batch %d/%d (%d stories) failed: %s' % (l_index_n + 1, len(l_batch_l), len(l_stories_l), l_error_c))
+      continue
+    l_created_l, l_latency_n = l_result_t
+    r_created_l[l_offset_l[l_index_n]:l_offset_l[l_index_n] + len(l_created_l)] = l_created_l
+    if p_done_c:
+      p_done_c(l_stories_l, l_created_l)
+    l_done_n += len(l_stories_l)
+    print('Batch %d/%d: %d stories in %.2fs' % (l_index_n + 1, len(l_batch_l), len(l_stories_l), l_latency_n))
+
+  l_seconds_n = time.perf_counter() - l_start_n
+  print('Created %d of %d stories in %.1fs (%.1f stories/sec, %d batches)' % (l_done_n, len(p_story_l), l_seconds_n, l_done_n / max(l_seconds_n, 0.001), len(l_batch_l)))
+  return (r_created_l, r_failed_n)
@@ -0,0 +1,350 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+Shared Clubhouse API client used by all of the scripts in this directory.
+
+All requests go through one pooled requests.Session so connections (and the
+TLS handshake) are reused across calls. The token is sent in the
+"Clubhouse-Token" header rather than being appended to the query string.
+
+Environment:
+CLUBHOUSE_API_TOKEN  - Clubhouse token (required by the scripts)
+CLUBHOUSE_POOL_SIZE  - Max pooled connections (default 10)
+CLUBHOUSE_URL_ROOT   - API host, handy for pointing at a local mock server
+CLUBHOUSE_RATE_LIMIT - Requests per minute (default 180, 0 for no limit)
+CLUBHOUSE_RATE_FILE  - Rate budget file shared by concurrent scripts
+                       (default clubhouse-rate-<token hash>.json in the
+                       temp directory, "-" for a budget per process)
+CLUBHOUSE_PAGE_SIZE  - Search results per page (default 25)
+CLUBHOUSE_PREFETCH   - Search pages fetched ahead of the caller (default 2,
+                       0 fetches each page only when it is asked for)
+CLUBHOUSE_ASYNC      - 1 sends every request through the asyncio backend
+                       (club_async.py)
+CLUBHOUSE_TIMEOUT    - Seconds to wait to connect, and for each read of a
+                       response (default 60)
+
+Every request is paced by club_rate.py: a token bucket at the per minute
+budget plus an adaptive concurrency limit. 429s are retried after the
+Retry-After time, 5xx responses (and connection errors on requests that
+are safe to repeat) with exponential backoff and jitter.
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+import hashlib
+import os
+import queue
+import requests
+import requests.adapters
+import sys
+import tempfile
+import threading
+import time
+
+import club_async
+import club_metrics
+import club_rate
+
+g_env_usage_message_s = '''
+This script requires that the environment variable "CLUBHOUSE_API_TOKEN" is
+set to a valid Clubhouse token.
+'''
+
+g_url_root_s = os.getenv('CLUBHOUSE_URL_ROOT', 'https://api.clubhouse.io')
+g_api_s      = '/api/v3/'
+
+g_token_header_s  = 'Clubhouse-Token'
+g_pool_size_n     = int(os.getenv('CLUBHOUSE_POOL_SIZE', '10'))
+g_rate_limit_n    = int(os.getenv('CLUBHOUSE_RATE_LIMIT', '180'))
+g_rate_file_s     = os.getenv('CLUBHOUSE_RATE_FILE')
+g_retry_n         = 5    # Retries of a 5xx or dropped connection
+g_retry_status_l  = [500, 502, 503, 504]
+g_idempotent_l    = ['GET', 'PUT', 'DELETE']
+g_page_size_n     = int(os.getenv('CLUBHOUSE_PAGE_SIZE', '25'))
+g_prefetch_n      = int(os.getenv('CLUBHOUSE_PREFETCH', '2'))
+g_async_b         = '1' == os.getenv('CLUBHOUSE_ASYNC')
+g_timeout_n       = float(os.getenv('CLUBHOUSE_TIMEOUT', '60'))
+
+g_session_c = None
+g_rate_c    = None
+
+# Build the shared session. Called by each script once the token is known,
+# calling it again replaces the session (and its pool).
+def init_session(p_token_s=None, p_pool_size_n=None, p_url_root_s=None):
+  global g_session_c, g_pool_size_n, g_url_root_s
+
+  if p_pool_size_n:
+    g_pool_size_n = p_pool_size_n
+  if p_url_root_s:
+    g_url_root_s = p_url_root_s
+  if p_token_s is None:
+    p_token_s = os.getenv('CLUBHOUSE_API_TOKEN', '')
+
+  if g_session_c is not None:
+    g_session_c.close()
+
+  g_session_c = requests.Session()
+  l_adapter_c = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=g_pool_size_n, pool_block=True)
+  g_session_c.mount('https://', l_adapter_c)
+  g_session_c.mount('http://', l_adapter_c)
+  g_session_c.headers.update({
+    'Content-Type'   : 'application/json',
+    'Connection'     : 'keep-alive',
+    g_token_header_s : p_token_s,
+  })
+  init_rate()
+  return g_session_c
+
+# Names files that belong to a token (rate budget, caches) without writing
+# the token itself anywhere.
+def token_hash_s():
+  l_token_s = get_session_c().headers.get(g_token_header_s, '')
+  return hashlib.sha256(l_token_s.encode('utf-8')).hexdigest()[:16]
+
+# The budget belongs to the token, so every script using the same token
+# shares the same file.
+def rate_file_s():
+  if '-' == g_rate_file_s:
+    return None
+  if g_rate_file_s:
+    return g_rate_file_s
+  return os.path.join(tempfile.gettempdir(), 'clubhouse-rate-' + token_hash_s() + '.json')
+
+# Replaces the rate controller, p_per_minute_n of 0 turns the pacing off.
+# The concurrency limit tops out at the pool size.
+def init_rate(p_per_minute_n=None):
+  global g_rate_c, g_rate_limit_n
+
+  if p_per_minute_n is not None:
+    g_rate_limit_n = p_per_minute_n
+  g_rate_c = club_rate.RateController_c(g_rate_limit_n, g_pool_size_n, p_path_s=rate_file_s())
+  return g_rate_c
+
+# Used by the scripts in place of their old copy of the token check.
+def init_from_env():
+  if not os.getenv('CLUBHOUSE_API_TOKEN'):
+    print(g_env_usage_message_s)
+    sys.exit(1)
+  return init_session(os.getenv('CLUBHOUSE_API_TOKEN'))
+
+def get_session_c():
+  if g_session_c is None:
+    init_session()
+  return g_session_c
+
+def api_url_s(p_source_s):
+  return g_url_root_s + g_api_s + p_source_s
+
+# Low level request. Paced by g_rate_c, waits and retries on 429 and
+# backs off and retries on 5xx. Raises any other (or a last)
+# requests.exceptions.RequestException to the caller. p_headers_d adds to
+# the session headers (If-None-Match for example).
+def send_request_c(p_method_s, p_url_s, p_json_d=None, p_params_d=None, p_headers_d=None):
+  with club_metrics.phase('fetch'):
+    if g_async_b:
+      return club_async.run(club_async.send_request_c(p_method_s, p_url_s, p_json_d, p_params_d, p_headers_d))
+    return send_paced_c(p_method_s, p_url_s, p_json_d, p_params_d, p_headers_d)
+
+# Every attempt is recorded in club_metrics
+def send_paced_c(p_method_s, p_url_s, p_json_d=None, p_params_d=None, p_headers_d=None):
+  l_session_c = get_session_c()
+  l_rate_c = g_rate_c
+  l_attempt_n = 0
+  while True:
+    l_rate_c.acquire()
+    l_start_n = time.perf_counter()
+    try:
+      r_response_c = l_session_c.request(p_method_s, p_url_s, json=p_json_d, params=p_params_d, headers=p_headers_d, timeout=g_timeout_n)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+      club_metrics.record_request(p_method_s, p_url_s, None, time.perf_counter() - l_start_n, 0, 0)
+      l_rate_c.release(None)
+      # A POST may have gone through, only repeat what is safe to
+      if p_method_s not in g_idempotent_l or l_attempt_n >= g_retry_n:
+        raise
+      club_metrics.record_retry(p_url_s, 'connection')
+      time.sleep(club_rate.backoff_n(l_attempt_n))
+      l_attempt_n += 1
+      continue
+    club_metrics.record_request(p_method_s, p_url_s, r_response_c.status_code, time.perf_counter() - l_start_n,
+                                len(r_response_c.request.body or b''), len(r_response_c.content))
+
+    l_wait_n = l_rate_c.release(r_response_c)
+    if l_wait_n is not None:
+      print( 'To Many Requests Error, waiting %.1f seconds ...' % l_wait_n )
+      club_metrics.record_retry(p_url_s, '429')
+      time.sleep(l_wait_n)
+      continue
+    if r_response_c.status_code in g_retry_status_l and l_attempt_n < g_retry_n:
+      club_metrics.record_retry(p_url_s, '5xx')
+      time.sleep(club_rate.backoff_n(l_attempt_n))
+      l_attempt_n += 1
+      continue
+    r_response_c.raise_for_status()
+    return r_response_c
+
+# Whether a failed non-idempotent request (a POST) can be sent again: the
+# server answered with an error, or no connection was ever made. After any
+# other transport error the request may have gone through.
+def resend_safe_b(p_error_c):
+  if isinstance(p_error_c, requests.exceptions.ConnectTimeout):
+    return True
+  if isinstance(p_error_c, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+    return False
+  return isinstance(p_error_c, requests.exceptions.HTTPError) and p_error_c.response is not None
+
+def response_json_d(p_response_c):
+  if not p_response_c.content:
+    return None
+  return p_response_c.json()
+
+# The fetch_ functions raise requests.exceptions.RequestException on failure,
+# for callers (like the thread pools) that want to report errors themselves.
+def fetch_json_d(p_method_s, p_url_s, p_json_d=None, p_params_d=None):
+  return response_json_d(send_request_c(p_method_s, p_url_s, p_json_d, p_params_d))
+
+def fetch_clubhouse_l(p_source_s, p_params_d=None):
+  return fetch_json_d('GET', api_url_s(p_source_s), p_params_d=p_params_d)
+
+# Searches return a 'next' path (already containing the query) when more
+# pages are available. Yields one page of records at a time, in order.
+def search_pages(p_type_s, p_query_d):
+  l_d = fetch_clubhouse_l('search/' + p_type_s, p_query_d)
+  while l_d['next'] is not None:
+    yield l_d['data']
+    l_d = fetch_json_d('GET', g_url_root_s + l_d['next'])
+  else:
+    yield l_d['data']
+
+# Runs search_pages in a background thread, p_prefetch_n pages ahead of the
+# caller, so the next page is on its way while this one is being used. A
+# failure is raised in the caller when it gets to that page. Stopping early
+# (closing the generator) stops the thread at its next page.
+def prefetch_pages(p_type_s, p_query_d, p_prefetch_n):
+  l_queue_c = queue.Queue(maxsize=p_prefetch_n)
+  l_stop_c = threading.Event()
+
+  def put(p_item_t):
+    while not l_stop_c.is_set():
+      try:
+        l_queue_c.put(p_item_t, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def produce():
+    try:
+      for l_page_l in search_pages(p_type_s, p_query_d):
+        if not put(('page', l_page_l)):
+          return
+      put(('done', None))
+    except Exception as l_e_c:
+      put(('error', l_e_c))
+
+  l_thread_c = threading.Thread(target=produce, daemon=True)
+  l_thread_c.start()
+  try:
+    while True:
+      l_kind_s, l_value_c = l_queue_c.get()
+      if 'page' == l_kind_s:
+        yield l_value_c
+      elif 'error' == l_kind_s:
+        raise l_value_c
+      else:
+        return
+  finally:
+    l_stop_c.set()
+
+# p_page_size_n and p_prefetch_n default to g_page_size_n and g_prefetch_n
+# (unless p_query_d already has a page_size). The async backend always
+# fetches one page ahead, the cursor for the one after isn't known yet.
+def fetch_query_pages(p_type_s, p_query_d, p_page_size_n=None, p_prefetch_n=None):
+  l_query_d = dict(p_query_d)
+  if p_page_size_n:
+    l_query_d['page_size'] = p_page_size_n
+  l_query_d.setdefault('page_size', g_page_size_n)
+  l_prefetch_n = g_prefetch_n if p_prefetch_n is None else p_prefetch_n
+  if g_async_b:
+    return club_async.query_pages(p_type_s, l_query_d)
+  if 1 > l_prefetch_n:
+    return search_pages(p_type_s, l_query_d)
+  return prefetch_pages(p_type_s, l_query_d, l_prefetch_n)
+
+# Same, one record at a time
+def fetch_query_records(p_type_s, p_query_d, p_page_size_n=None, p_prefetch_n=None):
+  for l_page_l in fetch_query_pages(p_type_s, p_query_d, p_page_size_n, p_prefetch_n):
+    yield from l_page_l
+
+def fetch_query_l(p_type_s, p_query_d, p_page_size_n=None, p_prefetch_n=None):
+  return list(fetch_query_records(p_type_s, p_query_d, p_page_size_n, p_prefetch_n))
+
+# Calls p_fetch_c but prints the error and exits, the way the scripts have
+# always handled failures.
+def exit_on_error(p_fetch_c, *p_args_l):
+  try:
+    return p_fetch_c(*p_args_l)
+  except requests.exceptions.RequestException as l_e_c:
+    print(l_e_c)
+    sys.exit(1)
+
+def call_clubhouse_d(p_method_s, p_url_s, p_json_d=None, p_params_d=None):
+  return exit_on_error(fetch_json_d, p_method_s, p_url_s, p_json_d, p_params_d)
+
+# curl -X GET \
+#  -H "Content-Type: application/json" \
+#  -H "Clubhouse-Token: $CLUBHOUSE_API_TOKEN" \
+#  -L "https://api.clubhouse.io/api/v3/labels"
+def get_clubhouse_l(p_source_s, p_params_d=None):
+  return call_clubhouse_d('GET', api_url_s(p_source_s), p_params_d=p_params_d)
+
+def post_clubhouse_l(p_source_s, p_json_d):
+  return call_clubhouse_d('POST', api_url_s(p_source_s), p_json_d=p_json_d)
+
+def put_clubhouse_d(p_source_s, p_json_d):
+  return call_clubhouse_d('PUT', api_url_s(p_source_s), p_json_d=p_json_d)
+
+def delete_clubhouse_d(p_source_s, p_json_d=None):
+  return call_clubhouse_d('DELETE', api_url_s(p_source_s), p_json_d=p_json_d)
+
+def query_clubhouse_l(p_type_s, p_query_d, p_page_size_n=None, p_prefetch_n=None):
+  return exit_on_error(fetch_query_l, p_type_s, p_query_d, p_page_size_n, p_prefetch_n)
+
+# Small helpers so the scripts can take "--name value" style options while
+# keeping their positional argument handling. The option is removed from
+# p_argv_l. Both "--jobs 4" and "--jobs=4" are accepted.
+def pop_option_s(p_argv_l, p_name_s, p_default_s=None):
+  for i in range(len(p_argv_l)):
+    if p_argv_l[i] == p_name_s and i + 1 < len(p_argv_l):
+      r_value_s = p_argv_l[i + 1]
+      del p_argv_l[i:i + 2]
+      return r_value_s
+    if p_argv_l[i].startswith(p_name_s + '='):
+      r_value_s = p_argv_l[i][len(p_name_s) + 1:]
+      del p_argv_l[i]
+      return r_value_s
+  return p_default_s
+
+def pop_flag_b(p_argv_l, p_name_s):
+  if p_name_s in p_argv_l:
+    p_argv_l.remove(p_name_s)
+    return True
+  return False
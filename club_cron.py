@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+Cron expressions for the create_by_label.py daemon.
+
+The usual five fields, in local time:
+
+  minute hour day-of-month month day-of-week
+
+Each field takes *, numbers, ranges (1-5), steps (*/15, 1-30/2), comma
+lists, and for month and day-of-week the English three letter names (jan,
+mon). Day-of-week 0 and 7 are both Sunday. As in Vixie cron, when both
+day-of-month and day-of-week are restricted a day matching either one
+matches. The @hourly, @daily, @weekly, @monthly and @yearly shortcuts are
+accepted too.
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+from datetime import timedelta
+
+g_field_l = [ # (name, low, high)
+  ('minute',       0, 59),
+  ('hour',         0, 23),
+  ('day of month', 1, 31),
+  ('month',        1, 12),
+  ('day of week',  0, 7),
+]
+
+g_names_d = {
+  3: { l_name_s: i + 1 for i, l_name_s in enumerate(['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']) },
+  4: { l_name_s: i for i, l_name_s in enumerate(['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']) },
+}
+
+g_shortcut_d = {
+  '@hourly'  : '0 * * * *',
+  '@daily'   : '0 0 * * *',
+  '@midnight': '0 0 * * *',
+  '@weekly'  : '0 0 * * 0',
+  '@monthly' : '0 0 1 * *',
+  '@yearly'  : '0 0 1 1 *',
+  '@annually': '0 0 1 1 *',
+}
+
+def value_n(p_text_s, p_index_n):
+  l_text_s = p_text_s.lower()
+  if l_text_s in g_names_d.get(p_index_n, {}):
+    return g_names_d[p_index_n][l_text_s]
+  return int(l_text_s)
+
+# One field => set of allowed values. Raises ValueError on a bad field.
+def parse_field_s(p_text_s, p_index_n):
+  l_name_s, l_low_n, l_high_n = g_field_l[p_index_n]
+  r_value_s = set()
+  for l_part_s in p_text_s.split(','):
+    l_range_s, l_slash_s, l_step_s = l_part_s.partition('/')
+    l_step_n = int(l_step_s) if l_slash_s else 1
+    if '*' == l_range_s:
+      l_start_n, l_end_n = l_low_n, l_high_n
+    elif '-' in l_range_s:
+      l_start_s, l_end_s = l_range_s.split('-', 1)
+      l_start_n, l_end_n = value_n(l_start_s, p_index_n), value_n(l_end_s, p_index_n)
+    else:
+      l_start_n = value_n(l_range_s, p_index_n)
+      l_end_n = l_high_n if l_slash_s else l_start_n # "5/10" means 5, 15, ...
+    if l_step_n < 1 or l_start_n < l_low_n or l_end_n > l_high_n or l_start_n > l_end_n:
+      raise ValueError('Bad ' + l_name_s + ' field in cron expression: ' + p_text_s)
+    r_value_s.update(range(l_start_n, l_end_n + 1, l_step_n))
+  return r_value_s
+
+class Cron_c:
+
+  def __init__(self, p_expression_s):
+    self.expression_s = p_expression_s
+    l_field_l = g_shortcut_d.get(p_expression_s.strip(), p_expression_s).split()
+    if 5 != len(l_field_l):
+      raise ValueError('Cron expression needs 5 fields: ' + p_expression_s)
+    self.minute_s, self.hour_s, self.day_s, self.month_s, self.weekday_s = [
+      parse_field_s(l_field_s, i) for i, l_field_s in enumerate(l_field_l) ]
+    if 7 in self.weekday_s:
+      self.weekday_s.add(0)
+    # Like Vixie cron, a day field starting with * ("*", "*/2") doesn't
+    # restrict the day, and is ANDed with the other one
+    self.day_any_b     = l_field_l[2].startswith('*')
+    self.weekday_any_b = l_field_l[4].startswith('*')
+
+  def day_b(self, p_time_c):
+    l_weekday_n = (p_time_c.weekday() + 1) % 7 # Python's Monday is 0, cron's Sunday is
+    l_day_b = p_time_c.day in self.day_s
+    l_weekday_b = l_weekday_n in self.weekday_s
+    if self.day_any_b or self.weekday_any_b:
+      return l_day_b and l_weekday_b
+    return l_day_b or l_weekday_b
+
+  # First matching minute after p_time_c. Skips whole months, days and
+  # hours that can't match rather than walking every minute.
+  def next_c(self, p_time_c):
+    r_time_c = p_time_c.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    l_limit_c = r_time_c + timedelta(days=366 * 8)  # "0 0 29 2 *" from 2096 is next in 2104
+    while r_time_c < l_limit_c:
+      if r_time_c.month not in self.month_s:
+        r_time_c = (r_time_c.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+      elif not self.day_b(r_time_c):
+        r_time_c = r_time_c.replace(hour=0, minute=0) + timedelta(days=1)
+      elif r_time_c.hour not in self.hour_s:
+        r_time_c = r_time_c.replace(minute=0) + timedelta(hours=1)
+      elif r_time_c.minute not in self.minute_s:
+        r_time_c += timedelta(minutes=1)
+      else:
+        return r_time_c
+    raise ValueError('Cron expression never matches: ' + self.expression_s)
@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+Compares two club_back.py backups collection by collection.
+
+The first pass reads each side once and keeps only id => hash for the old
+side. The new side is streamed against it: an id that isn't there was
+added, one whose hash differs was modified and whatever is left over was
+removed. Entities backups already have the hashes in index.json, so no
+record is read. With jsonl the hash is of the raw line and the file offset
+is kept so the second pass can seek straight to the lines that changed.
+When the two sides are in different formats both are hashed the entities
+way (canonical text, see club_store.py).
+
+The second pass reads only the changed records and works out which fields
+differ. A record whose line changed without any field changing (key order)
+is dropped there. Memory is the old side's hashes plus the changed records.
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+import hashlib
+import json
+import os
+import sys
+import time
+
+import club_client
+import club_store
+
+g_usage_string_0_s = """
+Reports what changed between two club_back.py backups (any formats): the
+records added, removed and modified in each collection, and for the
+modified ones which fields changed from what to what.
+
+Options:
+--only NAMES   Comma separated collections to compare (default all of them)
+--summary      Only the counts per collection
+--json         One JSON object per change instead of the text report
+
+Usage: prompt$ """
+
+g_usage_string_1_s = ''' [--only NAMES] [--summary] [--json] old_backup_directory new_backup_directory'''
+
+g_width_n = 70   # Longest value shown in the text report
+
+g_missing_c = object() # A field one side doesn't have
+
+def line_hash_s(p_line_c):
+  return hashlib.blake2b(p_line_c, digest_size=16).digest()
+
+# Yields (key, hash, where) for every record of a collection. where is the
+# byte offset of a jsonl line, else None. p_canonical_b hashes jsonl records
+# the entities way rather than by line.
+def key_hashes(p_dirpath_s, p_name_s, p_format_s, p_canonical_b):
+  if 'entities' == p_format_s:
+    for l_key_s, l_hash_s in club_store.read_entity_index_d(p_dirpath_s, p_name_s).items():
+      yield (l_key_s, l_hash_s, None)
+  elif 'jsonl' == p_format_s:
+    with open(club_store.jsonl_path_s(p_dirpath_s, p_name_s), 'rb') as l_file_c:
+      l_offset_n = 0
+      l_position_n = 0
+      for l_line_c in l_file_c:
+        if l_line_c.strip():
+          l_record_d = json.loads(l_line_c)
+          l_hash_s = club_store.hash_s(club_store.canonical_json_s(l_record_d)) if p_canonical_b else line_hash_s(l_line_c)
+          yield (club_store.entity_key_s(l_record_d, l_position_n), l_hash_s, l_offset_n)
+          l_position_n += 1
+        l_offset_n += len(l_line_c)
+  elif 'json' == p_format_s:
+    for l_position_n, l_record_d in enumerate(club_store.read_collection(p_dirpath_s, p_name_s, 'json')):
+      yield (club_store.entity_key_s(l_record_d, l_position_n), club_store.hash_s(club_store.canonical_json_s(l_record_d)), None)
+
+# Yields (key, record) for the keys in p_where_d (key => where from
+# key_hashes), reading as little as the format allows.
+def keyed_records(p_dirpath_s, p_name_s, p_format_s, p_where_d):
+  if 'entities' == p_format_s:
+    for l_key_s in p_where_d:
+      with open(os.path.join(club_store.entity_dir_s(p_dirpath_s, p_name_s), l_key_s + '.json'), 'r', encoding='utf-8') as json_file:
+        yield (l_key_s, json.load(json_file))
+  elif 'jsonl' == p_format_s:
+    with open(club_store.jsonl_path_s(p_dirpath_s, p_name_s), 'rb') as l_file_c:
+      for l_key_s in sorted(p_where_d, key=p_where_d.get):
+        l_file_c.seek(p_where_d[l_key_s])
+        yield (l_key_s, json.loads(l_file_c.readline()))
+  elif 'json' == p_format_s:
+    for l_position_n, l_record_d in enumerate(club_store.read_collection(p_dirpath_s, p_name_s, 'json')):
+      l_key_s = club_store.entity_key_s(l_record_d, l_position_n)
+      if l_key_s in p_where_d:
+        yield (l_key_s, l_record_d)
+
+# [(field, old value, new value)] in field order, with nested objects
+# followed down as a.b.c. Lists are compared whole.
+def field_changes_l(p_old_d, p_new_d, p_prefix_s=''):
+  r_change_l = []
+  for l_field_s in sorted(set(p_old_d) | set(p_new_d)):
+    l_old_c = p_old_d.get(l_field_s, g_missing_c)
+    l_new_c = p_new_d.get(l_field_s, g_missing_c)
+    if l_old_c == l_new_c:
+      continue
+    if isinstance(l_old_c, dict) and isinstance(l_new_c, dict):
+      r_change_l += field_changes_l(l_old_c, l_new_c, p_prefix_s + l_field_s + '.')
+    else:
+      r_change_l.append((p_prefix_s + l_field_s, l_old_c, l_new_c))
+  return r_change_l
+
+def record_name_s(p_record_d):
+  if not isinstance(p_record_d, dict):
+    return ''
+  return str(p_record_d.get('name') or p_record_d.get('profile', {}).get('name') or '')
+
+# Numeric ids in numeric order
+def key_order_t(p_key_s):
+  return (len(p_key_s), p_key_s)
+
+# Compares one collection. Returns
+# { 'name', 'old_count', 'new_count', 'added': [(key, name)],
+#   'removed': [(key, name)], 'modified': [(key, name, field changes)] }
+def diff_collection_d(p_old_dir_s, p_new_dir_s, p_name_s):
+  l_old_format_s = club_store.collection_format_s(p_old_dir_s, p_name_s)
+  l_new_format_s = club_store.collection_format_s(p_new_dir_s, p_name_s)
+  # Line hashes only mean something against the same layout
+  l_canonical_b = l_old_format_s != l_new_format_s
+
+  l_old_d = { l_key_s: (l_hash_s, l_where_c) for l_key_s, l_hash_s, l_where_c in key_hashes(p_old_dir_s, p_name_s, l_old_format_s, l_canonical_b) }
+  r_diff_d = { 'name': p_name_s, 'old_count': len(l_old_d), 'new_count': 0, 'added': [], 'removed': [], 'modified': [] }
+  l_new_where_d = {}
+  l_old_where_d = {}
+  l_modified_d = {}
+  for l_key_s, l_hash_s, l_where_c in key_hashes(p_new_dir_s, p_name_s, l_new_format_s, l_canonical_b):
+    r_diff_d['new_count'] += 1
+    l_old_t = l_old_d.pop(l_key_s, None)
+    if l_old_t is not None and l_old_t[0] == l_hash_s:
+      continue
+    l_new_where_d[l_key_s] = l_where_c
+    if l_old_t is not None:
+      l_old_where_d[l_key_s] = l_old_t[1]
+      l_modified_d[l_key_s] = None
+  for l_key_s in l_old_d:
+    l_old_where_d[l_key_s] = l_old_d[l_key_s][1]
+  l_old_d = None
+
+  # Old copies are kept for the modified records only
+  for l_key_s, l_record_d in keyed_records(p_old_dir_s, p_name_s, l_old_format_s, l_old_where_d):
+    if l_key_s in l_modified_d:
+      l_modified_d[l_key_s] = l_record_d
+    else:
+      r_diff_d['removed'].append((l_key_s, record_name_s(l_record_d)))
+
+  for l_key_s, l_record_d in keyed_records(p_new_dir_s, p_name_s, l_new_format_s, l_new_where_d):
+    if l_key_s not in l_modified_d:
+      r_diff_d['added'].append((l_key_s, record_name_s(l_record_d)))
+      continue
+    l_old_record_d = l_modified_d.pop(l_key_s)
+    if isinstance(l_old_record_d, dict) and isinstance(l_record_d, dict):
+      l_change_l = field_changes_l(l_old_record_d, l_record_d)
+    else:
+      l_change_l = [] if l_old_record_d == l_record_d else [('', l_old_record_d, l_record_d)]
+    if l_change_l:
+      r_diff_d['modified'].append((l_key_s, record_name_s(l_record_d), l_change_l))
+
+  for l_change_s in ['added', 'removed', 'modified']:
+    r_diff_d[l_change_s].sort(key=lambda p_t: key_order_t(p_t[0]))
+  return r_diff_d
+
+def value_s(p_value_c):
+  if p_value_c is g_missing_c:
+    return '(missing)'
+  r_value_s = json.dumps(p_value_c, ensure_ascii=False)
+  if len(r_value_s) > g_width_n:
+    r_value_s = r_value_s[:g_width_n - 3] + '...'
+  return r_value_s
+
+def summary_s(p_diff_d):
+  l_unchanged_n = p_diff_d['new_count'] - len(p_diff_d['added']) - len(p_diff_d['modified'])
+  return '%s: %d added, %d removed, %d modified, %d unchanged' % (
+    p_diff_d['name'], len(p_diff_d['added']), len(p_diff_d['removed']), len(p_diff_d['modified']), l_unchanged_n)
+
+def print_text(p_diff_d, p_summary_b):
+  print(summary_s(p_diff_d))
+  if p_summary_b:
+    return
+  for l_key_s, l_name_s in p_diff_d['added']:
+    print('  + ' + l_key_s + ' ' + l_name_s)
+  for l_key_s, l_name_s in p_diff_d['removed']:
+    print('  - ' + l_key_s + ' ' + l_name_s)
+  for l_key_s, l_name_s, l_change_l in p_diff_d['modified']:
+    print('  ~ ' + l_key_s + ' ' + l_name_s)
+    for l_field_s, l_old_c, l_new_c in l_change_l:
+      print('      ' + l_field_s + ': ' + value_s(l_old_c) + ' -> ' + value_s(l_new_c))
+
+def print_json(p_diff_d):
+  for l_change_s in ['added', 'removed']:
+    for l_key_s, l_name_s in p_diff_d[l_change_s]:
+      print(json.dumps({ 'collection': p_diff_d['name'], 'change': l_change_s, 'id': l_key_s, 'name': l_name_s }))
+  for l_key_s, l_name_s, l_change_l in p_diff_d['modified']:
+    l_field_l = []
+    for l_field_s, l_old_c, l_new_c in l_change_l:
+      l_field_d = { 'field': l_field_s }
+      if l_old_c is not g_missing_c:
+        l_field_d['old'] = l_old_c
+      if l_new_c is not g_missing_c:
+        l_field_d['new'] = l_new_c
+      l_field_l.append(l_field_d)
+    print(json.dumps({ 'collection': p_diff_d['name'], 'change': 'modified', 'id': l_key_s, 'name': l_name_s, 'fields': l_field_l }))
+
+def main():
+
+  l_argv_l = list(sys.argv)
+
+  l_summary_b = club_client.pop_flag_b(l_argv_l, '--summary')
+  l_json_b = club_client.pop_flag_b(l_argv_l, '--json')
+  l_only_s = club_client.pop_option_s(l_argv_l, '--only')
+
+  if (3 != len(l_argv_l)) or not os.path.isdir(l_argv_l[1]) or not os.path.isdir(l_argv_l[2]):
+    print(g_usage_string_0_s + sys.argv[0] + g_usage_string_1_s)
+    sys.exit(1)
+
+  l_old_dir_s, l_new_dir_s = l_argv_l[1], l_argv_l[2]
+  l_name_l = club_store.collection_names_l(l_old_dir_s)
+  l_name_l += [ l_name_s for l_name_s in club_store.collection_names_l(l_new_dir_s) if l_name_s not in l_name_l ]
+  if l_only_s:
+    l_name_l = [ l_name_s for l_name_s in l_only_s.split(',') if l_name_s in l_name_l ]
+
+  l_start_n = time.perf_counter()
+  l_record_n = 0
+  for l_name_s in l_name_l:
+    l_diff_d = diff_collection_d(l_old_dir_s, l_new_dir_s, l_name_s)
+    l_record_n += l_diff_d['old_count'] + l_diff_d['new_count']
+    if l_json_b:
+      print_json(l_diff_d)
+    else:
+      print_text(l_diff_d, l_summary_b)
+  if not l_json_b:
+    print('Compared %d records in %.2fs' % (l_record_n, time.perf_counter() - l_start_n))
+  sys.exit(0)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,374 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+SQLite index over club_back.py backups, for answering questions offline.
+
+Each backup directory that is ingested updates the database in place.
+Every row has the time it was first seen (valid_from, when the backup of
+its collection was written) and the time it changed or went away
+(valid_to, NULL while current). A record is hashed the same way as the
+entities format (club_store.py) and only gets a new row when the hash
+changes, so ingesting a backup costs what changed rather than the size of
+the workspace, and the database can answer "as of" questions for any time
+it has seen.
+
+Tables (one row per version):
+
+labels, projects, workflows, templates (entity-templates)
+epics, epic_labels
+stories, story_labels
+story_details (club_back.py --deep)
+tasks, comments (from story-details, or from the stories if they have them)
+
+Each of the first group has key, id, valid_from, valid_to, hash, json
+plus a few columns pulled out of the record for indexing. The label
+tables point at the story/epic row they belong to.
+
+A collection whose backup file hasn't changed since it was last ingested
+is skipped. With the entities format only the records whose hash changed
+are read.
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+from datetime import datetime, timezone
+import json
+import os
+import sqlite3
+import sys
+
+import club_client
+import club_store
+
+g_usage_string_0_s = """
+Builds or updates a SQLite index of a club_back.py backup directory (any
+of its formats). Run it after every backup, or use club_back.py --index.
+Only what changed since the last backup is written, the old versions are
+kept so the index can be asked what things looked like at an earlier time.
+
+With --label or --epic the index is queried instead:
+
+--label NAME   Stories that carry the label
+--epic ID      Stories in the epic
+--as-of DATE   As of YYYY-MM-DD (end of that day, UTC) or an ISO time,
+               instead of the latest backup
+
+Other queries can go straight to the database with the sqlite3 shell.
+
+Options:
+--db FILE      The database (default club_index.sqlite)
+
+Usage: prompt$ """
+
+g_usage_string_1_s = ''' [--db FILE] backup_directory'''
+g_usage_string_2_s = ''' [--db FILE] [--as-of DATE] --label NAME | --epic ID'''
+
+g_db_s = 'club_index.sqlite'
+
+# table, collection, extracted columns, indexed columns, label table
+g_table_l = [
+  ('labels',        'labels',           ['name', 'archived'], ['name'], None),
+  ('projects',      'projects',         ['name', 'archived'], ['name'], None),
+  ('workflows',     'workflows',        ['name'], [], None),
+  ('templates',     'entity-templates', ['name'], [], None),
+  ('epics',         'epics',            ['name', 'state', 'archived', 'created_at', 'updated_at'],
+                                        ['updated_at'], 'epic_labels'),
+  ('stories',       'stories',          ['name', 'story_type', 'project_id', 'epic_id', 'workflow_state_id', 'archived', 'created_at', 'updated_at'],
+                                        ['project_id', 'epic_id', 'workflow_state_id', 'created_at', 'updated_at'], 'story_labels'),
+  ('story_details', 'story-details',    ['updated_at'], [], None),
+]
+
+# Per story: table, story field, extracted columns
+g_child_l = [
+  ('tasks',    'tasks',    ['description', 'complete', 'created_at', 'updated_at']),
+  ('comments', 'comments', ['author_id', 'text', 'created_at', 'updated_at']),
+]
+
+def create_schema(p_conn_c):
+  p_conn_c.execute('CREATE TABLE IF NOT EXISTS collections (name TEXT PRIMARY KEY, signature TEXT, taken_at TEXT, count INTEGER, indexed_at TEXT)')
+  for l_table_s, l_collection_s, l_column_l, l_index_l, l_label_table_s in g_table_l:
+    p_conn_c.execute('CREATE TABLE IF NOT EXISTS ' + l_table_s + ' (row INTEGER PRIMARY KEY, key TEXT, id, valid_from TEXT, valid_to TEXT, hash TEXT, json TEXT, '
+                     + ', '.join(l_column_l) + ')')
+    p_conn_c.execute('CREATE UNIQUE INDEX IF NOT EXISTS ' + l_table_s + '_key ON ' + l_table_s + ' (key) WHERE valid_to IS NULL')
+    for l_column_s in ['id'] + l_index_l:
+      p_conn_c.execute('CREATE INDEX IF NOT EXISTS ' + l_table_s + '_' + l_column_s + ' ON ' + l_table_s + ' (' + l_column_s + ')')
+    if l_label_table_s:
+      p_conn_c.execute('CREATE TABLE IF NOT EXISTS ' + l_label_table_s + ' (row INTEGER, label_id, name TEXT)')
+      for l_column_s in ['row', 'label_id', 'name']:
+        p_conn_c.execute('CREATE INDEX IF NOT EXISTS ' + l_label_table_s + '_' + l_column_s + ' ON ' + l_label_table_s + ' (' + l_column_s + ')')
+  for l_table_s, l_field_s, l_column_l in g_child_l:
+    p_conn_c.execute('CREATE TABLE IF NOT EXISTS ' + l_table_s + ' (row INTEGER PRIMARY KEY, story_id, key TEXT, valid_from TEXT, valid_to TEXT, hash TEXT, json TEXT, '
+                     + ', '.join(l_column_l) + ')')
+    p_conn_c.execute('CREATE INDEX IF NOT EXISTS ' + l_table_s + '_story_id ON ' + l_table_s + ' (story_id, valid_to)')
+
+def connect_c(p_db_s):
+  r_conn_c = sqlite3.connect(p_db_s)
+  with r_conn_c:
+    create_schema(r_conn_c)
+  return r_conn_c
+
+def collection_path_s(p_dirpath_s, p_name_s, p_format_s):
+  if 'entities' == p_format_s:
+    return club_store.entity_index_path_s(p_dirpath_s, p_name_s)
+  if 'jsonl' == p_format_s:
+    return club_store.jsonl_path_s(p_dirpath_s, p_name_s)
+  return club_store.json_path_s(p_dirpath_s, p_name_s)
+
+# Changes whenever the collection's file is rewritten
+def signature_s(p_dirpath_s, p_name_s, p_format_s):
+  l_stat_c = os.stat(collection_path_s(p_dirpath_s, p_name_s, p_format_s))
+  return p_format_s + ':' + str(l_stat_c.st_mtime_ns) + ':' + str(l_stat_c.st_size)
+
+# When the collection was backed up: the manifest's written_at, the last
+# run in backup.manifest.json, or failing both the file's modification time.
+def taken_at_s(p_dirpath_s, p_name_s, p_format_s, p_backup_manifest_d):
+  l_manifest_d = club_store.read_manifest_d(p_dirpath_s, p_name_s)
+  if l_manifest_d and l_manifest_d.get('written_at'):
+    return l_manifest_d['written_at']
+  l_saved_d = p_backup_manifest_d['collections'].get(p_name_s, {})
+  if l_saved_d.get('last_run'):
+    return l_saved_d['last_run']
+  l_mtime_n = os.path.getmtime(collection_path_s(p_dirpath_s, p_name_s, p_format_s))
+  return datetime.fromtimestamp(l_mtime_n, timezone.utc).isoformat()
+
+# Yields (key, hash, record) for each record of the collection. With the
+# entities format the record is None when its hash is already in p_hash_d
+# (key => hash), the file isn't read.
+def source_records(p_dirpath_s, p_name_s, p_format_s, p_hash_d):
+  if 'entities' == p_format_s:
+    l_dir_s = club_store.entity_dir_s(p_dirpath_s, p_name_s)
+    for l_key_s, l_hash_s in club_store.read_entity_index_d(p_dirpath_s, p_name_s).items():
+      if p_hash_d.get(l_key_s) == l_hash_s:
+        yield (l_key_s, l_hash_s, None)
+        continue
+      with open(os.path.join(l_dir_s, l_key_s + '.json'), 'r', encoding='utf-8') as json_file:
+        yield (l_key_s, l_hash_s, json.load(json_file))
+    return
+  for l_position_n, l_record_d in enumerate(club_store.read_collection(p_dirpath_s, p_name_s, p_format_s)):
+    yield (club_store.entity_key_s(l_record_d, l_position_n), club_store.hash_s(club_store.canonical_json_s(l_record_d)), l_record_d)
+
+def insert_row_n(p_conn_c, p_table_s, p_column_l, p_lead_l, p_record_d):
+  l_value_l = p_lead_l + [ json.dumps(p_record_d) ] + [ p_record_d.get(l_column_s) for l_column_s in p_column_l ]
+  l_cursor_c = p_conn_c.execute('INSERT INTO ' + p_table_s + ' VALUES (NULL, ' + ', '.join(['?'] * len(l_value_l)) + ')', l_value_l)
+  return l_cursor_c.lastrowid
+
+# (row, label id, name) for each label of a story or epic. Slim records may
+# only have label_ids.
+def label_rows_l(p_row_n, p_record_d):
+  r_row_l = [ (p_row_n, l_label_d.get('id'), l_label_d.get('name')) for l_label_d in p_record_d.get('labels') or [] ]
+  l_id_l = [ l_row_t[1] for l_row_t in r_row_l ]
+  r_row_l += [ (p_row_n, l_id_n, None) for l_id_n in p_record_d.get('label_ids') or [] if l_id_n not in l_id_l ]
+  return r_row_l
+
+# Brings the tasks and comments of one story up to date. Only the fields
+# the story record has are touched (a slim search result has neither).
+def sync_children(p_conn_c, p_story_id_c, p_story_d, p_taken_s):
+  for l_table_s, l_field_s, l_column_l in g_child_l:
+    if p_story_d is not None and l_field_s not in p_story_d:
+      continue
+    l_current_d = { l_key_s: (l_row_n, l_hash_s) for l_key_s, l_row_n, l_hash_s in p_conn_c.execute(
+      'SELECT key, row, hash FROM ' + l_table_s + ' WHERE story_id = ? AND valid_to IS NULL', (p_story_id_c,)) }
+    l_seen_d = {}
+    for l_position_n, l_child_d in enumerate([] if p_story_d is None else p_story_d[l_field_s] or []):
+      l_key_s = club_store.entity_key_s(l_child_d, l_position_n)
+      l_hash_s = club_store.hash_s(club_store.canonical_json_s(l_child_d))
+      l_seen_d[l_key_s] = True
+      if l_key_s in l_current_d and l_hash_s == l_current_d[l_key_s][1]:
+        continue
+      if l_key_s in l_current_d:
+        p_conn_c.execute('UPDATE ' + l_table_s + ' SET valid_to = ? WHERE row = ?', (p_taken_s, l_current_d[l_key_s][0]))
+      insert_row_n(p_conn_c, l_table_s, l_column_l, [p_story_id_c, l_key_s, p_taken_s, None, l_hash_s], l_child_d)
+    p_conn_c.executemany('UPDATE ' + l_table_s + ' SET valid_to = ? WHERE row = ?',
+                         [ (p_taken_s, l_current_d[l_key_s][0]) for l_key_s in l_current_d if l_key_s not in l_seen_d ])
+
+# Brings one table up to date with its collection in the backup. Returns
+# (rows added or changed, rows removed, records in the backup).
+def sync_table_t(p_conn_c, p_table_t, p_dirpath_s, p_format_s, p_taken_s, p_children_b):
+  l_table_s, l_collection_s, l_column_l, l_index_l, l_label_table_s = p_table_t
+  l_current_d = { l_key_s: (l_row_n, l_hash_s, l_id_c) for l_key_s, l_row_n, l_hash_s, l_id_c in p_conn_c.execute(
+    'SELECT key, row, hash, id FROM ' + l_table_s + ' WHERE valid_to IS NULL') }
+  l_hash_d = { l_key_s: l_current_d[l_key_s][1] for l_key_s in l_current_d }
+
+  l_seen_d = {}
+  l_changed_n = 0
+  for l_key_s, l_hash_s, l_record_d in source_records(p_dirpath_s, l_collection_s, p_format_s, l_hash_d):
+    l_seen_d[l_key_s] = True
+    if l_hash_d.get(l_key_s) == l_hash_s:
+      continue
+    if l_key_s in l_current_d:
+      p_conn_c.execute('UPDATE ' + l_table_s + ' SET valid_to = ? WHERE row = ?', (p_taken_s, l_current_d[l_key_s][0]))
+    l_row_n = insert_row_n(p_conn_c, l_table_s, l_column_l, [l_key_s, l_record_d.get('id'), p_taken_s, None, l_hash_s], l_record_d)
+    if l_label_table_s:
+      p_conn_c.executemany('INSERT INTO ' + l_label_table_s + ' VALUES (?, ?, ?)', label_rows_l(l_row_n, l_record_d))
+    if p_children_b:
+      sync_children(p_conn_c, l_record_d.get('id'), l_record_d, p_taken_s)
+    l_changed_n += 1
+
+  l_removed_l = [ l_current_d[l_key_s] for l_key_s in l_current_d if l_key_s not in l_seen_d ]
+  for l_row_n, l_hash_s, l_id_c in l_removed_l:
+    p_conn_c.execute('UPDATE ' + l_table_s + ' SET valid_to = ? WHERE row = ?', (p_taken_s, l_row_n))
+    if p_children_b:
+      sync_children(p_conn_c, l_id_c, None, p_taken_s)
+  return (l_changed_n, len(l_removed_l), len(l_seen_d))
+
+# Ingests one backup directory. Collections missing from the backup, or
+# unchanged since they were last ingested, are left alone. Returns
+# {collection: (changed, removed, count)} for the ones that were updated.
+def ingest_d(p_conn_c, p_dirpath_s):
+  l_backup_manifest_d = club_store.read_backup_manifest_d(p_dirpath_s)
+  # Tasks and comments come from the full story records when there are any
+  l_child_source_s = 'story-details' if club_store.collection_format_s(p_dirpath_s, 'story-details') else 'stories'
+
+  r_result_d = {}
+  for l_table_t in g_table_l:
+    l_collection_s = l_table_t[1]
+    l_format_s = club_store.collection_format_s(p_dirpath_s, l_collection_s)
+    if l_format_s is None:
+      continue
+    l_signature_s = signature_s(p_dirpath_s, l_collection_s, l_format_s)
+    l_taken_s = taken_at_s(p_dirpath_s, l_collection_s, l_format_s, l_backup_manifest_d)
+    l_saved_t = p_conn_c.execute('SELECT signature, taken_at FROM collections WHERE name = ?', (l_collection_s,)).fetchone()
+    if l_saved_t and l_saved_t[0] == l_signature_s:
+      continue
+    if l_saved_t and l_saved_t[1] > l_taken_s:
+      print(l_collection_s + ': backup from ' + l_taken_s + ' is older than the indexed one from ' + l_saved_t[1] + ', skipped')
+      continue
+
+    # One transaction per collection, a failure leaves the last good copy
+    with p_conn_c:
+      r_result_d[l_collection_s] = sync_table_t(p_conn_c, l_table_t, p_dirpath_s, l_format_s, l_taken_s, l_child_source_s == l_collection_s)
+      p_conn_c.execute('INSERT OR REPLACE INTO collections VALUES (?, ?, ?, ?, ?)',
+                       (l_collection_s, l_signature_s, l_taken_s, r_result_d[l_collection_s][2], datetime.now(timezone.utc).isoformat()))
+    print('%s: %d changed, %d removed, %d total' % ((l_collection_s,) + r_result_d[l_collection_s]))
+  return r_result_d
+
+# A DATE is the end of that day
+def as_of_s(p_value_s):
+  if p_value_s is None or 'T' in p_value_s:
+    return p_value_s
+  return p_value_s + 'T23:59:59.999999+00:00'
+
+# SQL condition and parameters for the rows of p_alias_s that were current
+# at p_as_of_s (None for the latest)
+def live_t(p_alias_s, p_as_of_s=None):
+  if p_as_of_s is None:
+    return (p_alias_s + '.valid_to IS NULL', [])
+  return ('(' + p_alias_s + '.valid_from <= ? AND (' + p_alias_s + '.valid_to IS NULL OR ' + p_alias_s + '.valid_to > ?))', [p_as_of_s, p_as_of_s])
+
+# The records of a table as they were at p_as_of_s
+def records_l(p_conn_c, p_table_s, p_as_of_s=None):
+  l_where_s, l_param_l = live_t('t', p_as_of_s)
+  return [ json.loads(l_row_t[0]) for l_row_t in p_conn_c.execute('SELECT t.json FROM ' + p_table_s + ' t WHERE ' + l_where_s + ' ORDER BY t.row', l_param_l) ]
+
+def ids_named_l(p_conn_c, p_table_s, p_name_s, p_as_of_s=None):
+  l_where_s, l_param_l = live_t('t', p_as_of_s)
+  return [ l_row_t[0] for l_row_t in p_conn_c.execute('SELECT t.id FROM ' + p_table_s + ' t WHERE t.name = ? AND ' + l_where_s, [p_name_s] + l_param_l) ]
+
+def state_ids_l(p_conn_c, p_state_s, p_as_of_s=None):
+  return [ l_state_d['id'] for l_workflow_d in records_l(p_conn_c, 'workflows', p_as_of_s)
+           for l_state_d in l_workflow_d.get('states', []) if p_state_s == l_state_d.get('name') ]
+
+# Offline counterpart to club_select.select_stories_t, same filters as
+# club_select.label_query_l. Returns (stories sorted by id with the
+# club_select fields, {label: story count}).
+def select_stories_t(p_conn_c, p_label_l, p_project_s=None, p_state_s=None, p_created_before_s=None, p_created_since_s=None,
+                     p_archived_b=None, p_as_of_s=None):
+  l_story_where_s, l_story_param_l = live_t('s', p_as_of_s)
+  l_filter_s = ''
+  l_filter_l = []
+  if p_project_s:
+    l_id_l = ids_named_l(p_conn_c, 'projects', p_project_s, p_as_of_s)
+    l_filter_s += ' AND s.project_id IN (' + ', '.join(['?'] * len(l_id_l)) + ')'
+    l_filter_l += l_id_l
+  if p_state_s:
+    l_id_l = state_ids_l(p_conn_c, p_state_s, p_as_of_s)
+    l_filter_s += ' AND s.workflow_state_id IN (' + ', '.join(['?'] * len(l_id_l)) + ')'
+    l_filter_l += l_id_l
+  if p_created_before_s:
+    l_filter_s += ' AND s.created_at < ?'
+    l_filter_l.append(p_created_before_s)
+  if p_created_since_s:
+    l_filter_s += ' AND s.created_at >= ?'
+    l_filter_l.append(p_created_since_s)
+  if p_archived_b is not None:
+    l_filter_s += ' AND s.archived = ?'
+    l_filter_l.append(1 if p_archived_b else 0)
+
+  l_found_d = {}
+  r_count_d = {}
+  for l_label_s in p_label_l:
+    l_label_id_l = ids_named_l(p_conn_c, 'labels', l_label_s, p_as_of_s)
+    l_cursor_c = p_conn_c.execute('SELECT DISTINCT s.id, s.name, s.created_at, s.archived FROM stories s JOIN story_labels l ON l.row = s.row'
+      + ' WHERE (l.name = ? OR l.label_id IN (' + ', '.join(['?'] * len(l_label_id_l)) + ')) AND ' + l_story_where_s + l_filter_s,
+      [l_label_s] + l_label_id_l + l_story_param_l + l_filter_l)
+    r_count_d[l_label_s] = 0
+    for l_id_n, l_name_s, l_created_s, l_archived_n in l_cursor_c:
+      r_count_d[l_label_s] += 1
+      l_found_d[l_id_n] = { 'id': l_id_n, 'name': l_name_s, 'created_at': l_created_s, 'archived': bool(l_archived_n) }
+  return ([ l_found_d[l_id_n] for l_id_n in sorted(l_found_d) ], r_count_d)
+
+def select_ids_t(p_conn_c, p_label_l, **p_filter_d):
+  l_story_l, r_count_d = select_stories_t(p_conn_c, p_label_l, **p_filter_d)
+  return ([ l_story_d['id'] for l_story_d in l_story_l ], r_count_d)
+
+def epic_stories_l(p_conn_c, p_epic_id_n, p_as_of_s=None):
+  l_where_s, l_param_l = live_t('s', p_as_of_s)
+  return [ { 'id': l_id_n, 'name': l_name_s, 'created_at': l_created_s, 'archived': bool(l_archived_n) }
+           for l_id_n, l_name_s, l_created_s, l_archived_n in p_conn_c.execute(
+             'SELECT s.id, s.name, s.created_at, s.archived FROM stories s WHERE s.epic_id = ? AND ' + l_where_s + ' ORDER BY s.id',
+             [p_epic_id_n] + l_param_l) ]
+
+def print_stories(p_story_l):
+  for l_story_d in p_story_l:
+    print('  %-10s %-20s %s%s' % (l_story_d['id'], l_story_d['created_at'], l_story_d['name'], ' (archived)' if l_story_d['archived'] else ''))
+  print(str(len(p_story_l)) + ' stories')
+
+def main():
+
+  l_argv_l = list(sys.argv)
+
+  l_db_s = club_client.pop_option_s(l_argv_l, '--db', g_db_s)
+  l_label_s = club_client.pop_option_s(l_argv_l, '--label')
+  l_epic_s = club_client.pop_option_s(l_argv_l, '--epic')
+  l_as_of_s = as_of_s(club_client.pop_option_s(l_argv_l, '--as-of'))
+
+  if l_label_s or l_epic_s:
+    l_usage_b = (1 != len(l_argv_l)) or (l_label_s and l_epic_s) or (l_epic_s and not l_epic_s.isdigit())
+  else:
+    l_usage_b = (2 != len(l_argv_l)) or ('--help' == l_argv_l[1]) or l_as_of_s is not None or not os.path.isdir(l_argv_l[1])
+
+  if l_usage_b:
+    print(g_usage_string_0_s + sys.argv[0] + g_usage_string_1_s + '\n       prompt$ ' + sys.argv[0] + g_usage_string_2_s)
+    sys.exit(1)
+
+  l_conn_c = connect_c(l_db_s)
+  if l_label_s:
+    print_stories(select_stories_t(l_conn_c, [l_label_s], p_as_of_s=l_as_of_s)[0])
+  elif l_epic_s:
+    print_stories(epic_stories_l(l_conn_c, int(l_epic_s), l_as_of_s))
+  else:
+    ingest_d(l_conn_c, l_argv_l[1])
+  l_conn_c.close()
+  sys.exit(0)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,277 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+Run metrics for the scripts.
+
+club_client.py records every request here (per endpoint latency histogram,
+status codes, retries and bytes each way) and the scripts add the time
+spent in their phases: fetch (inside club_client), transform, serialize and
+write. Endpoints are the API path with ids replaced by {id}, so
+stories/123 and stories/456 count together.
+
+A script run through run_main accepts:
+
+--metrics FILE   JSON run report
+--prom FILE      Prometheus textfile (for the node exporter textfile
+                 collector), written atomically
+--profile FILE   CPU profile of the run (every thread), for pstats or
+                 snakeviz
+
+The options are taken out of sys.argv before the script's main sees them.
+Phase times are summed across threads, so with several jobs in flight they
+can add up to more than the wall time.
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+import club_client
+import club_store
+
+# Upper bounds in seconds, as in the Prometheus client defaults
+g_bucket_l = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+g_phase_l  = ['fetch', 'transform', 'serialize', 'write']
+g_id_re_c  = re.compile(r'^(\d+|[0-9a-fA-F]{8}-[0-9a-fA-F-]{27})$')
+g_prefix_s = 'clubhouse_'
+
+g_lock_c       = threading.Lock()
+g_endpoint_d   = {}   # (method, endpoint) => request stats
+g_retry_d      = {}   # (endpoint, reason) => count
+g_phase_d      = { l_phase_s: [0.0, 0] for l_phase_s in g_phase_l }  # phase => [seconds, calls]
+g_start_n      = time.time()
+g_script_s     = os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'python'
+
+g_profile_l    = []   # One cProfile.Profile per thread
+g_profile_lock_c = threading.Lock()
+
+def endpoint_s(p_url_s):
+  l_path_s = urllib.parse.urlsplit(p_url_s).path
+  if club_client.g_api_s in l_path_s:
+    l_path_s = l_path_s[l_path_s.index(club_client.g_api_s) + len(club_client.g_api_s):]
+  return '/'.join( '{id}' if g_id_re_c.match(l_part_s) else l_part_s for l_part_s in l_path_s.strip('/').split('/') )
+
+def new_endpoint_d():
+  return { 'count': 0, 'status': {}, 'seconds': 0.0, 'max_seconds': 0.0, 'buckets': [0] * len(g_bucket_l),
+           'bytes_sent': 0, 'bytes_received': 0 }
+
+# One request (each retry is a request of its own). p_status_n is None when
+# there was no response.
+def record_request(p_method_s, p_url_s, p_status_n, p_seconds_n, p_sent_n, p_received_n):
+  l_key_t = (p_method_s, endpoint_s(p_url_s))
+  l_status_s = 'error' if p_status_n is None else str(p_status_n)
+  with g_lock_c:
+    l_d = g_endpoint_d.get(l_key_t)
+    if l_d is None:
+      l_d = g_endpoint_d[l_key_t] = new_endpoint_d()
+    l_d['count'] += 1
+    l_d['status'][l_status_s] = l_d['status'].get(l_status_s, 0) + 1
+    l_d['seconds'] += p_seconds_n
+    l_d['max_seconds'] = max(l_d['max_seconds'], p_seconds_n)
+    for i, l_bound_n in enumerate(g_bucket_l):
+      if p_seconds_n <= l_bound_n:
+        l_d['buckets'][i] += 1
+        break
+    l_d['bytes_sent'] += p_sent_n
+    l_d['bytes_received'] += p_received_n
+
+# p_reason_s is '429', '5xx' or 'connection'
+def record_retry(p_url_s, p_reason_s):
+  l_key_t = (endpoint_s(p_url_s), p_reason_s)
+  with g_lock_c:
+    g_retry_d[l_key_t] = g_retry_d.get(l_key_t, 0) + 1
+
+def add_phase(p_phase_s, p_seconds_n):
+  with g_lock_c:
+    l_phase_l = g_phase_d.setdefault(p_phase_s, [0.0, 0])
+    l_phase_l[0] += p_seconds_n
+    l_phase_l[1] += 1
+
+@contextlib.contextmanager
+def phase(p_phase_s):
+  l_start_n = time.perf_counter()
+  try:
+    yield
+  finally:
+    add_phase(p_phase_s, time.perf_counter() - l_start_n)
+
+# Everything recorded so far. p_exit_n is the script's exit code, None while
+# it is still running.
+def report_d(p_exit_n=None):
+  with g_lock_c:
+    l_endpoint_l = []
+    for (l_method_s, l_endpoint_s), l_d in sorted(g_endpoint_d.items(), key=lambda p_t: (p_t[0][1], p_t[0][0])):
+      l_endpoint_d = dict(l_d, method=l_method_s, endpoint=l_endpoint_s, status=dict(l_d['status']),
+                          buckets={ str(l_bound_n): l_count_n for l_bound_n, l_count_n in zip(g_bucket_l, l_d['buckets']) })
+      l_endpoint_d['buckets']['+Inf'] = l_d['count'] - sum(l_d['buckets'])
+      l_endpoint_l.append(l_endpoint_d)
+    l_retry_l = [ { 'endpoint': l_endpoint_s, 'reason': l_reason_s, 'count': l_count_n }
+                  for (l_endpoint_s, l_reason_s), l_count_n in sorted(g_retry_d.items()) ]
+    l_phase_d = { l_phase_s: { 'seconds': l_phase_l[0], 'calls': l_phase_l[1] } for l_phase_s, l_phase_l in g_phase_d.items() }
+
+  return {
+    'script'     : g_script_s,
+    'started_at' : g_start_n,
+    'seconds'    : time.time() - g_start_n,
+    'exit_code'  : p_exit_n,
+    'totals'     : {
+      'requests'       : sum( l_d['count'] for l_d in l_endpoint_l ),
+      'retries'        : sum( l_d['count'] for l_d in l_retry_l ),
+      'throttled'      : sum( l_d['status'].get('429', 0) for l_d in l_endpoint_l ),
+      'bytes_sent'     : sum( l_d['bytes_sent'] for l_d in l_endpoint_l ),
+      'bytes_received' : sum( l_d['bytes_received'] for l_d in l_endpoint_l ),
+    },
+    'phases'     : l_phase_d,
+    'endpoints'  : l_endpoint_l,
+    'retries'    : l_retry_l,
+  }
+
+def label_s(p_label_d):
+  return '{' + ','.join( l_key_s + '="' + str(l_value_c).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                         for l_key_s, l_value_c in p_label_d.items() ) + '}'
+
+# Prometheus text exposition format. Every series carries the script name
+# so several scripts can share a textfile directory.
+def prometheus_s(p_report_d):
+  l_script_d = { 'script': p_report_d['script'] }
+  r_line_l = []
+
+  def metric(p_name_s, p_type_s, p_help_s, p_sample_l):
+    r_line_l.append('# HELP ' + g_prefix_s + p_name_s + ' ' + p_help_s)
+    r_line_l.append('# TYPE ' + g_prefix_s + p_name_s + ' ' + p_type_s)
+    for l_suffix_s, l_label_d, l_value_c in p_sample_l:
+      r_line_l.append(g_prefix_s + p_name_s + l_suffix_s + label_s(dict(l_script_d, **l_label_d)) + ' ' + repr(float(l_value_c)))
+
+  l_sample_l = []
+  for l_d in p_report_d['endpoints']:
+    l_label_d = { 'method': l_d['method'], 'endpoint': l_d['endpoint'] }
+    l_count_n = 0
+    for l_bound_s, l_bucket_n in l_d['buckets'].items():
+      l_count_n += l_bucket_n
+      l_sample_l.append(('_bucket', dict(l_label_d, le=l_bound_s), l_count_n))
+    l_sample_l.append(('_sum', l_label_d, l_d['seconds']))
+    l_sample_l.append(('_count', l_label_d, l_d['count']))
+  metric('request_duration_seconds', 'histogram', 'API request latency.', l_sample_l)
+
+  metric('requests_total', 'counter', 'API requests by response status.',
+    [ ('', { 'method': l_d['method'], 'endpoint': l_d['endpoint'], 'status': l_status_s }, l_count_n)
+      for l_d in p_report_d['endpoints'] for l_status_s, l_count_n in sorted(l_d['status'].items()) ])
+  metric('request_bytes_total', 'counter', 'Request body bytes sent.',
+    [ ('', { 'method': l_d['method'], 'endpoint': l_d['endpoint'] }, l_d['bytes_sent']) for l_d in p_report_d['endpoints'] ])
+  metric('response_bytes_total', 'counter', 'Response body bytes received.',
+    [ ('', { 'method': l_d['method'], 'endpoint': l_d['endpoint'] }, l_d['bytes_received']) for l_d in p_report_d['endpoints'] ])
+  metric('retries_total', 'counter', 'Requests repeated after a 429, 5xx or connection error.',
+    [ ('', { 'endpoint': l_d['endpoint'], 'reason': l_d['reason'] }, l_d['count']) for l_d in p_report_d['retries'] ])
+  metric('phase_seconds_total', 'counter', 'Time spent in each phase, summed across threads.',
+    [ ('', { 'phase': l_phase_s }, l_d['seconds']) for l_phase_s, l_d in p_report_d['phases'].items() ])
+  metric('run_duration_seconds', 'gauge', 'Wall time of the last run.', [ ('', {}, p_report_d['seconds']) ])
+  metric('run_start_time_seconds', 'gauge', 'Start of the last run, seconds since the epoch.', [ ('', {}, p_report_d['started_at']) ])
+  if p_report_d['exit_code'] is not None:
+    metric('run_exit_code', 'gauge', 'Exit code of the last run.', [ ('', {}, p_report_d['exit_code']) ])
+  return '\n'.join(r_line_l) + '\n'
+
+def write_reports(p_metrics_s, p_prom_s, p_exit_n=None):
+  l_report_d = report_d(p_exit_n)
+  try:
+    if p_metrics_s:
+      club_store.write_text_atomic(p_metrics_s, json.dumps(l_report_d, indent=2) + '\n')
+    if p_prom_s:
+      # The node exporter may read the file at any moment
+      club_store.write_text_atomic(p_prom_s, prometheus_s(l_report_d))
+  except OSError as l_e_c:
+    print('Could not write the run report: ' + str(l_e_c))
+
+# threading.setprofile hook: the first event in a new thread swaps in a
+# profiler of its own. From Python 3.12 one profiler sees every thread and
+# a second one can't be enabled, which is fine.
+def thread_profile(p_frame_c, p_event_s, p_arg_c):
+  l_profile_c = cProfile.Profile()
+  try:
+    l_profile_c.enable()
+  except ValueError:
+    sys.setprofile(None)
+    return
+  with g_profile_lock_c:
+    g_profile_l.append(l_profile_c)
+
+def start_profile():
+  l_profile_c = cProfile.Profile()
+  g_profile_l.append(l_profile_c)
+  threading.setprofile(thread_profile)
+  l_profile_c.enable()
+
+# Merges the per thread profiles into one file
+def write_profile(p_profile_s):
+  threading.setprofile(None)
+  g_profile_l[0].disable()
+  with g_profile_lock_c:
+    l_profile_l = list(g_profile_l)
+  l_stats_c = pstats.Stats(l_profile_l[0])
+  for l_profile_c in l_profile_l[1:]:
+    l_stats_c.add(l_profile_c)
+  try:
+    l_stats_c.dump_stats(p_profile_s)
+  except OSError as l_e_c:
+    print('Could not write the profile: ' + str(l_e_c))
+
+g_metrics_s = None
+g_prom_s    = None
+
+# Writes the reports so far without stopping, for long running scripts
+# (the create_by_label.py daemon) to call after each run.
+def flush():
+  if g_metrics_s or g_prom_s:
+    write_reports(g_metrics_s, g_prom_s)
+
+# Runs a script's main with the report options taken out of sys.argv and
+# writes the reports on the way out, whichever way that is.
+def run_main(p_main_c):
+  global g_metrics_s, g_prom_s
+  g_metrics_s = club_client.pop_option_s(sys.argv, '--metrics')
+  g_prom_s    = club_client.pop_option_s(sys.argv, '--prom')
+  l_profile_s = club_client.pop_option_s(sys.argv, '--profile')
+
+  if l_profile_s:
+    start_profile()
+  l_exit_n = 0
+  try:
+    p_main_c()
+  except SystemExit as l_e_c:
+    l_exit_n = l_e_c.code if isinstance(l_e_c.code, int) else (0 if l_e_c.code is None else 1)
+    raise
+  except BaseException:
+    l_exit_n = 1
+    raise
+  finally:
+    if l_profile_s:
+      write_profile(l_profile_s)
+    if g_metrics_s or g_prom_s:
+      write_reports(g_metrics_s, g_prom_s, l_exit_n)
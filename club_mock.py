@@ -0,0 +1,480 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+Local stand-in for the parts of the Clubhouse v3 API the scripts use, with
+a synthetic workspace of any size. Handy for trying the scripts (and timing
+them, see bench_suite.py) without a real workspace or token. Point a script
+at it with CLUBHOUSE_URL_ROOT=http://127.0.0.1:<port>, any token works.
+
+Served:
+- GET of every collection club_back.py saves (labels, projects, ...),
+  epic-workflow, stories/{id} and labels/{id}/stories
+- GET search/stories and search/epics with label:, project:, state:,
+  created:, updated: and is:archived terms, page_size, "detail": "slim",
+  next cursors and the 1000 result cap
+- POST, PUT and DELETE stories/bulk, POST stories, and POST of projects,
+  labels and epics (for club_restore.py)
+- entity-templates answers If-None-Match with 304
+- GET /__stats returns the request counts (not part of the real API)
+
+It can also add latency to every request, answer with 429s (with
+Retry-After) past a per minute limit, and fail a fraction of requests
+with 503.
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+import bisect
+from collections import deque
+from datetime import datetime, timedelta, timezone
+import http.server
+import json
+import math
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+import club_client
+
+g_usage_string_0_s = """
+Runs a local mock of the Clubhouse API with a synthetic workspace.
+
+Options:
+--port N          Port to listen on (default 8765, 0 picks a free one)
+--stories N       Stories in the workspace (default 1000)
+--latency MS      Added to every request (default 0)
+--rate-limit N    Requests per minute before answering 429 (default none)
+--error-rate F    Fraction of requests failed with 503 (default 0)
+--seed N          Random seed for the workspace (default 1)
+
+Usage: prompt$ """
+
+g_usage_string_1_s = ''' [--port N] [--stories N] [--latency MS] [--rate-limit N] [--error-rate F] [--seed N]'''
+
+g_search_cap_n     = 1000
+g_max_page_size_n  = 25
+g_api_s            = club_client.g_api_s
+g_start_c          = datetime(2016, 1, 1, tzinfo=timezone.utc)
+
+g_slim_drop_l      = ['description', 'tasks', 'comments', 'branches', 'commits', 'pull_requests', 'files', 'linked_files']
+g_term_re_c        = re.compile(r'(!?)([a-z_]+):("[^"]*"|\S+)')
+
+def iso_s(p_time_c):
+  return p_time_c.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+# The synthetic workspace. Everything is in memory; the search results for
+# a query are kept until the next change so paging through them doesn't
+# redo the search for every page.
+class Workspace_c:
+
+  def __init__(self, p_story_n=1000, p_seed_n=1):
+    l_random_c = random.Random(p_seed_n)
+    self.lock_c    = threading.Lock()
+    self.next_id_n = 1
+    self.search_d  = {}
+    self.created_l = None
+    self.etag_n    = 1
+
+    self.member_l = [ { 'id': 'member-' + str(i), 'profile': { 'name': 'Member ' + str(i), 'mention_name': 'member' + str(i) } } for i in range(8) ]
+    self.team_l   = [ { 'id': i + 1, 'name': 'Team ' + str(i) } for i in range(2) ]
+    l_state_l = [ { 'id': 500 + i, 'name': l_name_s, 'type': l_type_s } for i, (l_name_s, l_type_s) in
+                  enumerate([('Unstarted', 'unstarted'), ('Started', 'started'), ('Done', 'done')]) ]
+    self.workflow_l = [ { 'id': 499, 'name': 'Engineering', 'states': l_state_l } ]
+
+    self.project_l = [ self.add_d({ 'name': 'Project ' + str(i) }) for i in range(10) ]
+    self.label_l   = [ self.add_d({ 'name': 'Label ' + str(i) }) for i in range(20) ]
+    # Labels the benchmarks use: on every story, on every other story, on the templates
+    self.label_l  += [ self.add_d({ 'name': l_name_s }) for l_name_s in ['bench_all', 'bench_half', 'bench_template'] ]
+    l_label_d = { l_label_d['name']: l_label_d for l_label_d in self.label_l }
+
+    l_epic_n = max(1, p_story_n // 50)
+    self.epic_l = []
+    for i in range(l_epic_n):
+      l_created_c = g_start_c + timedelta(days=l_random_c.randrange(3000))
+      self.epic_l.append(self.add_d({ 'name': 'Epic ' + str(i), 'description': 'Epic number ' + str(i), 'state': 'to do',
+        'archived': i % 10 == 0, 'created_at': iso_s(l_created_c), 'updated_at': iso_s(l_created_c + timedelta(days=3)),
+        'owner_ids': [], 'follower_ids': [], 'labels': [] }))
+
+    self.story_d = {}
+    for i in range(p_story_n):
+      l_created_c = g_start_c + timedelta(days=l_random_c.randrange(3000), seconds=l_random_c.randrange(86400))
+      l_labels_l = [ l_label_d['bench_all'] ] + ([ l_label_d['bench_half'] ] if i % 2 else [])
+      l_labels_l.append(self.label_l[l_random_c.randrange(20)])
+      l_story_d = self.add_d({
+        'name'              : 'Story ' + str(i),
+        'description'       : 'Description of story ' + str(i) + '. ' * l_random_c.randrange(1, 40),
+        'story_type'        : l_random_c.choice(['feature', 'bug', 'chore']),
+        'archived'          : l_random_c.random() < 0.2,
+        'created_at'        : iso_s(l_created_c),
+        'updated_at'        : iso_s(l_created_c + timedelta(days=l_random_c.randrange(60))),
+        'project_id'        : l_random_c.choice(self.project_l)['id'],
+        'epic_id'           : l_random_c.choice(self.epic_l)['id'] if l_random_c.random() < 0.5 else None,
+        'workflow_state_id' : l_random_c.choice(l_state_l)['id'],
+        'owner_ids'         : [ l_random_c.choice(self.member_l)['id'] ],
+        'follower_ids'      : [],
+        'labels'            : [ { 'id': l_d['id'], 'name': l_d['name'] } for l_d in l_labels_l ],
+        'label_ids'         : [ l_d['id'] for l_d in l_labels_l ],
+        'tasks'             : [ { 'description': 'Task ' + str(j), 'complete': False } for j in range(l_random_c.randrange(3)) ],
+        'comments'          : [ { 'text': 'Comment ' + str(j) } for j in range(l_random_c.randrange(3)) ],
+      })
+      self.story_d[l_story_d['id']] = l_story_d
+
+    self.template_l = []
+    for i in range(max(1, p_story_n // 100)):
+      self.template_l.append({ 'id': 'template-' + str(i), 'name': 'Template ' + str(i), 'updated_at': iso_s(g_start_c),
+        'story_contents': { 'name': 'Recurring ' + str(i), 'project_id': self.project_l[0]['id'],
+                            'labels': [ { 'name': 'bench_template' } ], 'tasks': [ { 'description': 'Do it', 'complete': False } ] } })
+
+    self.collection_d = {
+      'categories'       : [ { 'id': 1, 'name': 'Category' } ],
+      'entity-templates' : self.template_l,
+      'epic-workflow'    : { 'id': 1, 'default_epic_state_id': 1, 'epic_states': [ { 'id': 1, 'name': 'to do' } ] },
+      'files'            : [],
+      'groups'           : [],
+      'iterations'       : [ { 'id': 1, 'name': 'Iteration 1' } ],
+      'labels'           : self.label_l,
+      'linked-files'     : [],
+      'members'          : self.member_l,
+      'milestones'       : [ { 'id': 1, 'name': 'Milestone 1' } ],
+      'projects'         : self.project_l,
+      'repositories'     : [],
+      'teams'            : self.team_l,
+      'workflows'        : self.workflow_l,
+      'epics'            : self.epic_l,
+    }
+
+  def add_d(self, p_d):
+    p_d['id'] = self.next_id_n
+    self.next_id_n += 1
+    return p_d
+
+  # Called with the lock held by anything that changes the workspace
+  def changed(self):
+    self.search_d = {}
+    self.created_l = None
+
+  # One search term => test of a record, or None for terms that are ignored
+  def term_test_c(self, p_key_s, p_value_s):
+    if 'is' == p_key_s and 'archived' == p_value_s:
+      return lambda p_d: bool(p_d.get('archived'))
+    if 'label' == p_key_s:
+      return lambda p_d: p_value_s in [ l_d['name'] for l_d in p_d.get('labels', []) ]
+    if 'project' == p_key_s:
+      l_id_s = set( l_d['id'] for l_d in self.project_l if p_value_s in (l_d['name'], str(l_d['id'])) )
+      return lambda p_d: p_d.get('project_id') in l_id_s
+    if 'state' == p_key_s:
+      l_id_s = set( l_s['id'] for l_w in self.workflow_l for l_s in l_w['states'] if l_s['name'] == p_value_s )
+      return lambda p_d: p_d.get('workflow_state_id') in l_id_s
+    if p_key_s in ['created', 'updated']:
+      l_from_s, l_to_s = self.day_range_t(p_value_s)
+      return lambda p_d: l_from_s <= (p_d.get(p_key_s + '_at') or '')[:10] <= l_to_s
+    return None
+
+  # 'YYYY-MM-DD..YYYY-MM-DD' with either end '*' => inclusive (from, to)
+  def day_range_t(self, p_value_s):
+    l_from_s, l_dots_s, l_to_s = p_value_s.partition('..')
+    return ('' if '*' == l_from_s else l_from_s, '9999' if '*' == l_to_s or not l_to_s else l_to_s)
+
+  # The stories in a created date range, from a sorted index so the
+  # sharded searches don't each scan the whole workspace
+  def created_in_l(self, p_value_s):
+    if self.created_l is None:
+      self.created_l = sorted( (l_d['created_at'][:10], l_id_n) for l_id_n, l_d in self.story_d.items() )
+      self.created_day_l = [ l_t[0] for l_t in self.created_l ]
+    l_from_s, l_to_s = self.day_range_t(p_value_s)
+    l_start_n = bisect.bisect_left(self.created_day_l, l_from_s)
+    l_end_n = bisect.bisect_right(self.created_day_l, l_to_s)
+    return [ self.story_d[l_id_n] for l_id_n in sorted( l_t[1] for l_t in self.created_l[l_start_n:l_end_n] ) ]
+
+  # All the records matching p_query_s, sorted by id
+  def search_l(self, p_type_s, p_query_s):
+    l_key_t = (p_type_s, p_query_s)
+    with self.lock_c:
+      if l_key_t not in self.search_d:
+        l_source_l = self.story_d.values() if 'stories' == p_type_s else self.epic_l
+        l_test_l = []
+        for l_not_s, l_key_s, l_value_s in g_term_re_c.findall(p_query_s):
+          l_value_s = l_value_s.strip('"')
+          if 'stories' == p_type_s and 'created' == l_key_s and not l_not_s:
+            l_source_l = self.created_in_l(l_value_s)
+          l_test_c = self.term_test_c(l_key_s, l_value_s)
+          if l_test_c is not None:
+            l_test_l.append((bool(l_not_s), l_test_c))
+        self.search_d[l_key_t] = [ l_d for l_d in l_source_l if all( l_test_c(l_d) != l_not_b for l_not_b, l_test_c in l_test_l ) ]
+      return self.search_d[l_key_t]
+
+  def create_story_d(self, p_story_d):
+    with self.lock_c:
+      r_story_d = self.add_d(dict(p_story_d))
+      r_story_d.setdefault('archived', False)
+      r_story_d.setdefault('created_at', iso_s(datetime.now(timezone.utc)))
+      r_story_d.setdefault('updated_at', r_story_d['created_at'])
+      r_story_d['labels'] = [ self.label_for_d(l_d['name']) for l_d in r_story_d.get('labels', []) ]
+      r_story_d['label_ids'] = [ l_d['id'] for l_d in r_story_d['labels'] ]
+      self.story_d[r_story_d['id']] = r_story_d
+      self.changed()
+      return r_story_d
+
+  # With the lock held. Labels named on a new story are created if missing.
+  def label_for_d(self, p_name_s):
+    for l_label_d in self.label_l:
+      if l_label_d['name'] == p_name_s:
+        return { 'id': l_label_d['id'], 'name': p_name_s }
+    l_label_d = self.add_d({ 'name': p_name_s })
+    self.label_l.append(l_label_d)
+    return { 'id': l_label_d['id'], 'name': p_name_s }
+
+class Handler_c(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+
+  workspace_c   = None
+  latency_n     = 0.0
+  rate_limit_n  = 0
+  error_rate_n  = 0.0
+  stats_d       = None
+  stats_lock_c  = None
+  window_c      = None  # Start times of the requests in the last minute
+
+  def log_message(self, *p_args_l):
+    pass
+
+  def reply(self, p_code_n, p_body_c=None, p_headers_d=None):
+    l_body_b = b'' if p_body_c is None else json.dumps(p_body_c).encode('utf-8')
+    self.send_response(p_code_n)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(l_body_b)))
+    for l_key_s, l_value_s in (p_headers_d or {}).items():
+      self.send_header(l_key_s, l_value_s)
+    self.end_headers()
+    self.wfile.write(l_body_b)
+
+  def read_json_c(self):
+    l_length_n = int(self.headers.get('Content-Length') or 0)
+    l_body_b = self.rfile.read(l_length_n) if l_length_n else b''
+    return json.loads(l_body_b) if l_body_b else {}
+
+  # Counting, latency, 429s and 503s. Returns True when the request was
+  # answered here.
+  def simulate_b(self):
+    l_now_n = time.monotonic()
+    with self.stats_lock_c:
+      self.stats_d['requests'] += 1
+      if self.rate_limit_n:
+        while self.window_c and l_now_n - self.window_c[0] > 60.0:
+          self.window_c.popleft()
+        if len(self.window_c) >= self.rate_limit_n:
+          self.stats_d['throttled'] += 1
+          l_retry_n = max(1, math.ceil(60.0 - (l_now_n - self.window_c[0])))
+          self.reply(429, { 'message': 'Too Many Requests' }, { 'Retry-After': str(l_retry_n) })
+          return True
+        self.window_c.append(l_now_n)
+    if self.latency_n:
+      time.sleep(self.latency_n)
+    if self.error_rate_n and random.random() < self.error_rate_n:
+      with self.stats_lock_c:
+        self.stats_d['errors'] += 1
+      self.reply(503, { 'message': 'Service Unavailable' })
+      return True
+    return False
+
+  def path_t(self):
+    l_url_c = urllib.parse.urlparse(self.path)
+    l_path_s = l_url_c.path[len(g_api_s):] if l_url_c.path.startswith(g_api_s) else l_url_c.path
+    return (l_path_s.strip('/'), dict(urllib.parse.parse_qsl(l_url_c.query)))
+
+  def do_GET(self):
+    l_path_s, l_query_d = self.path_t()
+    if '/__stats' == self.path:
+      with self.stats_lock_c:
+        return self.reply(200, dict(self.stats_d))
+    if self.simulate_b():
+      return
+    l_workspace_c = self.workspace_c
+
+    if l_path_s.startswith('search/'):
+      return self.search(l_path_s[len('search/'):], l_query_d)
+
+    if 'entity-templates' == l_path_s:
+      l_etag_s = '"templates-' + str(l_workspace_c.etag_n) + '"'
+      if self.headers.get('If-None-Match') == l_etag_s:
+        return self.reply(304, None, { 'ETag': l_etag_s })
+      return self.reply(200, l_workspace_c.template_l, { 'ETag': l_etag_s })
+
+    if l_path_s in l_workspace_c.collection_d:
+      with l_workspace_c.lock_c:
+        return self.reply(200, l_workspace_c.collection_d[l_path_s])
+
+    l_part_l = l_path_s.split('/')
+    if 2 == len(l_part_l) and 'stories' == l_part_l[0] and l_part_l[1].isdigit():
+      with l_workspace_c.lock_c:
+        l_story_d = l_workspace_c.story_d.get(int(l_part_l[1]))
+      if l_story_d is None:
+        return self.reply(404, { 'message': 'Not Found' })
+      return self.reply(200, l_story_d)
+
+    if 3 == len(l_part_l) and 'labels' == l_part_l[0] and 'stories' == l_part_l[2] and l_part_l[1].isdigit():
+      l_label_id_n = int(l_part_l[1])
+      with l_workspace_c.lock_c:
+        l_story_l = [ l_d for l_d in l_workspace_c.story_d.values() if l_label_id_n in [ l_label_d['id'] for l_label_d in l_d['labels'] ] ]
+      return self.reply(200, l_story_l)
+
+    return self.reply(404, { 'message': 'Not Found' })
+
+  def search(self, p_type_s, p_query_d):
+    if p_type_s not in ['stories', 'epics']:
+      return self.reply(404, { 'message': 'Not Found' })
+    l_query_s = p_query_d.get('query', '')
+    l_page_size_n = min(g_max_page_size_n, int(p_query_d.get('page_size', g_max_page_size_n)))
+    l_offset_n = int(p_query_d.get('next', 0))
+
+    l_match_l = self.workspace_c.search_l(p_type_s, l_query_s)
+    l_end_n = min(l_offset_n + l_page_size_n, len(l_match_l), g_search_cap_n)
+    l_page_l = l_match_l[l_offset_n:l_end_n]
+    if 'slim' == p_query_d.get('detail'):
+      l_page_l = [ { l_key_s: l_value_c for l_key_s, l_value_c in l_d.items() if l_key_s not in g_slim_drop_l } for l_d in l_page_l ]
+
+    l_next_s = None
+    if l_end_n < min(len(l_match_l), g_search_cap_n):
+      l_next_d = dict(p_query_d)
+      l_next_d['next'] = str(l_end_n)
+      l_next_s = g_api_s + 'search/' + p_type_s + '?' + urllib.parse.urlencode(l_next_d)
+    return self.reply(200, { 'data': l_page_l, 'next': l_next_s, 'total': len(l_match_l) })
+
+  def do_POST(self):
+    l_path_s, l_query_d = self.path_t()
+    l_body_d = self.read_json_c()
+    if self.simulate_b():
+      return
+    l_workspace_c = self.workspace_c
+
+    if 'stories/bulk' == l_path_s:
+      return self.reply(201, [ l_workspace_c.create_story_d(l_d) for l_d in l_body_d.get('stories', []) ])
+    if 'stories/search' == l_path_s: # Only exact matches on top level fields
+      with l_workspace_c.lock_c:
+        r_l = [ l_d for l_d in l_workspace_c.story_d.values() if all( l_d.get(l_key_s) == l_value_c for l_key_s, l_value_c in l_body_d.items() ) ]
+      return self.reply(200, r_l)
+    if 'stories' == l_path_s:
+      return self.reply(201, l_workspace_c.create_story_d(l_body_d))
+    if l_path_s in ['projects', 'labels', 'epics']:
+      with l_workspace_c.lock_c:
+        r_d = l_workspace_c.add_d(dict(l_body_d))
+        l_workspace_c.collection_d[l_path_s].append(r_d)
+        l_workspace_c.changed()
+      return self.reply(201, r_d)
+    return self.reply(404, { 'message': 'Not Found' })
+
+  def do_PUT(self):
+    l_path_s, l_query_d = self.path_t()
+    l_body_d = self.read_json_c()
+    if self.simulate_b():
+      return
+    l_workspace_c = self.workspace_c
+
+    if 'stories/bulk' == l_path_s:
+      l_update_d = { l_key_s: l_value_c for l_key_s, l_value_c in l_body_d.items() if 'story_ids' != l_key_s }
+      if 'archived' in l_update_d: # delete_by_label.py sends the string 'true'
+        l_update_d['archived'] = l_update_d['archived'] in [True, 'true']
+      with l_workspace_c.lock_c:
+        r_l = []
+        for l_id_n in l_body_d.get('story_ids', []):
+          if l_id_n in l_workspace_c.story_d:
+            l_workspace_c.story_d[l_id_n].update(l_update_d)
+            r_l.append(l_workspace_c.story_d[l_id_n])
+        l_workspace_c.changed()
+      return self.reply(200, r_l)
+    return self.reply(404, { 'message': 'Not Found' })
+
+  def do_DELETE(self):
+    l_path_s, l_query_d = self.path_t()
+    l_body_d = self.read_json_c()
+    if self.simulate_b():
+      return
+    l_workspace_c = self.workspace_c
+
+    if 'stories/bulk' == l_path_s:
+      with l_workspace_c.lock_c:
+        for l_id_n in l_body_d.get('story_ids', []):
+          l_story_d = l_workspace_c.story_d.get(l_id_n)
+          if l_story_d is not None and not l_story_d.get('archived'):
+            return self.reply(422, { 'message': 'Stories must be archived before they are deleted' })
+        for l_id_n in l_body_d.get('story_ids', []):
+          l_workspace_c.story_d.pop(l_id_n, None)
+        l_workspace_c.changed()
+      return self.reply(204)
+    return self.reply(404, { 'message': 'Not Found' })
+
+# The default listen backlog of 5 drops connections when the async backend
+# opens a hundred at once, this is above anything the benchmarks use
+class Server_c(http.server.ThreadingHTTPServer):
+  request_queue_size = 128
+  daemon_threads     = True
+
+# Builds the workspace and the server. Call serve_forever on the result (or
+# start_thread_c for a background thread).
+def make_server_c(p_port_n=0, p_story_n=1000, p_latency_ms_n=0, p_rate_limit_n=0, p_error_rate_n=0.0, p_seed_n=1):
+  l_handler_c = type('MockHandler_c', (Handler_c,), {
+    'workspace_c'  : Workspace_c(p_story_n, p_seed_n),
+    'latency_n'    : p_latency_ms_n / 1000.0,
+    'rate_limit_n' : p_rate_limit_n,
+    'error_rate_n' : p_error_rate_n,
+    'stats_d'      : { 'requests': 0, 'throttled': 0, 'errors': 0 },
+    'stats_lock_c' : threading.Lock(),
+    'window_c'     : deque(),
+  })
+  return Server_c(('127.0.0.1', p_port_n), l_handler_c)
+
+def start_thread_c(p_server_c):
+  l_thread_c = threading.Thread(target=p_server_c.serve_forever, daemon=True)
+  l_thread_c.start()
+  return l_thread_c
+
+def main():
+
+  l_argv_l = list(sys.argv)
+  try:
+    l_port_n       = int(club_client.pop_option_s(l_argv_l, '--port', '8765'))
+    l_story_n      = int(club_client.pop_option_s(l_argv_l, '--stories', '1000'))
+    l_latency_n    = float(club_client.pop_option_s(l_argv_l, '--latency', '0'))
+    l_rate_limit_n = int(club_client.pop_option_s(l_argv_l, '--rate-limit', '0'))
+    l_error_rate_n = float(club_client.pop_option_s(l_argv_l, '--error-rate', '0'))
+    l_seed_n       = int(club_client.pop_option_s(l_argv_l, '--seed', '1'))
+  except ValueError:
+    l_argv_l.append('--help')
+
+  if 1 != len(l_argv_l):
+    # Message reflects the current name of the script
+    print(g_usage_string_0_s + sys.argv[0] + g_usage_string_1_s)
+    sys.exit(1)
+
+  l_server_c = make_server_c(l_port_n, l_story_n, l_latency_n, l_rate_limit_n, l_error_rate_n, l_seed_n)
+  print('Mock Clubhouse API with ' + str(l_story_n) + ' stories on http://127.0.0.1:' + str(l_server_c.server_address[1]), flush=True)
+  try:
+    l_server_c.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+Worker pool with adaptive concurrency for running lots of small API calls.
+
+The number of requests in flight starts low and grows by one while calls
+succeed at a steady latency (additive increase). A failure, or latency
+blowing out to several times the best seen, halves it (multiplicative
+decrease). Failed items are retried a few times before being reported.
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import time
+
+g_retry_n         = 3    # Attempts per item after the first
+g_latency_ratio_n = 4.0  # Slow down when latency passes this times the best
+
+class AdaptiveLimit_c:
+
+  def __init__(self, p_start_n, p_max_n):
+    self.max_n    = p_max_n
+    self.limit_n  = float(min(p_start_n, p_max_n))
+    self.best_n   = None
+
+  def current_n(self):
+    return max(1, int(self.limit_n))
+
+  def success(self, p_latency_n):
+    if self.best_n is None or p_latency_n < self.best_n:
+      self.best_n = p_latency_n
+    if p_latency_n > self.best_n * g_latency_ratio_n:
+      self.decrease()
+    else:
+      self.limit_n = min(self.max_n, self.limit_n + 1.0 / self.current_n())
+
+  def decrease(self):
+    self.limit_n = max(1.0, self.limit_n / 2.0)
+
+def timed_call_t(p_work_c, p_item_c):
+  l_start_n = time.perf_counter()
+  try:
+    return (p_work_c(p_item_c), None, time.perf_counter() - l_start_n)
+  except Exception as l_e_c:
+    return (None, l_e_c, time.perf_counter() - l_start_n)
+
+# Calls p_work_c(item) for every item in p_item_l (any iterable, read
+# lazily) with at most p_max_jobs_n in flight. Yields (item, result,
+# exception) in completion order, exception is None on success. Runs in the
+# caller's thread so whatever consumes the results (writing files) doesn't
+# need locking. A failed item is retried only if p_retry_c(exception) is true
+# (always when p_retry_c is None).
+def run_adaptive(p_item_l, p_work_c, p_max_jobs_n, p_start_jobs_n=2, p_retry_c=None):
+  l_limit_c = AdaptiveLimit_c(p_start_jobs_n, p_max_jobs_n)
+  l_item_iter = iter(p_item_l)   # Only pulled as fast as the work goes
+  l_retry_l = []
+  l_more_b = True
+  l_pending_d = {}
+
+  with ThreadPoolExecutor(max_workers=p_max_jobs_n) as l_pool_c:
+    while l_more_b or l_retry_l or l_pending_d:
+      while len(l_pending_d) < l_limit_c.current_n():
+        if l_retry_l:
+          l_item_c, l_tries_n = l_retry_l.pop(0)
+        else:
+          try:
+            l_item_c, l_tries_n = next(l_item_iter), 0
+          except StopIteration:
+            l_more_b = False
+            break
+        l_pending_d[l_pool_c.submit(timed_call_t, p_work_c, l_item_c)] = (l_item_c, l_tries_n)
+
+      if not l_pending_d:
+        continue
+
+      l_done_l, _ = wait(l_pending_d, return_when=FIRST_COMPLETED)
+      for l_future_c in l_done_l:
+        l_item_c, l_tries_n = l_pending_d.pop(l_future_c)
+        l_result_c, l_error_c, l_latency_n = l_future_c.result()
+        if l_error_c is None:
+          l_limit_c.success(l_latency_n)
+          yield (l_item_c, l_result_c, None)
+        else:
+          l_limit_c.decrease()
+          if l_tries_n < g_retry_n and (p_retry_c is None or p_retry_c(l_error_c)):
+            l_retry_l.append((l_item_c, l_tries_n + 1))
+          else:
+            yield (l_item_c, None, l_error_c)
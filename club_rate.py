@@ -0,0 +1,292 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+Client side rate control shared by every request club_client.py sends.
+
+Two limits are applied before each request:
+
+- A token bucket refilled at the per minute budget, with a small burst, so
+  request starts never outrun what the API allows.
+- A concurrency limit (AIMD). It starts at the connection pool size, grows
+  by a fraction of a request per success and halves on a 429, a 5xx or a
+  request that got no response.
+
+A 429 also pauses the bucket for the Retry-After time (or an exponential
+backoff with jitter when the header is missing), so every thread waits
+rather than each one hammering the API on its own. A response saying no
+requests are left (X-RateLimit-Remaining: 0) pauses it until the reset.
+
+Scripts run at the same time with the same token (cron jobs firing in the
+same minute) share one bucket through a small state file locked with
+flock, see SharedTokenBucket_c. Request starts are handed out in the order
+they are asked for, so the budget is split between the processes by how
+much each is asking for, and a 429 seen by one pauses all of them.
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+from email.utils import parsedate_to_datetime
+import json
+import os
+import random
+import threading
+import time
+
+try:
+  import fcntl
+except ImportError: # No flock on Windows, the bucket is per process there
+  fcntl = None
+
+g_burst_n         = 10    # Requests allowed back to back from a full bucket
+g_backoff_base_n  = 1.0   # Seconds, first backoff step
+g_backoff_max_n   = 60.0  # Seconds, longest backoff step
+g_decrease_gap_n  = 1.0   # Seconds, failures closer together than this count once
+
+# True for a request that failed without a response (None) or with a 5xx
+def failed_b(p_response_c):
+  return p_response_c is None or 500 <= p_response_c.status_code
+
+# Full jitter: a random wait up to the exponential step for this attempt
+def backoff_n(p_attempt_n):
+  return random.uniform(0, min(g_backoff_max_n, g_backoff_base_n * (2 ** p_attempt_n)))
+
+# Seconds to wait from a Retry-After header (seconds or an HTTP date), None
+# if there isn't a usable one.
+def retry_after_n(p_headers_d):
+  l_value_s = p_headers_d.get('Retry-After')
+  if not l_value_s:
+    return None
+  try:
+    return max(0.0, float(l_value_s))
+  except ValueError:
+    pass
+  try:
+    return max(0.0, parsedate_to_datetime(l_value_s).timestamp() - time.time())
+  except (TypeError, ValueError):
+    return None
+
+# Seconds until the budget resets when the response says none is left. The
+# reset is taken as an epoch time when it is that large, else as seconds.
+def reset_wait_n(p_headers_d):
+  if '0' != p_headers_d.get('X-RateLimit-Remaining'):
+    return None
+  try:
+    l_reset_n = float(p_headers_d.get('X-RateLimit-Reset'))
+  except (TypeError, ValueError):
+    return None
+  if l_reset_n > 1e9:
+    l_reset_n -= time.time()
+  return max(0.0, l_reset_n)
+
+class TokenBucket_c:
+
+  def __init__(self, p_per_minute_n, p_burst_n=None):
+    self.rate_n     = p_per_minute_n / 60.0
+    self.capacity_n = float(p_burst_n or g_burst_n)
+    self.tokens_n   = self.capacity_n
+    self.updated_n  = time.monotonic()
+    self.lock_c     = threading.Lock()
+
+  # Nothing is added before updated_n, which is the end of any pause
+  def refill(self, p_now_n):
+    if p_now_n > self.updated_n:
+      self.tokens_n = min(self.capacity_n, self.tokens_n + (p_now_n - self.updated_n) * self.rate_n)
+      self.updated_n = p_now_n
+
+  # Reserves the next start and returns the seconds until it. Tokens go
+  # negative for the requests waiting their turn, so they start in order.
+  def wait_n(self):
+    with self.lock_c:
+      l_now_n = time.monotonic()
+      self.refill(l_now_n)
+      self.tokens_n -= 1.0
+      return max(0.0, self.updated_n - l_now_n) + max(0.0, -self.tokens_n) / self.rate_n
+
+  # Blocks until a request may start
+  def acquire(self):
+    l_wait_n = self.wait_n()
+    if l_wait_n > 0:
+      time.sleep(l_wait_n)
+
+  # Nothing new starts for p_seconds_n, and the burst is used up so the
+  # requests afterwards come at the steady rate.
+  def pause(self, p_seconds_n):
+    with self.lock_c:
+      l_now_n = time.monotonic()
+      self.refill(l_now_n)
+      self.tokens_n = min(0.0, self.tokens_n)
+      self.updated_n = max(self.updated_n, l_now_n + p_seconds_n)
+
+# Same interface as TokenBucket_c, but the state lives in p_path_s so every
+# process using that file draws from one budget. The state is the time the
+# next request may start without a burst (tat, as in the generic cell rate
+# algorithm) and the end of any pause. Each acquire reserves a start time
+# under the file lock and then sleeps until it, so nothing polls.
+class SharedTokenBucket_c:
+
+  def __init__(self, p_per_minute_n, p_path_s, p_burst_n=None):
+    self.interval_n  = 60.0 / p_per_minute_n
+    self.tolerance_n = (float(p_burst_n or g_burst_n) - 1.0) * self.interval_n
+    self.path_s      = p_path_s
+    self.lock_c      = threading.Lock()
+
+  # Runs p_update_c(state, now) with the file locked and writes the state
+  # back. Returns what p_update_c returns.
+  def update_c(self, p_update_c):
+    with self.lock_c:
+      l_fd_n = os.open(self.path_s, os.O_RDWR | os.O_CREAT, 0o600)
+      try:
+        fcntl.flock(l_fd_n, fcntl.LOCK_EX)
+        l_data_s = os.read(l_fd_n, 4096).decode('utf-8')
+        try:
+          l_state_d = json.loads(l_data_s)
+        except ValueError: # New (or damaged) file, start with a full bucket
+          l_state_d = {}
+        l_state_d.setdefault('tat', 0.0)
+        l_state_d.setdefault('paused', 0.0)
+
+        r_result_c = p_update_c(l_state_d, time.time())
+
+        l_data_b = json.dumps(l_state_d).encode('utf-8')
+        os.lseek(l_fd_n, 0, os.SEEK_SET)
+        os.ftruncate(l_fd_n, 0)
+        os.write(l_fd_n, l_data_b)
+        return r_result_c
+      finally:
+        os.close(l_fd_n) # Releases the flock too
+
+  def reserve_n(self, p_state_d, p_now_n):
+    r_start_n = max(p_now_n, p_state_d['paused'], p_state_d['tat'] - self.tolerance_n)
+    p_state_d['tat'] = max(p_state_d['tat'], r_start_n) + self.interval_n
+    return r_start_n - p_now_n
+
+  def wait_n(self):
+    return self.update_c(self.reserve_n)
+
+  def acquire(self):
+    l_wait_n = self.wait_n()
+    if l_wait_n > 0:
+      time.sleep(l_wait_n)
+
+  def pause(self, p_seconds_n):
+    def pause_update(p_state_d, p_now_n):
+      p_state_d['paused'] = max(p_state_d['paused'], p_now_n + p_seconds_n)
+      p_state_d['tat'] = max(p_state_d['tat'], p_state_d['paused'] + self.tolerance_n)
+    self.update_c(pause_update)
+
+class ConcurrencyLimit_c:
+
+  def __init__(self, p_max_n):
+    self.max_n       = p_max_n
+    self.limit_n     = float(p_max_n)
+    self.in_flight_n = 0
+    self.decrease_n  = 0.0
+    self.cond_c      = threading.Condition()
+
+  def current_n(self):
+    return max(1, int(self.limit_n))
+
+  def acquire(self):
+    with self.cond_c:
+      while self.in_flight_n >= self.current_n():
+        self.cond_c.wait()
+      self.in_flight_n += 1
+
+  # For callers that can't block (club_async.py), True if a slot was taken
+  def try_acquire_b(self):
+    with self.cond_c:
+      if self.in_flight_n >= self.current_n():
+        return False
+      self.in_flight_n += 1
+      return True
+
+  # p_throttled_b for a 429, p_failed_b for a request that failed (see
+  # failed_b). Either halves the limit, anything else grows it.
+  def release(self, p_throttled_b=False, p_failed_b=False):
+    with self.cond_c:
+      self.in_flight_n -= 1
+      l_now_n = time.monotonic()
+      if p_throttled_b or p_failed_b:
+        # The requests already in flight when the limit was hit (or the
+        # server went bad) all come back failed, only halve once for them.
+        if l_now_n - self.decrease_n > g_decrease_gap_n:
+          self.limit_n = max(1.0, self.limit_n / 2.0)
+          self.decrease_n = l_now_n
+      else:
+        self.limit_n = min(float(self.max_n), self.limit_n + 1.0 / self.current_n())
+      self.cond_c.notify_all()
+
+# p_per_minute_n of 0 (or None) turns the bucket off, for a local mock server.
+# With p_path_s (and flock available) the bucket is shared through that file.
+class RateController_c:
+
+  def __init__(self, p_per_minute_n, p_max_jobs_n, p_burst_n=None, p_path_s=None):
+    self.per_minute_n = p_per_minute_n
+    self.bucket_c     = None
+    if p_per_minute_n and p_path_s and fcntl:
+      self.bucket_c = SharedTokenBucket_c(p_per_minute_n, p_path_s, p_burst_n)
+    elif p_per_minute_n:
+      self.bucket_c = TokenBucket_c(p_per_minute_n, p_burst_n)
+    self.limit_c      = ConcurrencyLimit_c(p_max_jobs_n)
+    self.throttle_n   = 0   # 429s in a row, for the backoff without Retry-After
+    self.lock_c       = threading.Lock()
+
+  def acquire(self):
+    self.limit_c.acquire()
+    if self.bucket_c:
+      try:
+        self.bucket_c.acquire()
+      except BaseException:
+        self.limit_c.release()
+        raise
+
+  # Called with the response once it arrives (None if the request failed
+  # without one). Returns the seconds the caller should wait before trying
+  # again after a 429, else None.
+  def release(self, p_response_c):
+    r_wait_n = self.settle_n(p_response_c)
+    self.limit_c.release(r_wait_n is not None, failed_b(p_response_c))
+    return r_wait_n
+
+  # The bucket's part of acquire and release, for club_async.py which keeps
+  # its own concurrency limit and only shares the budget.
+  def start_wait_n(self):
+    return self.bucket_c.wait_n() if self.bucket_c else 0.0
+
+  def settle_n(self, p_response_c):
+    if p_response_c is None or 429 != p_response_c.status_code:
+      with self.lock_c:
+        self.throttle_n = 0
+      if p_response_c is not None and self.bucket_c:
+        l_wait_n = reset_wait_n(p_response_c.headers)
+        if l_wait_n:
+          self.bucket_c.pause(l_wait_n)
+      return None
+
+    with self.lock_c:
+      r_wait_n = retry_after_n(p_response_c.headers)
+      if r_wait_n is None:
+        r_wait_n = backoff_n(self.throttle_n)
+      self.throttle_n += 1
+    if self.bucket_c:
+      self.bucket_c.pause(r_wait_n)
+    return r_wait_n
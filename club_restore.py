@@ -0,0 +1,398 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+Restore counterpart to club_back.py.
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+import json
+import os
+import sys
+import time
+
+import club_bulk
+import club_client
+import club_pool
+import club_store
+from club_client import fetch_clubhouse_l, fetch_json_d
+
+g_usage_string_0_s = """
+This script recreates labels, epics and stories (with their tasks and
+comments) from a club_back.py backup directory. Any of the club_back.py
+formats can be read. If the backup has story-details (club_back.py --deep)
+those are used for the stories.
+
+Projects, workflow states, members and teams are matched by name in the
+destination workspace. Labels that already exist (by name) are reused,
+projects that don't exist are created. Everything else is created new and
+the old id => new id mapping is used to fix up epic_id, project_id,
+workflow_state_id and the owner/follower ids.
+
+Stories are sent to stories/bulk in chunks, several chunks at a time,
+while keeping under the API's request budget. Every id that gets created is
+appended to a journal. If the restore dies partway through, run it again
+with the same journal and it picks up where it left off.
+
+Options:
+--jobs N      Most requests in flight (default 4)
+--chunk N     Most stories per stories/bulk request (default 25), batches
+              are also kept under club_bulk's byte limit
+--rate N      Requests per minute budget (default 180)
+--journal F   Journal file (default <backup_directory>/restore.journal.jsonl)
+
+Usage: prompt$ """
+
+g_usage_string_1_s = ''' [--jobs N] [--chunk N] [--rate N] [--journal F] backup_directory
+
+Note: This script requires that the environment variable "CLUBHOUSE_API_TOKEN"
+is set to a valid Clubhouse token.'''
+
+g_dirpath_s     = None
+g_journal_s     = None
+g_jobs_n        = 4
+g_chunk_n       = 25
+g_rate_n        = 180
+
+g_journal_c     = None
+
+# old id => new id, one dictionary per kind of entity. Filled from the
+# journal, name matching and the creates.
+g_remap_d = {
+  'label'          : {},
+  'project'        : {},
+  'team'           : {},
+  'member'         : {},
+  'workflow_state' : {},
+  'epic'           : {},
+  'story'          : {},
+  'archive'        : {},   # Stories archived after they were created
+  'sent'           : {},   # Stories sent to stories/bulk, old id => None
+}
+
+g_story_field_l = ['name', 'description', 'story_type', 'estimate', 'deadline', 'created_at', 'updated_at']
+g_epic_field_l  = ['name', 'description', 'state', 'deadline', 'planned_start_date', 'created_at', 'updated_at']
+
+def read_l(p_name_s):
+  return list(club_store.read_collection(g_dirpath_s, p_name_s))
+
+# Journal: one {"kind", "old", "new"} line per created (or archived) entity.
+# Written from the main thread only and flushed to disk after every batch.
+def load_journal():
+  if not os.path.exists(g_journal_s):
+    return
+  with open(g_journal_s, 'r') as l_file_c:
+    for l_line_s in l_file_c:
+      if not l_line_s.strip():
+        continue
+      try:
+        l_entry_d = json.loads(l_line_s)
+      except ValueError:
+        continue # Partial line from a crash
+      g_remap_d[l_entry_d['kind']][l_entry_d['old']] = l_entry_d['new']
+
+def journal(p_kind_s, p_pair_l):
+  for l_old_n, l_new_n in p_pair_l:
+    g_remap_d[p_kind_s][l_old_n] = l_new_n
+    g_journal_c.write(json.dumps({ 'kind': p_kind_s, 'old': l_old_n, 'new': l_new_n }) + '\n')
+  g_journal_c.flush()
+  os.fsync(g_journal_c.fileno())
+
+def api_fetch_d(p_method_s, p_source_s, p_json_d=None):
+  return fetch_json_d(p_method_s, club_client.api_url_s(p_source_s), p_json_d)
+
+def remap_n(p_kind_s, p_old_n):
+  if p_old_n is None:
+    return None
+  return g_remap_d[p_kind_s].get(p_old_n)
+
+def remap_l(p_kind_s, p_old_l):
+  return [ g_remap_d[p_kind_s][l_old_n] for l_old_n in (p_old_l or []) if l_old_n in g_remap_d[p_kind_s] ]
+
+# Things that can't (or shouldn't) be created are matched by name against
+# the destination workspace.
+def match_by_name(p_kind_s, p_old_l, p_new_l, p_key_c):
+  l_name_d = {}
+  for l_item_d in p_new_l:
+    l_name_d[p_key_c(l_item_d)] = l_item_d['id']
+  for l_old_d in p_old_l:
+    if l_old_d['id'] not in g_remap_d[p_kind_s] and p_key_c(l_old_d) in l_name_d:
+      g_remap_d[p_kind_s][l_old_d['id']] = l_name_d[p_key_c(l_old_d)]
+
+def mention_name_s(p_member_d):
+  return p_member_d.get('profile', {}).get('mention_name')
+
+def match_workspace():
+  match_by_name('team',   read_l('teams'),   fetch_clubhouse_l('teams'),   lambda p_d: p_d['name'])
+  match_by_name('member', read_l('members'), fetch_clubhouse_l('members'), mention_name_s)
+
+  l_new_state_d = {}
+  for l_workflow_d in fetch_clubhouse_l('workflows'):
+    for l_state_d in l_workflow_d.get('states', []):
+      l_new_state_d[(l_workflow_d['name'], l_state_d['name'])] = l_state_d['id']
+  for l_workflow_d in read_l('workflows'):
+    for l_state_d in l_workflow_d.get('states', []):
+      if (l_workflow_d['name'], l_state_d['name']) in l_new_state_d:
+        g_remap_d['workflow_state'][l_state_d['id']] = l_new_state_d[(l_workflow_d['name'], l_state_d['name'])]
+
+  match_by_name('project', read_l('projects'), fetch_clubhouse_l('projects'), lambda p_d: p_d['name'])
+  match_by_name('label',   read_l('labels'),   fetch_clubhouse_l('labels'),   lambda p_d: p_d['name'])
+
+  # Epics carry their old id as external_id, this finds any that were
+  # created by a POST whose response never came back
+  l_new_epic_d = { l_epic_d.get('external_id'): l_epic_d['id'] for l_epic_d in fetch_clubhouse_l('epics') }
+  for l_epic_d in read_l('epics'):
+    if l_epic_d['id'] not in g_remap_d['epic'] and str(l_epic_d['id']) in l_new_epic_d:
+      g_remap_d['epic'][l_epic_d['id']] = l_new_epic_d[str(l_epic_d['id'])]
+
+# Creates one entity per item, several at a time. Returns the number that
+# failed; the rest are journaled as they complete. A create that timed out
+# may have gone through so it is left for the next run rather than retried.
+def create_each_n(p_kind_s, p_source_s, p_old_l, p_payload_c):
+  l_todo_l = [ l_old_d for l_old_d in p_old_l if l_old_d['id'] not in g_remap_d[p_kind_s] ]
+  if not l_todo_l:
+    return 0
+  print('Creating ' + str(len(l_todo_l)) + ' ' + p_source_s)
+
+  r_failed_n = 0
+  l_work_c = lambda p_old_d: api_fetch_d('POST', p_source_s, p_payload_c(p_old_d))
+  for l_old_d, l_new_d, l_error_c in club_pool.run_adaptive(l_todo_l, l_work_c, g_jobs_n, g_jobs_n, club_client.resend_safe_b):
+    if l_error_c is None:
+      journal(p_kind_s, [(l_old_d['id'], l_new_d['id'])])
+    else:
+      r_failed_n += 1
+      print('Could not create ' + p_kind_s + ' ' + str(l_old_d['id']) + ': ' + str(l_error_c))
+  return r_failed_n
+
+def project_payload_d(p_project_d):
+  r_d = { 'name': p_project_d['name'] }
+  for l_key_s in ['description', 'color', 'abbreviation']:
+    if p_project_d.get(l_key_s):
+      r_d[l_key_s] = p_project_d[l_key_s]
+  if remap_n('team', p_project_d.get('team_id')):
+    r_d['team_id'] = remap_n('team', p_project_d['team_id'])
+  return r_d
+
+def label_payload_d(p_label_d):
+  r_d = { 'name': p_label_d['name'] }
+  for l_key_s in ['description', 'color']:
+    if p_label_d.get(l_key_s):
+      r_d[l_key_s] = p_label_d[l_key_s]
+  return r_d
+
+def copy_fields_d(p_old_d, p_field_l):
+  r_d = {}
+  for l_key_s in p_field_l:
+    if p_old_d.get(l_key_s) is not None:
+      r_d[l_key_s] = p_old_d[l_key_s]
+  return r_d
+
+def epic_payload_d(p_epic_d):
+  r_d = copy_fields_d(p_epic_d, g_epic_field_l)
+  r_d['labels']       = [ { 'name': l_label_d['name'] } for l_label_d in p_epic_d.get('labels', []) ]
+  r_d['owner_ids']    = remap_l('member', p_epic_d.get('owner_ids'))
+  r_d['follower_ids'] = remap_l('member', p_epic_d.get('follower_ids'))
+  r_d['external_id']  = str(p_epic_d['id'])
+  return r_d
+
+def story_payload_d(p_story_d):
+  r_d = copy_fields_d(p_story_d, g_story_field_l)
+  r_d['project_id']   = remap_n('project', p_story_d.get('project_id'))
+  r_d['labels']       = [ { 'name': l_label_d['name'] } for l_label_d in p_story_d.get('labels', []) ]
+  r_d['owner_ids']    = remap_l('member', p_story_d.get('owner_ids'))
+  r_d['follower_ids'] = remap_l('member', p_story_d.get('follower_ids'))
+  r_d['external_id']  = str(p_story_d['id'])
+
+  # Missing mappings are left out so Clubhouse picks its defaults
+  for l_key_s, l_kind_s in [('epic_id', 'epic'), ('workflow_state_id', 'workflow_state'), ('requested_by_id', 'member')]:
+    if remap_n(l_kind_s, p_story_d.get(l_key_s)):
+      r_d[l_key_s] = remap_n(l_kind_s, p_story_d[l_key_s])
+
+  if p_story_d.get('tasks'):
+    r_d['tasks'] = [ { 'description': l_task_d['description'], 'complete': l_task_d.get('complete', False) } for l_task_d in p_story_d['tasks'] ]
+
+  if p_story_d.get('comments'):
+    r_d['comments'] = []
+    for l_comment_d in p_story_d['comments']:
+      l_new_comment_d = { 'text': l_comment_d['text'] }
+      if l_comment_d.get('created_at'):
+        l_new_comment_d['created_at'] = l_comment_d['created_at']
+      if remap_n('member', l_comment_d.get('author_id')):
+        l_new_comment_d['author_id'] = remap_n('member', l_comment_d['author_id'])
+      r_d['comments'].append(l_new_comment_d)
+
+  return r_d
+
+# The deep backup has the full records, fall back to the search results for
+# anything it doesn't have.
+def backup_stories():
+  l_seen_d = {}
+  for l_story_d in club_store.read_collection(g_dirpath_s, 'story-details'):
+    l_seen_d[l_story_d['id']] = True
+    yield l_story_d
+  for l_story_d in club_store.read_collection(g_dirpath_s, 'stories'):
+    if l_story_d['id'] not in l_seen_d:
+      yield l_story_d
+
+# (old story, new payload) for everything not restored yet
+def story_payloads():
+  for l_story_d in backup_stories():
+    if l_story_d['id'] not in g_remap_d['story']:
+      yield (l_story_d, story_payload_d(l_story_d))
+
+# Chunks are capped by count and by serialized size. Each chunk is
+# journaled as sent before it goes out (this runs in the main thread, as
+# run_adaptive pulls the next chunk).
+def story_chunks():
+  for l_chunk_l in club_bulk.batches(story_payloads(), g_chunk_n, p_payload_c=lambda p_pair_t: p_pair_t[1]):
+    journal('sent', [ (l_pair_t[0]['id'], None) for l_pair_t in l_chunk_l ])
+    yield [ l_pair_t[0] for l_pair_t in l_chunk_l ], [ l_pair_t[1] for l_pair_t in l_chunk_l ]
+
+# Stories sent by an earlier run that never got an answer may have been
+# created. They are looked up by external_id and journaled if they were.
+# Returns the number that couldn't be checked, None when all were.
+def settle_sent_n():
+  l_old_l = [ l_old_n for l_old_n in g_remap_d['sent'] if l_old_n not in g_remap_d['story'] ]
+  if not l_old_l:
+    return None
+  print('Checking ' + str(len(l_old_l)) + ' stories that were sent without an answer')
+  try:
+    l_story_d = club_bulk.existing_stories_d([ str(l_old_n) for l_old_n in l_old_l ], g_jobs_n)
+  except Exception as l_e_c:
+    print('Could not check for stories already created: ' + str(l_e_c))
+    return len(l_old_l)
+  journal('story', [ (l_old_n, l_story_d[str(l_old_n)]['id']) for l_old_n in l_old_l if str(l_old_n) in l_story_d ])
+  return None
+
+def post_story_chunk_l(p_chunk_t):
+  return api_fetch_d('POST', 'stories/bulk', { 'stories': p_chunk_t[1] })
+
+# Bulk create can't archive, so archived stories are archived once created.
+# p_pair_l is [(old id, new id)], each chunk is journaled when it's done.
+def archive_stories_n(p_pair_l):
+  r_failed_n = 0
+  for i in range(0, len(p_pair_l), g_chunk_n):
+    l_pair_l = p_pair_l[i:i + g_chunk_n]
+    try:
+      api_fetch_d('PUT', 'stories/bulk', { 'archived': True, 'story_ids': [ l_new_n for l_old_n, l_new_n in l_pair_l ] })
+    except Exception as l_e_c:
+      r_failed_n += len(l_pair_l)
+      print('Could not archive stories: ' + str(l_e_c))
+      continue
+    journal('archive', l_pair_l)
+  return r_failed_n
+
+# Stories restored by an earlier run that still need archiving
+def unarchived_l():
+  return [ (l_story_d['id'], g_remap_d['story'][l_story_d['id']]) for l_story_d in backup_stories()
+           if l_story_d.get('archived') and l_story_d['id'] in g_remap_d['story'] and l_story_d['id'] not in g_remap_d['archive'] ]
+
+# Stories go out in chunks through stories/bulk with several chunks in
+# flight. The new stories come back in the same order they were sent.
+def create_stories_n():
+  r_failed_n = 0
+  l_created_n = 0
+  l_start_n = time.time()
+
+  # Nothing new is sent until it's known which of those were created
+  l_unchecked_n = settle_sent_n()
+  if l_unchecked_n is not None:
+    return l_unchecked_n
+
+  if g_remap_d['story']:
+    r_failed_n += archive_stories_n(unarchived_l())
+
+  # A chunk that timed out may have been created, it's left for the next run
+  # to look up
+  l_run_c = club_pool.run_adaptive(story_chunks(), post_story_chunk_l, g_jobs_n, g_jobs_n, club_client.resend_safe_b)
+  for l_chunk_t, l_new_l, l_error_c in l_run_c:
+    l_chunk_l = l_chunk_t[0]
+    if l_error_c is not None:
+      r_failed_n += len(l_chunk_l)
+      print('Could not create stories ' + str(l_chunk_l[0]['id']) + '..' + str(l_chunk_l[-1]['id']) + ': ' + str(l_error_c))
+      continue
+    journal('story', [ (l_old_d['id'], l_new_d['id']) for l_old_d, l_new_d in zip(l_chunk_l, l_new_l) ])
+    r_failed_n += archive_stories_n([ (l_old_d['id'], l_new_d['id']) for l_old_d, l_new_d in zip(l_chunk_l, l_new_l) if l_old_d.get('archived') ])
+    l_created_n += len(l_new_l)
+    print('Created ' + str(l_created_n) + ' stories (%.1f/sec)' % (l_created_n / max(time.time() - l_start_n, 0.001)))
+
+  return r_failed_n
+
+def main():
+
+  l_argv_l = list(sys.argv)
+
+  global g_dirpath_s, g_journal_s, g_jobs_n, g_chunk_n, g_rate_n, g_journal_c
+  g_journal_s = club_client.pop_option_s(l_argv_l, '--journal')
+  try:
+    g_jobs_n  = int(club_client.pop_option_s(l_argv_l, '--jobs', str(g_jobs_n)))
+    g_chunk_n = int(club_client.pop_option_s(l_argv_l, '--chunk', str(g_chunk_n)))
+    g_rate_n  = int(club_client.pop_option_s(l_argv_l, '--rate', str(g_rate_n)))
+  except ValueError:
+    g_jobs_n = 0
+
+  if (2 != len(l_argv_l)) or ('--help' == l_argv_l[1]) or (1 > min(g_jobs_n, g_chunk_n, g_rate_n)):
+    # Message reflects the current name of the script
+    print(g_usage_string_0_s + sys.argv[0] + g_usage_string_1_s)
+    sys.exit(1)
+
+  g_dirpath_s = l_argv_l[1]
+  if not os.path.isdir(g_dirpath_s):
+    print('Backup directory not found: ' + g_dirpath_s)
+    sys.exit(1)
+  if not g_journal_s:
+    g_journal_s = os.path.join(g_dirpath_s, 'restore.journal.jsonl')
+
+  club_client.init_from_env()
+  if g_jobs_n > club_client.g_pool_size_n:
+    club_client.init_session(p_pool_size_n=g_jobs_n)
+
+  club_client.init_rate(g_rate_n)
+
+  load_journal()
+  g_journal_c = club_store.open_journal_c(g_journal_s)
+  print('Journal: ' + g_journal_s + ' (' + str(len(g_remap_d['story'])) + ' stories already restored)')
+
+  try:
+    match_workspace()
+  except Exception as l_e_c:
+    print(l_e_c)
+    sys.exit(1)
+
+  # Order matters, each step needs the ids from the ones before it
+  l_failed_n = 0
+  l_failed_n += create_each_n('project', 'projects', read_l('projects'), project_payload_d)
+  l_failed_n += create_each_n('label', 'labels', read_l('labels'), label_payload_d)
+  l_failed_n += create_each_n('epic', 'epics', read_l('epics'), epic_payload_d)
+  l_failed_n += create_stories_n()
+
+  g_journal_c.close()
+
+  if l_failed_n:
+    print(str(l_failed_n) + ' items failed. Run again with the same journal to retry them.')
+    sys.exit(1)
+
+  print('Restore complete.')
+  sys.exit(0)
+
+if __name__ == "__main__":
+  main()
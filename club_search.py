@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+Sharded search for large workspaces.
+
+A plain search walks the 'next' cursor one page at a time and Clubhouse caps
+the number of results a single search will return. Here the search is split
+into disjoint created-date ranges, each range is paged through on its own
+thread and the results are merged and de-duplicated by id. Any range whose
+total hits the cap is cut in half and searched again until it fits.
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date, timedelta
+
+import club_async
+import club_client
+
+g_search_cap_n   = 1000
+g_shard_start_s  = '2014-01-01'  # Clubhouse didn't exist before this
+g_shard_count_n  = 8             # Initial number of date ranges
+
+# p_params_d adds to the search parameters (detail: slim for example)
+def shard_query_d(p_query_s, p_shard_t, p_params_d=None):
+  l_query_s = p_query_s + ' created:' + p_shard_t[0].isoformat() + '..' + p_shard_t[1].isoformat()
+  r_query_d = {'query': l_query_s, 'page_size': club_client.g_page_size_n}
+  r_query_d.update(p_params_d or {})
+  return r_query_d
+
+# Split [start, end] (inclusive days) into p_count_n disjoint ranges
+def split_shard_l(p_shard_t, p_count_n=2):
+  r_shard_l = []
+  l_days_n = (p_shard_t[1] - p_shard_t[0]).days + 1
+  l_count_n = min(p_count_n, l_days_n)
+  l_start_c = p_shard_t[0]
+  for i in range(l_count_n):
+    l_end_c = p_shard_t[0] + timedelta(days=(l_days_n * (i + 1)) // l_count_n - 1)
+    r_shard_l.append((l_start_c, l_end_c))
+    l_start_c = l_end_c + timedelta(days=1)
+  return r_shard_l
+
+def capped_b(p_page_d):
+  if 'total' in p_page_d and p_page_d['total'] is not None:
+    return p_page_d['total'] >= g_search_cap_n
+  return False
+
+# Worker: returns ('split', [shards]) when the range is too big for one
+# search, otherwise ('data', [records]) for the whole range.
+def search_shard_t(p_type_s, p_query_s, p_shard_t, p_params_d=None):
+  l_d = club_client.fetch_clubhouse_l('search/' + p_type_s, shard_query_d(p_query_s, p_shard_t, p_params_d))
+
+  if capped_b(l_d):
+    if p_shard_t[0] < p_shard_t[1]:
+      return ('split', split_shard_l(p_shard_t))
+    print('Warning: more than ' + str(g_search_cap_n) + ' ' + p_type_s + ' created on ' + p_shard_t[0].isoformat() + ', results may be incomplete')
+
+  r_l = list(l_d['data'])
+  while l_d['next'] is not None:
+    l_d = club_client.fetch_json_d('GET', club_client.g_url_root_s + l_d['next'])
+    r_l += l_d['data']
+  return ('data', r_l)
+
+# Run p_query_s over every created-date shard with p_jobs_n threads and
+# yield each shard's records as soon as it is done. Raises
+# requests.exceptions.RequestException if any shard fails.
+def sharded_query_pages(p_type_s, p_query_s, p_jobs_n, p_start_s=None, p_params_d=None):
+  if club_client.g_async_b: # Every shard in flight at once instead
+    yield from club_async.sharded_query_pages(p_type_s, p_query_s, p_start_s, p_params_d)
+    return
+
+  l_start_c = date.fromisoformat(p_start_s or g_shard_start_s)
+  l_end_c = date.today() + timedelta(days=1) # Clock skew between here and there
+
+  with ThreadPoolExecutor(max_workers=p_jobs_n) as l_pool_c:
+    l_pending_d = {}
+    for l_shard_t in split_shard_l((l_start_c, l_end_c), g_shard_count_n):
+      l_pending_d[l_pool_c.submit(search_shard_t, p_type_s, p_query_s, l_shard_t, p_params_d)] = l_shard_t
+
+    while l_pending_d:
+      l_done_l, _ = wait(l_pending_d, return_when=FIRST_COMPLETED)
+      for l_future_c in l_done_l:
+        del l_pending_d[l_future_c]
+        l_kind_s, l_value_l = l_future_c.result()
+        if 'split' == l_kind_s:
+          for l_shard_t in l_value_l:
+            l_pending_d[l_pool_c.submit(search_shard_t, p_type_s, p_query_s, l_shard_t, p_params_d)] = l_shard_t
+        else:
+          yield l_value_l
+
+# Same as above but merged into one list. The result is sorted by id so the
+# backup files come out the same every run.
+def fetch_sharded_query_l(p_type_s, p_query_s, p_jobs_n, p_start_s=None):
+  l_record_d = {}
+  for l_page_l in sharded_query_pages(p_type_s, p_query_s, p_jobs_n, p_start_s):
+    for l_item_d in l_page_l:
+      l_record_d[l_item_d['id']] = l_item_d
+  return [ l_record_d[l_id_n] for l_id_n in sorted(l_record_d) ]
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+Story selection through the search API, for the label scripts.
+
+labels/{id}/stories returns the full body of every story on the label when
+only the ids are wanted, and can't be narrowed down any further. Here the
+selection is a search query (label plus optional project, state, created
+date and archived filters) asked for with "detail": "slim", and only a few
+fields of each result are kept.
+
+Search terms are ANDed together and there is no OR, so each label is its
+own query. The queries run in parallel and the results are merged by id.
+A query that hits the search result cap is re-run split into created-date
+shards (see club_search.py).
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import club_client
+import club_search
+
+g_params_d     = {'detail': 'slim'}
+g_keep_field_l = ['id', 'name', 'created_at', 'archived', 'label_ids']
+g_jobs_n       = 4
+
+# Search values with spaces need quotes. The search has no escape for a
+# quote inside a value, so those are dropped.
+def term_s(p_name_s, p_value_s):
+  l_value_s = str(p_value_s).replace('"', '')
+  if ' ' in l_value_s:
+    l_value_s = '"' + l_value_s + '"'
+  return p_name_s + ':' + l_value_s
+
+# One query per label. p_archived_b None means both archived and not, which
+# are separate queries like in club_back.py. Dates are YYYY-MM-DD,
+# p_created_before_s is exclusive and p_created_since_s inclusive.
+def label_query_l(p_label_l, p_project_s=None, p_state_s=None, p_created_before_s=None, p_created_since_s=None, p_archived_b=None):
+  l_filter_l = []
+  if p_project_s:
+    l_filter_l.append(term_s('project', p_project_s))
+  if p_state_s:
+    l_filter_l.append(term_s('state', p_state_s))
+  if p_created_before_s or p_created_since_s:
+    l_to_s = '*'
+    if p_created_before_s:
+      l_to_s = (date.fromisoformat(p_created_before_s) - timedelta(days=1)).isoformat()
+    l_filter_l.append('created:' + (p_created_since_s or '*') + '..' + l_to_s)
+
+  l_archived_l = ['!is:archived', 'is:archived']
+  if p_archived_b is not None:
+    l_archived_l = ['is:archived' if p_archived_b else '!is:archived']
+
+  r_query_l = []
+  for l_label_s in p_label_l:
+    for l_archived_s in l_archived_l:
+      r_query_l.append(' '.join([term_s('label', l_label_s)] + l_filter_l + [l_archived_s]))
+  return r_query_l
+
+def trim_d(p_story_d):
+  return { l_field_s : p_story_d.get(l_field_s) for l_field_s in g_keep_field_l }
+
+# All of one query's stories (trimmed). Raises
+# requests.exceptions.RequestException on failure.
+def query_stories_l(p_query_s):
+  l_query_d = {'query': p_query_s, 'page_size': club_client.g_page_size_n}
+  l_query_d.update(g_params_d)
+  l_d = club_client.fetch_clubhouse_l('search/stories', l_query_d)
+
+  if club_search.capped_b(l_d):
+    r_story_l = []
+    for l_page_l in club_search.sharded_query_pages('stories', p_query_s, g_jobs_n, p_params_d=g_params_d):
+      r_story_l += [ trim_d(l_story_d) for l_story_d in l_page_l ]
+    return r_story_l
+
+  r_story_l = [ trim_d(l_story_d) for l_story_d in l_d['data'] ]
+  while l_d['next'] is not None:
+    l_d = club_client.fetch_json_d('GET', club_client.g_url_root_s + l_d['next'])
+    r_story_l += [ trim_d(l_story_d) for l_story_d in l_d['data'] ]
+  return r_story_l
+
+# Runs p_query_l p_jobs_n at a time. Returns (stories sorted by id with
+# duplicates removed, {query: result count}). Raises
+# requests.exceptions.RequestException if any query fails.
+def select_stories_t(p_query_l, p_jobs_n=None):
+  l_found_d = {}
+  r_count_d = {}
+  with ThreadPoolExecutor(max_workers=p_jobs_n or g_jobs_n) as l_pool_c:
+    for l_query_s, l_story_l in zip(p_query_l, l_pool_c.map(query_stories_l, p_query_l)):
+      r_count_d[l_query_s] = len(l_story_l)
+      for l_story_d in l_story_l:
+        l_found_d[l_story_d['id']] = l_story_d
+  return ([ l_found_d[l_id_n] for l_id_n in sorted(l_found_d) ], r_count_d)
+
+def select_ids_t(p_query_l, p_jobs_n=None):
+  l_story_l, r_count_d = select_stories_t(p_query_l, p_jobs_n)
+  return ([ l_story_d['id'] for l_story_d in l_story_l ], r_count_d)
@@ -0,0 +1,331 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+Backup file formats.
+
+json  - The original layout. One <name>.json file per collection holding
+        { "<name>": [ ... ] }. Has to be built in memory.
+jsonl - Streaming layout. <name>.jsonl holds one record per line and is
+        written page by page as the data arrives. <name>.manifest.json
+        records the format, record count and when it was written.
+entities - One canonical (sorted keys, indented) file per record at
+        <name>/<id>.json with <name>/index.json mapping id => sha256 of
+        the file contents. A record is only rewritten when its hash
+        changes, so disk writes and git diffs follow what changed rather
+        than the size of the workspace. Also writes <name>.manifest.json.
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+from datetime import datetime, timezone
+import hashlib
+import json
+import os
+import time
+
+import club_metrics
+
+g_format_l = ['json', 'jsonl', 'entities']
+
+def json_path_s(p_dirpath_s, p_name_s):
+  return os.path.join(p_dirpath_s, p_name_s + '.json')
+
+def jsonl_path_s(p_dirpath_s, p_name_s):
+  return os.path.join(p_dirpath_s, p_name_s + '.jsonl')
+
+def entity_dir_s(p_dirpath_s, p_name_s):
+  return os.path.join(p_dirpath_s, p_name_s)
+
+def entity_index_path_s(p_dirpath_s, p_name_s):
+  return os.path.join(p_dirpath_s, p_name_s, 'index.json')
+
+def manifest_path_s(p_dirpath_s, p_name_s):
+  return os.path.join(p_dirpath_s, p_name_s + '.manifest.json')
+
+# Writes to a temporary file and renames it into place, so readers never see
+# a half written file.
+def write_json_atomic(p_filename_s, p_d):
+  with club_metrics.phase('serialize'):
+    l_text_s = json.dumps(p_d)
+  with club_metrics.phase('write'):
+    with open(p_filename_s + '.tmp', 'w') as json_file:
+      json_file.write(l_text_s)
+    os.replace(p_filename_s + '.tmp', p_filename_s)
+
+def write_text_atomic(p_filename_s, p_text_s):
+  with open(p_filename_s + '.tmp', 'w', encoding='utf-8') as text_file:
+    text_file.write(p_text_s)
+  os.replace(p_filename_s + '.tmp', p_filename_s)
+
+# Opens a journal (one JSON record per line) for appending. A crash part way
+# through a write leaves a partial last line, it is cut off first so the
+# next entry doesn't get joined onto it.
+def open_journal_c(p_filename_s):
+  if os.path.exists(p_filename_s):
+    with open(p_filename_s, 'rb+') as l_file_c:
+      l_end_n = l_file_c.seek(0, os.SEEK_END)
+      l_keep_n = l_end_n
+      while l_keep_n > 0:
+        l_start_n = max(0, l_keep_n - 65536)
+        l_file_c.seek(l_start_n)
+        l_block_b = l_file_c.read(l_keep_n - l_start_n)
+        l_newline_n = l_block_b.rfind(b'\n')
+        if l_newline_n >= 0:
+          l_keep_n = l_start_n + l_newline_n + 1
+          break
+        l_keep_n = l_start_n
+      if l_keep_n < l_end_n:
+        l_file_c.truncate(l_keep_n)
+  return open(p_filename_s, 'a')
+
+# Same record always gives the same text (and hash)
+def canonical_json_s(p_record_d):
+  return json.dumps(p_record_d, sort_keys=True, indent=2, ensure_ascii=False) + '\n'
+
+def hash_s(p_text_s):
+  return hashlib.sha256(p_text_s.encode('utf-8')).hexdigest()
+
+# A few endpoints return records without an id
+def entity_key_s(p_record_d, p_position_n):
+  if isinstance(p_record_d, dict) and 'id' in p_record_d:
+    return str(p_record_d['id'])
+  return 'record_' + str(p_position_n)
+
+def write_manifest_d(p_dirpath_s, p_name_s, p_format_s, p_count_n, p_extra_d=None):
+  r_manifest_d = {
+    'name'       : p_name_s,
+    'format'     : p_format_s,
+    'count'      : p_count_n,
+    'written_at' : datetime.now(timezone.utc).isoformat(),
+  }
+  if p_extra_d:
+    r_manifest_d.update(p_extra_d)
+  write_json_atomic(manifest_path_s(p_dirpath_s, p_name_s), r_manifest_d)
+  return r_manifest_d
+
+def read_manifest_d(p_dirpath_s, p_name_s):
+  try:
+    with open(manifest_path_s(p_dirpath_s, p_name_s), 'r') as json_file:
+      return json.load(json_file)
+  except FileNotFoundError:
+    return None
+
+# Streams one collection to <name>.jsonl. Only the current page is ever held
+# in memory. Nothing replaces the previous backup until close() is called.
+class JsonlWriter_c:
+
+  def __init__(self, p_dirpath_s, p_name_s):
+    self.dirpath_s  = p_dirpath_s
+    self.name_s     = p_name_s
+    self.filename_s = jsonl_path_s(p_dirpath_s, p_name_s)
+    self.count_n    = 0
+    self.file_c     = open(self.filename_s + '.tmp', 'w')
+
+  def write_l(self, p_record_l):
+    with club_metrics.phase('serialize'):
+      l_text_s = ''.join( json.dumps(l_record_d) + '\n' for l_record_d in p_record_l )
+    with club_metrics.phase('write'):
+      self.file_c.write(l_text_s)
+    self.count_n += len(p_record_l)
+
+  # p_extra_d is merged into the manifest
+  def close(self, p_extra_d=None):
+    self.file_c.close()
+    os.replace(self.filename_s + '.tmp', self.filename_s)
+    return write_manifest_d(self.dirpath_s, self.name_s, 'jsonl', self.count_n, p_extra_d)
+
+  def abort(self):
+    self.file_c.close()
+    os.remove(self.filename_s + '.tmp')
+
+# Writes one file per record, skipping any whose hash is unchanged. Same
+# interface as JsonlWriter_c. With p_prune_b (a full download) records that
+# were not written this time are removed, without it (merging updates) the
+# old records are kept.
+class EntityWriter_c:
+
+  def __init__(self, p_dirpath_s, p_name_s, p_prune_b=True):
+    self.dirpath_s    = p_dirpath_s
+    self.name_s       = p_name_s
+    self.prune_b      = p_prune_b
+    self.filename_s   = entity_dir_s(p_dirpath_s, p_name_s)
+    self.old_index_d  = read_entity_index_d(p_dirpath_s, p_name_s)
+    self.index_d      = {} if p_prune_b else dict(self.old_index_d)
+    self.count_n      = 0
+    self.written_n    = 0
+    os.makedirs(self.filename_s, exist_ok=True)
+
+  def write_l(self, p_record_l):
+    l_serialize_n = 0.0
+    l_write_n = 0.0
+    for l_record_d in p_record_l:
+      l_start_n = time.perf_counter()
+      l_key_s = entity_key_s(l_record_d, self.count_n)
+      l_text_s = canonical_json_s(l_record_d)
+      l_hash_s = hash_s(l_text_s)
+      l_filename_s = os.path.join(self.filename_s, l_key_s + '.json')
+      l_hashed_n = time.perf_counter()
+      l_serialize_n += l_hashed_n - l_start_n
+      if self.old_index_d.get(l_key_s) != l_hash_s or not os.path.exists(l_filename_s):
+        write_text_atomic(l_filename_s, l_text_s)
+        self.written_n += 1
+      l_write_n += time.perf_counter() - l_hashed_n
+      self.index_d[l_key_s] = l_hash_s
+      self.count_n += 1
+    club_metrics.add_phase('serialize', l_serialize_n)
+    club_metrics.add_phase('write', l_write_n)
+
+  def close(self, p_extra_d=None):
+    l_removed_n = 0
+    if self.prune_b:
+      for l_key_s in self.old_index_d:
+        if l_key_s not in self.index_d:
+          try:
+            os.remove(os.path.join(self.filename_s, l_key_s + '.json'))
+          except FileNotFoundError:
+            pass
+          l_removed_n += 1
+
+    # Keys are sorted so the index itself only changes when an entity does
+    write_text_atomic(entity_index_path_s(self.dirpath_s, self.name_s), canonical_json_s(self.index_d))
+
+    print(self.name_s + ': ' + str(self.written_n) + ' changed, ' + str(l_removed_n) + ' removed, ' + str(len(self.index_d)) + ' total')
+    l_extra_d = { 'changed': self.written_n, 'removed': l_removed_n }
+    if p_extra_d:
+      l_extra_d.update(p_extra_d)
+    return write_manifest_d(self.dirpath_s, self.name_s, 'entities', len(self.index_d), l_extra_d)
+
+  # Each record file was written atomically, just leave the index alone
+  def abort(self):
+    pass
+
+def read_entity_index_d(p_dirpath_s, p_name_s):
+  try:
+    with open(entity_index_path_s(p_dirpath_s, p_name_s), 'r') as json_file:
+      return json.load(json_file)
+  except FileNotFoundError:
+    return {}
+
+def read_entities(p_dirpath_s, p_name_s):
+  for l_key_s in read_entity_index_d(p_dirpath_s, p_name_s):
+    with open(os.path.join(entity_dir_s(p_dirpath_s, p_name_s), l_key_s + '.json'), 'r', encoding='utf-8') as json_file:
+      yield json.load(json_file)
+
+# Streaming writer for p_format_s (jsonl or entities)
+def open_writer_c(p_dirpath_s, p_name_s, p_format_s, p_prune_b=True):
+  if 'entities' == p_format_s:
+    return EntityWriter_c(p_dirpath_s, p_name_s, p_prune_b)
+  return JsonlWriter_c(p_dirpath_s, p_name_s)
+
+# Yields the records of a jsonl collection one at a time
+def read_jsonl(p_dirpath_s, p_name_s):
+  with open(jsonl_path_s(p_dirpath_s, p_name_s), 'r') as jsonl_file:
+    for l_line_s in jsonl_file:
+      if l_line_s.strip():
+        yield json.loads(l_line_s)
+
+# Reads a collection in whichever layout it was saved in, or only the one
+# given by p_format_s.
+def read_collection(p_dirpath_s, p_name_s, p_format_s=None):
+  if p_format_s in [None, 'entities'] and os.path.exists(entity_index_path_s(p_dirpath_s, p_name_s)):
+    yield from read_entities(p_dirpath_s, p_name_s)
+  elif p_format_s in [None, 'jsonl'] and os.path.exists(jsonl_path_s(p_dirpath_s, p_name_s)):
+    yield from read_jsonl(p_dirpath_s, p_name_s)
+  elif p_format_s in [None, 'json'] and os.path.exists(json_path_s(p_dirpath_s, p_name_s)):
+    with open(json_path_s(p_dirpath_s, p_name_s), 'r') as json_file:
+      l_record_c = json.load(json_file)[p_name_s]
+    # A few endpoints (epic-workflow) return a single record
+    yield from l_record_c if isinstance(l_record_c, list) else [l_record_c]
+
+def collection_exists_b(p_dirpath_s, p_name_s, p_format_s):
+  if 'entities' == p_format_s:
+    return os.path.exists(entity_index_path_s(p_dirpath_s, p_name_s))
+  if 'jsonl' == p_format_s:
+    return os.path.exists(jsonl_path_s(p_dirpath_s, p_name_s))
+  return os.path.exists(json_path_s(p_dirpath_s, p_name_s))
+
+# The layout a collection was saved in, the same preference as
+# read_collection. None when the backup doesn't have it.
+def collection_format_s(p_dirpath_s, p_name_s):
+  for l_format_s in ['entities', 'jsonl', 'json']:
+    if collection_exists_b(p_dirpath_s, p_name_s, l_format_s):
+      return l_format_s
+  return None
+
+# Names of the collections saved in a backup directory, in any format. A
+# jsonl file only counts with its manifest (the restore journal is jsonl too).
+def collection_names_l(p_dirpath_s):
+  r_name_d = {}
+  for l_entry_s in sorted(os.listdir(p_dirpath_s)):
+    if os.path.exists(entity_index_path_s(p_dirpath_s, l_entry_s)):
+      r_name_d[l_entry_s] = True
+    elif l_entry_s.endswith('.jsonl') and os.path.exists(manifest_path_s(p_dirpath_s, l_entry_s[:-len('.jsonl')])):
+      r_name_d[l_entry_s[:-len('.jsonl')]] = True
+    elif l_entry_s.endswith('.json') and not l_entry_s.endswith('.manifest.json'):
+      r_name_d[l_entry_s[:-len('.json')]] = True
+  return list(r_name_d)
+
+# Merges updated records into an existing collection by id. Records in
+# p_update_d (id => record) replace the saved copy, anything new is added at
+# the end. For jsonl only the updates are held in memory. Returns the new
+# record count.
+def merge_collection_n(p_dirpath_s, p_name_s, p_format_s, p_update_d, p_extra_d=None):
+  l_update_d = dict(p_update_d)
+
+  if 'entities' == p_format_s:
+    l_writer_c = EntityWriter_c(p_dirpath_s, p_name_s, p_prune_b=False)
+    l_writer_c.write_l(list(l_update_d.values()))
+    return l_writer_c.close(p_extra_d)['count']
+
+  if 'jsonl' == p_format_s:
+    l_writer_c = JsonlWriter_c(p_dirpath_s, p_name_s)
+    try:
+      for l_record_d in read_jsonl(p_dirpath_s, p_name_s):
+        l_writer_c.write_l([ l_update_d.pop(l_record_d['id'], l_record_d) ])
+      l_writer_c.write_l(list(l_update_d.values()))
+    except:
+      l_writer_c.abort()
+      raise
+    return l_writer_c.close(p_extra_d)['count']
+
+  r_record_l = []
+  for l_record_d in read_collection(p_dirpath_s, p_name_s, 'json'):
+    r_record_l.append(l_update_d.pop(l_record_d['id'], l_record_d))
+  r_record_l += list(l_update_d.values())
+  write_json_atomic(json_path_s(p_dirpath_s, p_name_s), { p_name_s : r_record_l })
+  return len(r_record_l)
+
+# backup.manifest.json describes the backup as a whole. Per collection it
+# keeps the high-water mark (largest updated_at saved) and when the
+# collection was last fully downloaded.
+def backup_manifest_path_s(p_dirpath_s):
+  return os.path.join(p_dirpath_s, 'backup.manifest.json')
+
+def read_backup_manifest_d(p_dirpath_s):
+  try:
+    with open(backup_manifest_path_s(p_dirpath_s), 'r') as json_file:
+      return json.load(json_file)
+  except FileNotFoundError:
+    return { 'collections': {} }
+
+def write_backup_manifest(p_dirpath_s, p_manifest_d):
+  write_json_atomic(backup_manifest_path_s(p_dirpath_s), p_manifest_d)
@@ -23,10 +23,19 @@ s - String
 
 '''
 
+from datetime import datetime, timedelta, timezone
 import json
 import os
-import requests
 import sys
+import time
+
+import club_bulk
+import club_client
+import club_cron
+import club_index
+import club_metrics
+import club_select
+import club_store
 
 g_usage_string_0_s = """
 This script creates Clubhouse stories from story templates. For each 
@@ -42,37 +51,186 @@ That is, if you want a recurring story to be created every Monday at
 1. Create a template for the story with the label Monday_9AM.
 2. Execute "create_by_label.py Monday_9AM" from cron every Monday at 9AM.
 
+The templates are cached on disk together with a label => template index
+and the story each template makes. Within --cache-ttl seconds of the last
+check the cache is used as is, after that one conditional request checks
+whether the templates changed.
+
+Options:
+--skip-existing   Don't create a story when one with the same name and label
+                  was already created today (a cron job that ran twice)
+--cache-ttl N     Seconds to trust the cache without asking (default 3600)
+--no-cache        Always download the templates, don't read or write the cache
+--dry-run         Only list the stories that would be created and the
+                  stories/bulk requests it takes
+--index FILE      With --dry-run, take the templates (and for --skip-existing
+                  the stories) from the SQLite index of a backup
+                  (club_index.py) instead of the API. No requests are made
+                  and no token is needed, but the index is only as current
+                  as its last backup.
+
+--daemon FILE     Stay running and create the stories on the schedule in FILE
+                  (see below) instead of for labels given on the command line
+--catch-up HOURS  On start, make up runs missed while the daemon was down if
+                  they are less than this old (default 24)
+
+The daemon schedule is a JSON list of cron expressions and labels:
+
+[
+  { "cron": "0 9 * * 1",  "labels": ["Monday_9AM"] },
+  { "cron": "0 8 * * 1-5", "labels": ["Daily"], "skip_existing": true }
+]
+
+A scheduled run that fails is tried again every minute, skipping the
+stories already created today, until it is --catch-up hours late.
+
+Environment:
+CLUBHOUSE_CACHE_DIR  Cache directory (default ~/.cache/utilities_clubhouse)
+
 Usage: prompt$ """
 
-g_usage_string_1_s = ''' label_0 [label_1 ...]
+g_usage_string_1_s = ''' [--skip-existing] [--cache-ttl N] [--no-cache] [--dry-run [--index FILE]] [--daemon FILE [--catch-up HOURS]] [label_0 label_1 ...]
+
+Run reports: [--metrics report.json] [--prom metrics.prom] [--profile run.prof]
 
 Note: This script requires that the environment variable "CLUBHOUSE_API_TOKEN" 
 is set to a valid Clubhouse token.'''
 
-g_env_usage_message_s = '''
-This script requires that the environment variable "CLUBHOUSE_API_TOKEN" is
-set to a valid Clubhouse token.
-'''
-
-g_url_root_s = 'https://api.clubhouse.io'
-g_api_s      = '/api/v3/'
-g_token_s    = 'token='
-
 # Example for API document
 # curl -X GET \
 #  -H "Content-Type: application/json" \
 #  -L "https://api.clubhouse.io/api/v3/entity-templates?token=$CLUBHOUSE_API_TOKEN"
   
-# Get the list of templates from clubhouse.io
-def get_template_l():
+g_skip_existing_b = False
+g_cache_ttl_n     = 3600
+g_cache_b         = True
+g_cache_dir_s     = os.getenv('CLUBHOUSE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'utilities_clubhouse'))
+g_cache_version_n = 1
+g_catch_up_hours_n = 24.0
+g_retry_wait_n    = 60.0   # Seconds before a failed scheduled run is tried again
+g_dry_run_b       = False
+g_index_s         = None
+
+# Get the list of templates from clubhouse.io, unless they haven't changed
+# since p_cache_d was saved. Returns None when the server says nothing
+# changed (304), else (templates, validator headers for next time).
+def fetch_changed_templates_t(p_cache_d):
+  l_headers_d = {}
+  if p_cache_d.get('etag'):
+    l_headers_d['If-None-Match'] = p_cache_d['etag']
+  if p_cache_d.get('last_modified'):
+    l_headers_d['If-Modified-Since'] = p_cache_d['last_modified']
+  l_response_c = club_client.send_request_c('GET', club_client.api_url_s('entity-templates'), p_headers_d=l_headers_d)
+  if 304 == l_response_c.status_code:
+    return None
+  return (l_response_c.json(), { 'etag': l_response_c.headers.get('ETag'), 'last_modified': l_response_c.headers.get('Last-Modified') })
+
+def cache_path_s():
+  return os.path.join(g_cache_dir_s, 'templates-' + club_client.token_hash_s() + '.json')
+
+def read_cache_d():
   try:
-    l_url_s = g_url_root_s + g_api_s + 'entity-templates' + '?' + g_token_s
-    r_response_d = requests.get(l_url_s)
-    r_response_d.raise_for_status()
-  except requests.exceptions.RequestException as l_e_c:
-    print(l_e_c)
-    sys.exit(1)
-  return r_response_d.json()
+    with open(cache_path_s(), 'r') as json_file:
+      r_cache_d = json.load(json_file)
+  except (OSError, ValueError):
+    return None
+  if g_cache_version_n != r_cache_d.get('version'):
+    return None
+  return r_cache_d
+
+# The cache is only a speed up, a run that can't write it still works
+def write_cache(p_cache_d):
+  try:
+    os.makedirs(g_cache_dir_s, exist_ok=True)
+    club_store.write_json_atomic(cache_path_s(), p_cache_d)
+  except OSError as l_e_c:
+    print('Could not write the template cache: ' + str(l_e_c))
+
+# Index of the templates: label name => template ids (each once, in template
+# order) and template id => {name, story}. The story is None when the
+# template is missing a mandatory field, story_data_from_template raises
+# for it again if it is ever picked.
+def build_cache_d(p_template_l, p_validator_d):
+  r_cache_d = { 'version': g_cache_version_n, 'checked_at': time.time(), 'index': {}, 'templates': {} }
+  r_cache_d.update(p_validator_d)
+  r_cache_d['hash'] = club_store.hash_s(json.dumps(p_template_l, sort_keys=True))
+
+  for l_cur_template_d in p_template_l:
+    if "story_contents" not in l_cur_template_d or "labels" not in l_cur_template_d['story_contents']:
+      continue
+    l_id_s = str(l_cur_template_d['id'])
+    try:
+      l_story_d = story_data_from_template(l_cur_template_d)
+    except KeyError:
+      l_story_d = None
+    r_cache_d['templates'][l_id_s] = { 'name': l_cur_template_d['name'], 'story': l_story_d, 'template': l_cur_template_d if l_story_d is None else None }
+    for l_cur_label_d in l_cur_template_d['story_contents']['labels']:
+      l_id_l = r_cache_d['index'].setdefault(l_cur_label_d['name'], [])
+      if l_id_s not in l_id_l:
+        l_id_l.append(l_id_s)
+  return r_cache_d
+
+# The same index built from the templates in the backup index
+def backup_index_d():
+  l_conn_c = club_index.connect_c(g_index_s)
+  try:
+    l_template_l = club_index.records_l(l_conn_c, 'templates')
+  finally:
+    l_conn_c.close()
+  return build_cache_d(l_template_l, {})
+
+# The cached index, refreshed when it is older than g_cache_ttl_n and the
+# server has something newer.
+def load_index_d():
+  if g_index_s:
+    with club_metrics.phase('transform'):
+      return backup_index_d()
+
+  l_cache_d = read_cache_d() if g_cache_b else None
+
+  if l_cache_d is not None and time.time() - l_cache_d['checked_at'] < g_cache_ttl_n:
+    return l_cache_d
+
+  if l_cache_d is None:
+    l_changed_t = fetch_changed_templates_t({})
+    with club_metrics.phase('transform'):
+      l_cache_d = build_cache_d(*l_changed_t)
+  else:
+    l_changed_t = fetch_changed_templates_t(l_cache_d)
+    if l_changed_t is None:
+      l_cache_d['checked_at'] = time.time()
+    else:
+      l_template_l, l_validator_d = l_changed_t
+      l_hash_s = club_store.hash_s(json.dumps(l_template_l, sort_keys=True))
+      if l_hash_s == l_cache_d['hash']: # No validators from the server, same content
+        l_cache_d['checked_at'] = time.time()
+        l_cache_d.update(l_validator_d)
+      else:
+        with club_metrics.phase('transform'):
+          l_cache_d = build_cache_d(l_template_l, l_validator_d)
+
+  if g_cache_b:
+    write_cache(l_cache_d)
+  return l_cache_d
+
+# The stories for p_label_l, one per template even when a template has more
+# than one of the labels
+def stories_for_labels_l(p_index_d, p_label_l):
+  l_id_l = []
+  for l_label_s in p_label_l:
+    for l_id_s in p_index_d['index'].get(l_label_s, []):
+      if l_id_s not in l_id_l:
+        l_id_l.append(l_id_s)
+
+  r_story_l = []
+  for l_id_s in l_id_l:
+    l_template_d = p_index_d['templates'][l_id_s]
+    print('Adding story from template named: ' + l_template_d['name'])
+    if l_template_d['story'] is None:
+      r_story_l.append(story_data_from_template(l_template_d['template']))
+    else:
+      r_story_l.append(dict(l_template_d['story']))
+  return r_story_l
 
 # Extract the fields from the template to populte the new story
 def story_data_from_template(p_template_d):
@@ -118,56 +276,210 @@ def story_data_from_template(p_template_d):
 #   -d '{ "name": "foo", "project_id": 30 }' \
 #   -L "https://api.clubhouse.io/api/v3/stories?token=$CLUBHOUSE_API_TOKEN"
 
-# Create a bunch of new stories
+# Names of the stories with any of p_label_l created today, from a slim
+# search (see club_select.py). Today is the UTC day, as created_at is UTC.
+def created_today_s(p_label_l):
+  l_today_s = datetime.now(timezone.utc).date().isoformat()
+  if g_index_s:
+    l_conn_c = club_index.connect_c(g_index_s)
+    try:
+      l_story_l, l_count_d = club_index.select_stories_t(l_conn_c, p_label_l, p_created_since_s=l_today_s)
+    finally:
+      l_conn_c.close()
+    return set( l_story_d['name'] for l_story_d in l_story_l )
+  l_query_l = club_select.label_query_l(p_label_l, p_created_since_s=l_today_s)
+  l_story_l, l_count_d = club_select.select_stories_t(l_query_l)
+  return set( l_story_d['name'] for l_story_d in l_story_l )
+
+# Create a bunch of new stories, batched by count and size. Returns the
+# number of batches that failed.
 def create_stories(p_story_l):
+  r_created_l, r_failed_n = club_bulk.create_stories_t(p_story_l)
+  return r_failed_n
+
+def print_plan(p_story_l):
+  l_batch_n = len(list(club_bulk.batches(p_story_l)))
+  print('Dry run, nothing is created.')
+  for l_story_d in p_story_l:
+    print('  %-60s %d labels, %d tasks' % (l_story_d['name'], len(l_story_d['labels']), len(l_story_d.get('tasks', []))))
+  print('Requests: ' + str(l_batch_n) + ' POST stories/bulk for ' + str(len(p_story_l)) + ' stories')
+
+# One run for p_label_l. Returns False if any stories couldn't be created,
+# raises requests.exceptions.RequestException if the lookups fail.
+def run_labels_b(p_label_l, p_skip_existing_b):
+  # The labels passed into the script
+  print('Processing Labels:', p_label_l)
+
+  l_index_d = load_index_d()
+  with club_metrics.phase('transform'):
+    l_story_l = stories_for_labels_l(l_index_d, p_label_l)
+
+  if l_story_l and p_skip_existing_b:
+    l_existing_s = created_today_s(p_label_l)
+    for l_story_d in l_story_l:
+      if l_story_d['name'] in l_existing_s:
+        print('Already created today, skipping: ' + l_story_d['name'])
+    l_story_l = [ l_story_d for l_story_d in l_story_l if l_story_d['name'] not in l_existing_s ]
+    if not l_story_l:
+      print("All matching stories were already created today.")
+      return True
+
+  if l_story_l and g_dry_run_b:
+    print_plan(l_story_l)
+    return True
+  if l_story_l:
+    return 0 == create_stories(l_story_l)
+  print("No label matches found.")
+  return True
+
+# Daemon mode. The schedule file is a list of
+#   { "cron": "0 9 * * 1", "labels": ["Monday_9AM"], "skip_existing": true }
+# Returns [(key, club_cron.Cron_c, labels, skip existing)].
+def read_schedule_l(p_filename_s):
+  with open(p_filename_s, 'r') as json_file:
+    l_entry_l = json.load(json_file)
+  r_schedule_l = []
+  for l_entry_d in l_entry_l:
+    l_key_s = l_entry_d['cron'] + ' ' + ','.join(l_entry_d['labels'])
+    r_schedule_l.append((l_key_s, club_cron.Cron_c(l_entry_d['cron']), l_entry_d['labels'], l_entry_d.get('skip_existing', g_skip_existing_b)))
+  return r_schedule_l
+
+def schedule_state_path_s():
+  return os.path.join(g_cache_dir_s, 'schedule-' + club_client.token_hash_s() + '.json')
+
+# key => when it last ran (or was deliberately skipped)
+def read_schedule_state_d():
   try:
-    l_url_s = g_url_root_s + g_api_s + 'stories/bulk' + '?' + g_token_s
-    r_response_d = requests.post(l_url_s, json={ 'stories': p_story_l } )
-    r_response_d.raise_for_status()
-  except requests.exceptions.RequestException as l_e_c:
-    print(l_e_c)
-    sys.exit(1)
-  return r_response_d.json()
+    with open(schedule_state_path_s(), 'r') as json_file:
+      return json.load(json_file)
+  except (OSError, ValueError):
+    return {}
+
+def write_schedule_state(p_state_d):
+  try:
+    os.makedirs(g_cache_dir_s, exist_ok=True)
+    club_store.write_json_atomic(schedule_state_path_s(), p_state_d)
+  except OSError as l_e_c:
+    print('Could not write the schedule state: ' + str(l_e_c))
+
+# Runs forever. Every entry due at the same minute is created in one run
+# (one template lookup, one set of bulk creates). A run missed while the
+# daemon was down is made up once on start if it is less than
+# g_catch_up_hours_n old. New entries start from now. An entry whose run
+# fails stays due and is tried again every g_retry_wait_n seconds (skipping
+# the stories already created today) until it is g_catch_up_hours_n late.
+def run_daemon(p_schedule_l):
+  l_state_d = read_schedule_state_d()
+  l_now_c = datetime.now()
+  l_next_d = {}
+  for l_key_s, l_cron_c, l_label_l, l_skip_b in p_schedule_l:
+    if l_key_s not in l_state_d:
+      l_state_d[l_key_s] = l_now_c.isoformat()
+    l_next_c = l_cron_c.next_c(datetime.fromisoformat(l_state_d[l_key_s]))
+    if l_next_c <= l_now_c and l_now_c - l_next_c > timedelta(hours=g_catch_up_hours_n):
+      print('Skipping missed run of ' + l_key_s + ' from ' + l_next_c.isoformat(' ', 'minutes') + ', too old to catch up')
+      l_state_d[l_key_s] = l_now_c.isoformat()
+      l_next_c = l_cron_c.next_c(l_now_c)
+    elif l_next_c <= l_now_c:
+      print('Catching up missed run of ' + l_key_s + ' from ' + l_next_c.isoformat(' ', 'minutes'))
+    l_next_d[l_key_s] = l_next_c
+  write_schedule_state(l_state_d)
+
+  l_retry_d = {} # key => when a failed run is next tried
+  print('Daemon started with ' + str(len(p_schedule_l)) + ' schedules')
+  while True:
+    l_now_c = datetime.now()
+    l_due_l = [ l_entry_t for l_entry_t in p_schedule_l if max(l_next_d[l_entry_t[0]], l_retry_d.get(l_entry_t[0], l_now_c)) <= l_now_c ]
+    if not l_due_l:
+      # Wake at least once a minute so clock changes don't strand a run
+      l_wait_n = min( (max(l_next_d[l_key_s], l_retry_d.get(l_key_s, l_now_c)) - l_now_c).total_seconds() for l_key_s in l_next_d )
+      time.sleep(min(60.0, max(1.0, l_wait_n)))
+      continue
+
+    # Entries that skip existing stories run apart from the ones that don't.
+    # A retry always skips them, the failed run may have created some.
+    l_done_l = []
+    for l_skip_b in [False, True]:
+      l_group_l = [ l_entry_t for l_entry_t in l_due_l if l_skip_b == (l_entry_t[3] or l_entry_t[0] in l_retry_d) ]
+      l_label_l = []
+      for l_key_s, l_cron_c, l_entry_label_l, l_entry_skip_b in l_group_l:
+        l_label_l += [ l_label_s for l_label_s in l_entry_label_l if l_label_s not in l_label_l ]
+      if not l_label_l:
+        continue
+      print(datetime.now().isoformat(' ', 'seconds') + ' running ' + ', '.join(l_label_l))
+      try:
+        if run_labels_b(l_label_l, l_skip_b):
+          l_done_l += l_group_l
+        else:
+          print('Some stories could not be created')
+      except Exception as l_e_c: # Keep the daemon up, the next run may work
+        print('Run failed: ' + str(l_e_c))
+
+    # Any number of missed times are covered by this one run
+    for l_key_s, l_cron_c, l_label_l, l_skip_b in l_due_l:
+      if (l_key_s, l_cron_c, l_label_l, l_skip_b) not in l_done_l:
+        if l_now_c - l_next_d[l_key_s] <= timedelta(hours=g_catch_up_hours_n):
+          print('Will retry ' + l_key_s + ' in ' + str(int(g_retry_wait_n)) + ' seconds')
+          l_retry_d[l_key_s] = l_now_c + timedelta(seconds=g_retry_wait_n)
+          continue
+        print('Giving up on the run of ' + l_key_s + ' from ' + l_next_d[l_key_s].isoformat(' ', 'minutes'))
+      l_retry_d.pop(l_key_s, None)
+      l_state_d[l_key_s] = l_now_c.isoformat()
+      l_next_d[l_key_s] = l_cron_c.next_c(l_now_c)
+    write_schedule_state(l_state_d)
+    club_metrics.flush()
 
 def main():
 
-  if (2 > len(sys.argv)) or (2 == len(sys.argv) and '--help' == sys.argv[1]):
+  l_argv_l = list(sys.argv)
+
+  global g_skip_existing_b, g_cache_b, g_cache_ttl_n, g_catch_up_hours_n, g_dry_run_b, g_index_s
+  g_skip_existing_b = club_client.pop_flag_b(l_argv_l, '--skip-existing')
+  g_cache_b = not club_client.pop_flag_b(l_argv_l, '--no-cache')
+  g_dry_run_b = club_client.pop_flag_b(l_argv_l, '--dry-run')
+  g_index_s = club_client.pop_option_s(l_argv_l, '--index')
+  l_schedule_s = club_client.pop_option_s(l_argv_l, '--daemon')
+  try:
+    g_cache_ttl_n = int(club_client.pop_option_s(l_argv_l, '--cache-ttl', str(g_cache_ttl_n)))
+    g_catch_up_hours_n = float(club_client.pop_option_s(l_argv_l, '--catch-up', str(g_catch_up_hours_n)))
+  except ValueError:
+    g_cache_ttl_n = -1
+
+  # The index is only as current as its last backup, never create from it
+  l_usage_b = (0 > g_cache_ttl_n) or (0 > g_catch_up_hours_n) or (g_index_s and not g_dry_run_b)
+  if l_schedule_s:
+    l_usage_b = l_usage_b or (1 != len(l_argv_l)) or g_dry_run_b
+  else:
+    l_usage_b = l_usage_b or (2 > len(l_argv_l)) or (2 == len(l_argv_l) and '--help' == l_argv_l[1])
+
+  if l_usage_b:
     # Message reflects the current name of the script
     print(g_usage_string_0_s + sys.argv[0] + g_usage_string_1_s)
     sys.exit(1)
 
-  if not os.getenv('CLUBHOUSE_API_TOKEN'):
-    print(g_env_usage_message_s)
-    sys.exit(1)
-
-  global g_token_s
-  g_token_s += os.getenv('CLUBHOUSE_API_TOKEN')
+  if not g_index_s:
+    club_client.init_from_env()
+
+  if l_schedule_s:
+    try:
+      l_schedule_l = read_schedule_l(l_schedule_s)
+    except (OSError, ValueError, KeyError, TypeError) as l_e_c:
+      print('Failure processing schedule file named:', l_schedule_s)
+      print(l_e_c)
+      sys.exit(1)
+    try:
+      run_daemon(l_schedule_l)
+    except KeyboardInterrupt:
+      sys.exit(0)
 
   l_arg_labels_l = []
-  for l_cur_arg_s in sys.argv[1:]:
+  for l_cur_arg_s in l_argv_l[1:]:
     l_arg_labels_l.append(l_cur_arg_s)
 
-  # The labels passed into the script
-  print('Processing Labels:', l_arg_labels_l)
-
-  l_template_l = get_template_l()
-
-  l_story_l = []
-
-  for l_cur_template_d in l_template_l:
-    if "story_contents" in l_cur_template_d:
-      if "labels" in l_cur_template_d['story_contents']:
-        for l_cur_label_d in l_cur_template_d['story_contents']['labels']:
-          if l_cur_label_d['name'] in l_arg_labels_l:
-            print('Adding story from template named: '+l_cur_template_d['name'])
-            l_story_l.append(story_data_from_template(l_cur_template_d))
-
-  if l_story_l:
-    create_stories(l_story_l)
-  else:
-    print("No label matches found.")
+  if not club_client.exit_on_error(run_labels_b, l_arg_labels_l, g_skip_existing_b):
+    sys.exit(1)
 
   sys.exit(0)
 
 if __name__ == "__main__":
-  main()
\ No newline at end of file
+  club_metrics.run_main(main)
@@ -23,11 +23,17 @@ s - String
 
 '''
 
+from datetime import date
 import json
-import os
-import requests
 import sys
 
+import club_async
+import club_client
+import club_index
+import club_metrics
+import club_pool
+import club_select
+
 g_usage_string_0_s = """
 !!! Danger !!!
 
@@ -41,20 +47,44 @@ This was created as a complement to trello_to_clubhouse.py and
 create_by_label.py. Basically, it's a way to recover if I accidentally create 
 a bunch of unwanted stories.
 
+The stories of each label are looked up in parallel, then archived and
+deleted in chunks with a few chunks in flight at once.
+
+Options:
+--jobs N      Requests in flight at once (default 4)
+--chunk N     Stories per archive/delete request (default 100)
+--dry-run     Only report what would be deleted and the requests it takes
+--index FILE  With --dry-run, pick the stories from the SQLite index of a
+              backup (club_index.py) instead of asking the API. No requests
+              are made, and no token is needed. The search filters below
+              can be used with it too.
+--async       Use the asyncio backend (club_async.py): every label lookup
+              and chunk is in flight at once (up to CLUBHOUSE_ASYNC_JOBS,
+              default 100) from one thread instead of --jobs threads
+
+--search      Pick the stories with a search (slim records) instead of
+              reading each label's full stories. A story the search returns
+              without one of the labels is skipped. Only with --search,
+              narrow it down:
+  --project NAME            Stories in this project
+  --state NAME              Stories in this workflow state
+  --created-before DATE     Created before YYYY-MM-DD
+  --archived yes|no         Only archived / only unarchived stories
+
 Usage: prompt$ """
-g_usage_string_1_s = ''' label_0 label_1 ...
+g_usage_string_1_s = ''' [--jobs N] [--chunk N] [--dry-run [--index FILE]] [--async] [--search [filters]] label_0 label_1 ...
+
+Run reports: [--metrics report.json] [--prom metrics.prom] [--profile run.prof]
 
 Note: This script requires that the environment variable "CLUBHOUSE_API_TOKEN" 
 is set to a valid Clubhouse token.'''
 
-g_env_usage_message_s = '''
-This script requires that the environment variable "CLUBHOUSE_API_TOKEN" is
-set to a valid Clubhouse token.
-'''
-
-g_url_root_s = 'https://api.clubhouse.io'
-g_api_s      = '/api/v3/'
-g_token_s    = 'token='
+g_jobs_n    = 4
+g_chunk_n   = 100  # stories/bulk takes at most 100 ids
+g_dry_run_b = False
+g_search_b  = False
+g_index_s   = None
+g_filter_d  = {}
 
 # Python variant of this example
 #
@@ -64,29 +94,37 @@ g_token_s    = 'token='
 
 # Get the list of labels
 def get_labels_l():
-  try:
-    l_url_s = g_url_root_s + g_api_s + 'labels' + '?' + g_token_s
-    r_response_d = requests.get(l_url_s)
-    r_response_d.raise_for_status()
-  except requests.exceptions.RequestException as l_e_c:
-    print(l_e_c)
-    sys.exit(1)
-  return r_response_d.json()
+  return club_client.get_clubhouse_l('labels')
 
 # curl -X GET \
 #  -H "Content-Type: application/json" \
 #  -L "https://api.clubhouse.io/api/v3/labels/{label-public-id}/stories?token=$CLUBHOUSE_API_TOKEN"  
 
-# Get the list of stories associated with the labels
+# Get the list of stories associated with the labels. Raises on failure,
+# called from the pool.
 def get_story_l(p_label_id_n):
-  try:
-    l_url_s = g_url_root_s + g_api_s + 'labels/'+ str(p_label_id_n) +'/stories' + '?' + g_token_s
-    r_response_d = requests.get(l_url_s)
-    r_response_d.raise_for_status()
-  except requests.exceptions.RequestException as l_e_c:
-    print(l_e_c)
-    sys.exit(1)
-  return r_response_d.json()
+  return club_client.fetch_clubhouse_l('labels/'+ str(p_label_id_n) +'/stories')
+
+async def get_story_async_l(p_label_id_n):
+  return await club_async.fetch_clubhouse_l('labels/'+ str(p_label_id_n) +'/stories')
+
+# Story ids for all of p_label_d (id => name), looked up g_jobs_n at a time.
+# Returns (sorted unique ids, {label name: story count}).
+def resolve_story_ids_t(p_label_d):
+  r_story_id_s = set()
+  r_count_d = {}
+  if club_client.g_async_b:
+    l_run_c = club_async.run_map(get_story_async_l, p_label_d)
+  else:
+    l_run_c = club_pool.run_adaptive(p_label_d, get_story_l, g_jobs_n, g_jobs_n)
+  for l_label_id_n, l_story_l, l_error_c in l_run_c:
+    if l_error_c is not None:
+      print('Could not get the stories for label ' + p_label_d[l_label_id_n] + ': ' + str(l_error_c))
+      sys.exit(1)
+    with club_metrics.phase('transform'):
+      r_count_d[p_label_d[l_label_id_n]] = len(l_story_l)
+      r_story_id_s.update(l_story_d['id'] for l_story_d in l_story_l)
+  return (sorted(r_story_id_s), r_count_d)
 
 # curl -X PUT \
 #  -H "Content-Type: application/json" \
@@ -94,14 +132,11 @@ def get_story_l(p_label_id_n):
 #  -L "https://api.clubhouse.io/api/v3/stories/bulk?token=$CLUBHOUSE_API_TOKEN"  
 
 # Archive the stories
+def archive_request_t(p_story_l):
+  return ('PUT', club_client.api_url_s('stories/bulk'), { "archived": 'true', 'story_ids': p_story_l })
+
 def archive_stories(p_story_l):
-  try:
-    l_url_s = g_url_root_s + g_api_s + 'stories/bulk' + '?' + g_token_s
-    r_response_d = requests.put(l_url_s, json={ "archived": 'true', 'story_ids': p_story_l } )
-    r_response_d.raise_for_status()
-  except requests.exceptions.RequestException as l_e_c:
-    print(l_e_c)
-    sys.exit(1)
+  club_client.fetch_json_d(*archive_request_t(p_story_l))
   return 0
 
 # curl -X DELETE \
@@ -110,65 +145,162 @@ def archive_stories(p_story_l):
 #  -L "https://api.clubhouse.io/api/v3/stories/bulk?token=$CLUBHOUSE_API_TOKEN"
 
 # Delete the stories
+def delete_request_t(p_story_l):
+  return ('DELETE', club_client.api_url_s('stories/bulk'), { 'story_ids': p_story_l })
+
 def delete_stories(p_story_l):
-  try:
-    l_url_s = g_url_root_s + g_api_s + 'stories/bulk' + '?' + g_token_s
-    r_response_d = requests.delete(l_url_s, json={ 'story_ids': p_story_l } )
-    r_response_d.raise_for_status()
-  except requests.exceptions.RequestException as l_e_c:
-    print(l_e_c)
-    sys.exit(1)
+  club_client.fetch_json_d(*delete_request_t(p_story_l))
   return 0
 
+# One chunk of the pipeline. Delete will fail unless the story is archived.
+# Raises on failure so the chunk can be retried.
+def archive_delete_chunk(p_story_l):
+  archive_stories(p_story_l)
+  delete_stories(p_story_l)
+
+async def archive_delete_chunk_async(p_story_l):
+  await club_async.fetch_json_d(*archive_request_t(p_story_l))
+  await club_async.fetch_json_d(*delete_request_t(p_story_l))
+
+def chunks_l(p_story_id_l):
+  return [ p_story_id_l[i:i + g_chunk_n] for i in range(0, len(p_story_id_l), g_chunk_n) ]
+
+# Each chunk is archived and then deleted while the other chunks are in
+# flight. Returns the ids of the chunks that still failed after their retries.
+def archive_delete_l(p_story_id_l):
+  r_failed_l = []
+  l_done_n = 0
+  if club_client.g_async_b:
+    l_run_c = club_async.run_map(archive_delete_chunk_async, chunks_l(p_story_id_l))
+  else:
+    l_run_c = club_pool.run_adaptive(chunks_l(p_story_id_l), archive_delete_chunk, g_jobs_n, g_jobs_n)
+  for l_chunk_l, l_result_c, l_error_c in l_run_c:
+    if l_error_c is not None:
+      print('Chunk of ' + str(len(l_chunk_l)) + ' stories failed: ' + str(l_error_c))
+      r_failed_l += l_chunk_l
+      continue
+    l_done_n += len(l_chunk_l)
+    print('Deleted ' + str(l_done_n) + ' of ' + str(len(p_story_id_l)) + ' stories')
+  return r_failed_l
+
+# Search mode: one slim search per label (and archived state). Returns
+# (sorted unique ids, {query: story count}). The search's label: matching
+# isn't trusted for a delete, a story is only kept if its label_ids have
+# one of p_label_l.
+def search_story_ids_t(p_label_l):
+  l_query_l = club_select.label_query_l(p_label_l, g_filter_d.get('project'), g_filter_d.get('state'),
+                                        g_filter_d.get('created_before'), p_archived_b=g_filter_d.get('archived'))
+  l_story_l, r_count_d = club_client.exit_on_error(club_select.select_stories_t, l_query_l, g_jobs_n)
+
+  l_label_id_s = set( l_label_d['id'] for l_label_d in get_labels_l() if l_label_d['name'] in p_label_l )
+  r_story_id_l = []
+  for l_story_d in l_story_l:
+    if l_label_id_s.intersection(l_story_d.get('label_ids') or []):
+      r_story_id_l.append(l_story_d['id'])
+    else:
+      print('Skipping story ' + str(l_story_d['id']) + ' (' + str(l_story_d['name']) + '), it has none of the labels')
+  return (r_story_id_l, r_count_d)
+
+# Same as the search mode, from the index as of its last backup
+def index_story_ids_t(p_label_l):
+  l_conn_c = club_index.connect_c(g_index_s)
+  try:
+    return club_index.select_ids_t(l_conn_c, p_label_l, p_project_s=g_filter_d.get('project'), p_state_s=g_filter_d.get('state'),
+                                   p_created_before_s=g_filter_d.get('created_before'), p_archived_b=g_filter_d.get('archived'))
+  finally:
+    l_conn_c.close()
+
+# p_count_d is label name or search query => number of stories
+def print_plan(p_count_d, p_story_id_l):
+  print('Dry run, nothing is archived or deleted.')
+  for l_name_s in p_count_d:
+    print('  %-60s %6d stories' % (l_name_s, p_count_d[l_name_s]))
+  print('Unique stories: ' + str(len(p_story_id_l)))
+  l_chunk_n = len(chunks_l(p_story_id_l))
+  print('Requests: ' + str(l_chunk_n) + ' archive (PUT stories/bulk) + ' + str(l_chunk_n) + ' delete (DELETE stories/bulk), '
+        + str(g_chunk_n) + ' stories each, up to ' + str(g_jobs_n) + ' chunks in flight')
+
 def main():
 
-  if (2 > len(sys.argv)) or (2 == len(sys.argv) and '--help' == sys.argv[1]):
+  l_argv_l = list(sys.argv)
+
+  global g_jobs_n, g_chunk_n, g_dry_run_b, g_search_b, g_index_s
+  g_dry_run_b = club_client.pop_flag_b(l_argv_l, '--dry-run')
+  g_search_b  = club_client.pop_flag_b(l_argv_l, '--search')
+  g_index_s   = club_client.pop_option_s(l_argv_l, '--index')
+  if club_client.pop_flag_b(l_argv_l, '--async'):
+    club_client.g_async_b = True
+  g_filter_d['project'] = club_client.pop_option_s(l_argv_l, '--project')
+  g_filter_d['state']   = club_client.pop_option_s(l_argv_l, '--state')
+  g_filter_d['created_before'] = club_client.pop_option_s(l_argv_l, '--created-before')
+  l_archived_s = club_client.pop_option_s(l_argv_l, '--archived')
+  g_filter_d['archived'] = { None: None, 'yes': True, 'no': False }.get(l_archived_s, 'bad')
+  try:
+    g_jobs_n  = int(club_client.pop_option_s(l_argv_l, '--jobs', str(g_jobs_n)))
+    g_chunk_n = int(club_client.pop_option_s(l_argv_l, '--chunk', str(g_chunk_n)))
+    if g_filter_d['created_before']:
+      date.fromisoformat(g_filter_d['created_before'])
+  except ValueError:
+    g_jobs_n = 0
+
+  # The filters only mean something to a search (or the index). The index
+  # is only as current as its last backup, never delete from it.
+  if 'bad' == g_filter_d['archived'] or ([ l_value_c for l_value_c in g_filter_d.values() if l_value_c is not None ] and not (g_search_b or g_index_s)):
+    g_jobs_n = 0
+  if g_index_s and not g_dry_run_b:
+    g_jobs_n = 0
+
+  if (2 > len(l_argv_l)) or (2 == len(l_argv_l) and '--help' == l_argv_l[1]) or (1 > min(g_jobs_n, g_chunk_n)):
     # Message reflects the current name of the script
     print(g_usage_string_0_s + sys.argv[0] + g_usage_string_1_s)
     sys.exit(1)
 
-  if not os.getenv('CLUBHOUSE_API_TOKEN'):
-    print(g_env_usage_message_s)
-    sys.exit(1)
-
-  global g_token_s
-  g_token_s += os.getenv('CLUBHOUSE_API_TOKEN')
+  if not g_index_s:
+    club_client.init_from_env()
+    if g_jobs_n > club_client.g_pool_size_n:
+      club_client.init_session(p_pool_size_n=g_jobs_n)
 
   l_arg_labels_l = []
-  for l_cur_arg_s in sys.argv[1:]:
+  for l_cur_arg_s in l_argv_l[1:]:
     l_arg_labels_l.append(l_cur_arg_s)
 
   # The labels passed into the script
   print('Processing Labels:', l_arg_labels_l)
 
-  # All the labels for the user's workspaces
-  l_labels_l = get_labels_l()
+  if g_index_s:
+    l_story_id_l, l_count_d = index_story_ids_t(l_arg_labels_l)
+  elif g_search_b:
+    l_story_id_l, l_count_d = search_story_ids_t(l_arg_labels_l)
+  else:
+    # All the labels for the user's workspaces
+    l_labels_l = get_labels_l()
 
-  l_label_ids_l = []
-  for l_cur_label_d in l_labels_l:
-    if l_cur_label_d['name'] in l_arg_labels_l:
-      l_label_ids_l.append(l_cur_label_d['id'])
+    l_label_d = {}
+    for l_cur_label_d in l_labels_l:
+      if l_cur_label_d['name'] in l_arg_labels_l:
+        l_label_d[l_cur_label_d['id']] = l_cur_label_d['name']
 
-  # These labels are not used anywhere.
-  if not l_label_ids_l:
-    print("These labels are not used.")
-    sys.exit(1)
+    # These labels are not used anywhere.
+    if not l_label_d:
+      print("These labels are not used.")
+      sys.exit(1)
+
+    l_story_id_l, l_count_d = resolve_story_ids_t(l_label_d)
 
-  l_story_id_l = []
-  for l_cur_label_id_n in l_label_ids_l:
-    l_story_l = get_story_l(l_cur_label_id_n)
-    for l_story_d in l_story_l:
-      if l_story_d['id'] not in l_story_id_l:
-        l_story_id_l.append(l_story_d['id'])
+  if g_dry_run_b:
+    print_plan(l_count_d, l_story_id_l)
+    sys.exit(0)
 
   if l_story_id_l:
     print("Deleting Stories with Ids:", json.dumps(l_story_id_l))
-    archive_stories(l_story_id_l) # Delete will fail unless the story is archived
-    delete_stories(l_story_id_l)
+    l_failed_l = archive_delete_l(l_story_id_l)
+    if l_failed_l:
+      print("Failed to delete " + str(len(l_failed_l)) + " stories:", json.dumps(l_failed_l))
+      sys.exit(1)
   else:
     print("No Story matches for these labels.")
 
   sys.exit(0)
 
 if __name__ == "__main__":
-  main()
+  club_metrics.run_main(main)
@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+import json
+import sys
+import time
+
+import club_bulk
+import club_client
+import trello_to_clubhouse
+
+g_usage_string_0_s = """
+This script runs trello_to_clubhouse.py over many boards at once.
+
+The manifest is a JSON list of boards to migrate:
+
+[
+  { "export": "board_a.json", "project": "Project A" },
+  { "export": "board_b.json", "project": "Project B", "list": "To Do" }
+]
+
+The Clubhouse project list is fetched once. The exports are read and
+translated in a pool of processes while the stories from finished boards
+are uploaded through one shared, rate limited stories/bulk uploader. Each
+board gets its own translation label, same as trello_to_clubhouse.py. A
+summary of cards, stories created and time taken per board is printed at
+the end.
+
+Options:
+--procs N   Boards translated at once (default 4)
+--jobs N    stories/bulk batches in flight (default 4)
+--rate N    Requests per minute budget for the uploads (default 180)
+--stream    Use the streaming reader for the exports
+
+Usage: prompt$ """
+
+g_usage_string_1_s = ''' [--procs N] [--jobs N] [--rate N] [--stream] manifest_file
+
+Note: This script requires that the environment variable "CLUBHOUSE_API_TOKEN"
+is set to a valid Clubhouse token.'''
+
+g_procs_n  = 4
+g_jobs_n   = 4
+g_rate_n   = 180
+g_stream_b = False
+
+# Runs in a worker process. Returns the board summary and its stories.
+def translate_board_t(p_entry_d, p_project_d, p_stream_b, p_stamp_s):
+  r_summary_d = { 'export': p_entry_d['export'], 'project': p_entry_d['project'], 'list': p_entry_d.get('list'),
+                  'cards': 0, 'stories': 0, 'created': 0, 'error': None }
+  l_start_n = time.time()
+  try:
+    l_trello_db_d = trello_to_clubhouse.load_board_d(p_entry_d['export'], p_stream_b)
+
+    l_trello_list_d = None
+    if p_entry_d.get('list'):
+      l_trello_list_d = trello_to_clubhouse.find_list_d(l_trello_db_d, p_entry_d['list'])
+      if l_trello_list_d is None:
+        raise ValueError('Could not find Trello List: ' + p_entry_d['list'])
+
+    # The translation reads these module globals, each process has its own
+    trello_to_clubhouse.set_project(p_project_d)
+    trello_to_clubhouse.g_translation_label_s = trello_to_clubhouse.label_prefix_s(l_trello_db_d, p_entry_d.get('list')) + p_stamp_s
+
+    r_story_l = trello_to_clubhouse.translate_cards_l(l_trello_db_d, l_trello_list_d)
+    r_summary_d['cards'] = len([ l_card_d for l_card_d in l_trello_db_d['cards'] if not l_trello_list_d or l_card_d['idList'] == l_trello_list_d['id'] ])
+    r_summary_d['stories'] = len(r_story_l)
+    r_summary_d['label'] = trello_to_clubhouse.g_translation_label_s
+  except Exception as l_e_c:
+    r_summary_d['error'] = str(l_e_c)
+    r_story_l = []
+  r_summary_d['translate_seconds'] = time.time() - l_start_n
+  return (r_summary_d, r_story_l)
+
+def print_summary(p_summary_l):
+  print('')
+  print('%-30s %-20s %7s %8s %8s %8s %8s  %s' % ('export', 'project', 'cards', 'stories', 'created', 'xlate s', 'upload s', 'status'))
+  for l_summary_d in p_summary_l:
+    print('%-30s %-20s %7d %8d %8d %8.1f %8.1f  %s' % (
+      l_summary_d['export'][-30:], l_summary_d['project'][:20], l_summary_d['cards'], l_summary_d['stories'], l_summary_d['created'],
+      l_summary_d['translate_seconds'], l_summary_d.get('upload_seconds', 0.0), l_summary_d['error'] or 'ok'))
+
+def main():
+
+  l_argv_l = list(sys.argv)
+
+  global g_procs_n, g_jobs_n, g_rate_n, g_stream_b
+  g_stream_b = club_client.pop_flag_b(l_argv_l, '--stream')
+  try:
+    g_procs_n = int(club_client.pop_option_s(l_argv_l, '--procs', str(g_procs_n)))
+    g_jobs_n  = int(club_client.pop_option_s(l_argv_l, '--jobs', str(g_jobs_n)))
+    g_rate_n  = int(club_client.pop_option_s(l_argv_l, '--rate', str(g_rate_n)))
+  except ValueError:
+    g_procs_n = 0
+
+  if (2 != len(l_argv_l)) or ('--help' == l_argv_l[1]) or (1 > min(g_procs_n, g_jobs_n, g_rate_n)):
+    # Message reflects the current name of the script
+    print(g_usage_string_0_s + sys.argv[0] + g_usage_string_1_s)
+    sys.exit(1)
+
+  try:
+    with open(l_argv_l[1], 'r') as json_file:
+      l_entry_l = json.load(json_file)
+  except Exception as l_e_c:
+    print('Failure processing file named:', l_argv_l[1])
+    print(l_e_c)
+    sys.exit(1)
+
+  club_client.init_from_env()
+  if g_jobs_n > club_client.g_pool_size_n:
+    club_client.init_session(p_pool_size_n=g_jobs_n)
+  club_client.init_rate(g_rate_n)
+
+  # Fetched once for every board
+  l_project_l = club_client.get_clubhouse_l('projects')
+
+  # One time stamp for the whole run so the labels line up
+  l_stamp_s = datetime.now().strftime("_%Y_%m_%d_%H_%M_%S")
+
+  l_summary_l = [ None ] * len(l_entry_l)
+  with ProcessPoolExecutor(max_workers=g_procs_n) as l_pool_c:
+    l_future_d = {}
+    for l_index_n, l_entry_d in enumerate(l_entry_l):
+      l_project_d = trello_to_clubhouse.find_project_d(l_project_l, l_entry_d['project'])
+      if l_project_d is None:
+        l_summary_l[l_index_n] = { 'export': l_entry_d['export'], 'project': l_entry_d['project'], 'cards': 0, 'stories': 0,
+                                   'created': 0, 'translate_seconds': 0.0, 'error': 'No Clubhouse Project Name match found' }
+        continue
+      l_future_d[l_pool_c.submit(translate_board_t, l_entry_d, l_project_d, g_stream_b, l_stamp_s)] = l_index_n
+
+    # Upload each board as soon as its translation is done, the other
+    # boards keep translating in the background.
+    for l_future_c in as_completed(l_future_d):
+      l_index_n = l_future_d[l_future_c]
+      l_summary_d, l_story_l = l_future_c.result()
+      l_summary_l[l_index_n] = l_summary_d
+      if l_summary_d['error'] or not l_story_l:
+        continue
+      print('Uploading ' + str(len(l_story_l)) + ' stories from ' + l_summary_d['export'] + ' as ' + l_summary_d['label'])
+      l_start_n = time.time()
+      l_created_l, l_failed_n = club_bulk.create_stories_t(l_story_l, g_jobs_n)
+      l_summary_d['upload_seconds'] = time.time() - l_start_n
+      l_summary_d['created'] = len([ l_created_d for l_created_d in l_created_l if l_created_d is not None ])
+      if l_failed_n:
+        l_summary_d['error'] = str(l_failed_n) + ' batches failed'
+
+  print_summary(l_summary_l)
+
+  if [ l_summary_d for l_summary_d in l_summary_l if l_summary_d['error'] ]:
+    sys.exit(1)
+  sys.exit(0)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+
+'''
+Copyright Derek Dickinson 2020 Open Source MIT/Expat license
+For specific text see: https://github.com/derekdickinson/utilities_clubhouse/blob/master/LICENSE.txt
+
+Streaming reader for very large Trello board exports.
+
+json.load needs the whole export (and several times its size again) in
+memory. This walks the top level object a chunk at a time, decoding one
+array element at a time with the standard json decoder, and keeps only the
+fields trello_to_clubhouse.py uses. Everything else (non-comment actions,
+attachments, members, ...) is dropped as soon as it is read.
+
+The result has the same shape as the parts of the export that
+trello_to_clubhouse.py reads, so it can be used in place of json.load.
+
+Variable Naming Convention:
+
+Names are of the form: S_varname_T
+
+S indicates Scope (mostly):
+g - Global variables "g_"
+l - Local variables "l_"
+p - Parameters "p_"
+r - Return values "r_"
+
+T indicates Type:
+c - Class
+d - Dictionary
+l - List
+n - Number
+s - String
+
+'''
+
+import json
+
+g_chunk_size_n = 1 << 20
+
+# Array name => function trimming one element down to what is needed (or
+# returning None to drop it).
+def trim_card_d(p_card_d):
+  return {
+    'id'           : p_card_d['id'],
+    'name'         : p_card_d['name'],
+    'desc'         : p_card_d.get('desc', ''),
+    'idList'       : p_card_d['idList'],
+    'idChecklists' : p_card_d.get('idChecklists', []),
+  }
+
+def trim_checklist_d(p_checklist_d):
+  return {
+    'id'         : p_checklist_d['id'],
+    'name'       : p_checklist_d['name'],
+    'checkItems' : [ { 'name': l_item_d['name'] } for l_item_d in p_checklist_d.get('checkItems', []) ],
+  }
+
+def trim_list_d(p_list_d):
+  return { 'id': p_list_d['id'], 'name': p_list_d['name'] }
+
+def trim_action_d(p_action_d):
+  if 'commentCard' != p_action_d.get('type'):
+    return None
+  return {
+    'type' : 'commentCard',
+    'data' : { 'card': { 'id': p_action_d['data']['card']['id'] }, 'text': p_action_d['data']['text'] },
+  }
+
+g_trim_d = {
+  'cards'      : trim_card_d,
+  'checklists' : trim_checklist_d,
+  'lists'      : trim_list_d,
+  'actions'    : trim_action_d,
+}
+
+g_keep_value_l = ['name']  # Top level values kept as they are
+
+class StreamReader_c:
+
+  def __init__(self, p_file_c):
+    self.file_c    = p_file_c
+    self.buffer_s  = ''
+    self.pos_n     = 0
+    self.eof_b     = False
+    self.decoder_c = json.JSONDecoder()
+
+  # Pulls in at least one more chunk, dropping what has been consumed.
+  # Returns False at end of file.
+  def fill_b(self, p_size_n=g_chunk_size_n):
+    if self.eof_b:
+      return False
+    l_chunk_s = self.file_c.read(p_size_n)
+    if not l_chunk_s:
+      self.eof_b = True
+      return False
+    self.buffer_s = self.buffer_s[self.pos_n:] + l_chunk_s
+    self.pos_n = 0
+    return True
+
+  # Next non-whitespace character, without consuming it
+  def peek_s(self):
+    while True:
+      while self.pos_n < len(self.buffer_s) and self.buffer_s[self.pos_n] in ' \t\r\n':
+        self.pos_n += 1
+      if self.pos_n < len(self.buffer_s):
+        return self.buffer_s[self.pos_n]
+      if not self.fill_b():
+        raise ValueError('Unexpected end of Trello export')
+
+  def expect(self, p_char_s):
+    if self.peek_s() != p_char_s:
+      raise ValueError('Expected ' + repr(p_char_s) + ' at offset ' + str(self.pos_n) + ' in the current chunk')
+    self.pos_n += 1
+
+  # Decodes one JSON value, reading more of the file until it is complete.
+  # A value ending exactly at the end of the buffer might be a number that
+  # continues in the next chunk, so it only counts once something follows.
+  def value_c(self):
+    self.peek_s()
+    l_size_n = g_chunk_size_n
+    while True:
+      try:
+        r_value_c, l_end_n = self.decoder_c.raw_decode(self.buffer_s, self.pos_n)
+        if l_end_n < len(self.buffer_s) or self.eof_b:
+          self.pos_n = l_end_n
+          return r_value_c
+      except json.JSONDecodeError:
+        if self.eof_b:
+          raise
+      # Grow the reads so a huge value isn't re-parsed once per chunk
+      if not self.fill_b(l_size_n) and not self.eof_b:
+        raise ValueError('Unexpected end of Trello export')
+      l_size_n *= 2
+
+  # Yields the elements of the array starting at the current position
+  def array_items(self):
+    self.expect('[')
+    if ']' == self.peek_s():
+      self.pos_n += 1
+      return
+    while True:
+      yield self.value_c()
+      l_char_s = self.peek_s()
+      self.pos_n += 1
+      if ']' == l_char_s:
+        return
+      if ',' != l_char_s:
+        raise ValueError('Expected , or ] in Trello export array')
+
+# Reads the export at p_filename_s, returns the trimmed board
+def load_trello_d(p_filename_s):
+  r_board_d = { l_name_s : [] for l_name_s in g_trim_d }
+
+  with open(p_filename_s, 'r', encoding='utf-8') as l_file_c:
+    l_reader_c = StreamReader_c(l_file_c)
+    l_reader_c.expect('{')
+    if '}' == l_reader_c.peek_s():
+      return r_board_d
+
+    while True:
+      l_key_s = l_reader_c.value_c()
+      l_reader_c.expect(':')
+
+      if l_key_s in g_trim_d and '[' == l_reader_c.peek_s():
+        l_trim_c = g_trim_d[l_key_s]
+        for l_item_d in l_reader_c.array_items():
+          l_item_d = l_trim_c(l_item_d)
+          if l_item_d is not None:
+            r_board_d[l_key_s].append(l_item_d)
+      elif '[' == l_reader_c.peek_s():
+        for l_item_d in l_reader_c.array_items(): # Skipped one element at a time
+          pass
+      else:
+        l_value_c = l_reader_c.value_c()
+        if l_key_s in g_keep_value_l:
+          r_board_d[l_key_s] = l_value_c
+
+      l_char_s = l_reader_c.peek_s()
+      l_reader_c.pos_n += 1
+      if '}' == l_char_s:
+        return r_board_d
+      if ',' != l_char_s:
+        raise ValueError('Expected , or } in Trello export')
@@ -26,9 +26,13 @@ s - String
 from datetime import datetime
 import json
 import os
-import requests
 import sys
-import time
+
+import club_bulk
+import club_client
+import club_metrics
+import club_store
+import trello_stream
 
 g_usage_string_0_s = """
 This script takes input from a Trello Board's JSON export file and creates 
@@ -61,52 +65,107 @@ The case where a Trello Card has multiple checklists is handled by creating a
 story for every Checklist. So Card <=> Stories are mostly one to one, but
 occasionally extra stories will be created.
 
+Options:
+--stream   Read the export incrementally, keeping only the fields needed
+           for the translation. Use this for multi-gigabyte exports with
+           a long action history.
+--jobs N   Number of stories/bulk batches in flight (default 4)
+--resume   Carry on with an import that died partway through. Cards
+           already in the journal are skipped and the original
+           translation label is reused.
+--journal F
+           Import journal (default <trello_board_export_file>.journal.jsonl).
+           Maps each Trello card (and checklist) to the story it produced.
+
 Usage: prompt$ """
 
-g_usage_string_1_s = ''' clubhouse_project trello_board_export_file [trello_list]
+g_usage_string_1_s = ''' [--stream] [--jobs N] [--resume] [--journal F] clubhouse_project trello_board_export_file [trello_list]
+
+Run reports: [--metrics report.json] [--prom metrics.prom] [--profile run.prof]
 
 Note: This script requires that the environment variable "CLUBHOUSE_API_TOKEN" 
 is set to a valid Clubhouse token.'''
 
-g_env_usage_message_s = '''
-This script requires that the environment variable "CLUBHOUSE_API_TOKEN" is
-set to a valid Clubhouse token.
-'''
-
 g_trello_db_d           = None
 g_project_d             = None
 g_project_follower_id_s = None
 g_translation_label_s   = None
-
-g_url_root_s = 'https://api.clubhouse.io'
-g_api_s      = '/api/v3/'
-g_token_s    = 'token='
+g_jobs_n                = 4
+g_journal_c             = None
 
 # Get the list of projects from clubhouse.io
 def get_project_l():
-  # Add page loop logic here?
-  # Add timeour retry logic here?
-  try:
-    l_url_s = g_url_root_s + g_api_s + 'projects' + '?' + g_token_s
-    r_response_d = requests.get(l_url_s)
-    r_response_d.raise_for_status()
-  except requests.exceptions.RequestException as l_e_c:
-    print(l_e_c)
-    sys.exit(1)
-  return r_response_d.json()
+  return club_client.get_clubhouse_l('projects')
 
-# Create a bunch of new stories
+# Create a bunch of new stories, batched by count and size with several
+# batches in flight
 def create_stories(p_story_l):
-  # Add page loop logic here?
-  # Add timeour retry logic here?
+  r_created_l, l_failed_n = club_bulk.create_stories_t(p_story_l, g_jobs_n, p_done_c=journal_batch, p_sending_c=journal_sending)
+  if l_failed_n:
+    print('Run again with --resume to retry the stories that failed.')
+    sys.exit(1)
+  return r_created_l
+
+g_header_key_l = ['label', 'project', 'list']
+
+# Import journal. The first line records the translation so a resumed
+# import can reuse its label, then lines keyed by the story's external_id
+# (the Trello card and checklist ids): one with a story_id of None as each
+# batch is sent, and one with the new story's id once it's created. The
+# header is None when its line is missing or torn.
+def read_journal_t(p_journal_s):
+  r_header_d = None
+  r_done_d = {}
+  with open(p_journal_s, 'r') as l_file_c:
+    for l_line_s in l_file_c:
+      if not l_line_s.strip():
+        continue
+      try:
+        l_entry_d = json.loads(l_line_s)
+      except ValueError:
+        continue # Partial line from a crash
+      if 'external_id' in l_entry_d:
+        if l_entry_d['story_id'] is not None or l_entry_d['external_id'] not in r_done_d:
+          r_done_d[l_entry_d['external_id']] = l_entry_d['story_id']
+      elif r_header_d is None and all( l_key_s in l_entry_d for l_key_s in g_header_key_l ):
+        r_header_d = l_entry_d
+  return (r_header_d, r_done_d)
+
+def journal_sending(p_story_l):
+  journal_batch(p_story_l, [None] * len(p_story_l))
+
+def journal_batch(p_story_l, p_created_l):
+  for l_story_d, l_created_d in zip(p_story_l, p_created_l):
+    g_journal_c.write(json.dumps({ 'external_id': l_story_d['external_id'], 'story_id': l_created_d and l_created_d['id'] }) + '\n')
+  g_journal_c.flush()
+  os.fsync(g_journal_c.fileno())
+
+# Stories sent without an answer (story_id None in p_done_d) may have been
+# created. Those that were are journaled and kept in p_done_d, the rest
+# are taken out so they are sent again.
+def settle_sent(p_done_d):
+  l_sent_l = [ l_id_s for l_id_s, l_story_id_n in p_done_d.items() if l_story_id_n is None ]
+  if not l_sent_l:
+    return
+  print('Checking ' + str(len(l_sent_l)) + ' stories that were sent without an answer')
   try:
-    l_url_s = g_url_root_s + g_api_s + 'stories/bulk' + '?' + g_token_s
-    r_response_d = requests.post(l_url_s, json={ 'stories': p_story_l } )
-    r_response_d.raise_for_status()
-  except requests.exceptions.RequestException as l_e_c:
-    print(l_e_c)
+    l_story_d = club_bulk.existing_stories_d(l_sent_l, g_jobs_n)
+  except Exception as l_e_c:
+    print('Could not check for stories already created: ' + str(l_e_c))
     sys.exit(1)
-  return r_response_d.json()
+  l_found_l = [ l_id_s for l_id_s in l_sent_l if l_id_s in l_story_d ]
+  journal_batch([ { 'external_id': l_id_s } for l_id_s in l_found_l ], [ l_story_d[l_id_s] for l_id_s in l_found_l ])
+  for l_id_s in l_sent_l:
+    if l_id_s in l_story_d:
+      p_done_d[l_id_s] = l_story_d[l_id_s]['id']
+    else:
+      del p_done_d[l_id_s]
+
+def external_id_s(p_trello_card_d, p_trello_checklist_d=None):
+  r_external_id_s = 'trello:' + p_trello_card_d['id']
+  if p_trello_checklist_d:
+    r_external_id_s += '/' + p_trello_checklist_d['id']
+  return r_external_id_s
 
   # g_trello_db_d['checklists'][i]['id'] (contains an 'idCard' hmmm)
   #    g_trello_db_d['cards'][i]['idChecklists'][i]
@@ -131,6 +190,9 @@ def create_story_d(p_trello_card_d, p_trello_comment_l, p_trello_checklist_d=Non
   r_clubhouse_story_d['name']      = l_story_name_s
   r_clubhouse_story_d['project_id']= g_project_d['id']
 
+  # Identifies the card (and checklist) this came from, for the journal
+  r_clubhouse_story_d['external_id'] = external_id_s(p_trello_card_d, p_trello_checklist_d)
+
   # Now the optional parameters - Non-arrays
   if 'desc' in p_trello_card_d:
     r_clubhouse_story_d['description']=p_trello_card_d['desc']
@@ -163,29 +225,131 @@ def create_story_d(p_trello_card_d, p_trello_comment_l, p_trello_checklist_d=Non
 
   return r_clubhouse_story_d
 
+# One pass over the actions. Card id => list of its "commentCard" actions,
+# in the order they appear in the export.
+def index_comments_d(p_action_l):
+  r_comment_d = {}
+  for l_action_d in p_action_l:
+    if 'commentCard' != l_action_d['type']: # We only care about comments
+      continue
+    r_comment_d.setdefault(l_action_d['data']['card']['id'], []).append(l_action_d)
+  return r_comment_d
+
+# Checklist id => checklist
+def index_checklists_d(p_checklist_l):
+  r_checklist_d = {}
+  for l_checklist_d in p_checklist_l:
+    r_checklist_d[l_checklist_d['id']] = l_checklist_d
+  return r_checklist_d
+
+# Builds the story list for every card (or just those on p_trello_list_d).
+# The comments and checklists are indexed first so this is linear in the
+# size of the export.
+def translate_cards_l(p_trello_db_d, p_trello_list_d=None):
+  l_comment_d = index_comments_d(p_trello_db_d['actions'])
+  l_checklist_d = index_checklists_d(p_trello_db_d['checklists'])
+
+  r_story_l = []
+  for l_card_d in p_trello_db_d['cards']:
+
+    # Exclude other lists if a specific list was specified.
+    if p_trello_list_d and (l_card_d['idList'] != p_trello_list_d['id']):
+      continue
+
+    # All the "commentCards" to add as comments
+    l_trello_comment_l = l_comment_d.get(l_card_d['id'], [])
+
+    # Now process the Checklists and add the stories to r_story_l
+    if [] == l_card_d['idChecklists']:
+      r_story_l.append(create_story_d(l_card_d, l_trello_comment_l)) # No checklist, one story per card.
+    else:
+      for l_checklist_id_s in l_card_d['idChecklists']:    # One story per checklist
+        if l_checklist_id_s in l_checklist_d:
+          r_story_l.append(create_story_d(l_card_d, l_trello_comment_l, l_checklist_d[l_checklist_id_s]))
+          l_trello_comment_l = [] # Only put the comments on the first card when 
+
+  return r_story_l
+
+# Load the trello export file, the streaming reader keeps only what the
+# translation needs.
+def load_board_d(p_filename_s, p_stream_b=False):
+  if p_stream_b:
+    return trello_stream.load_trello_d(p_filename_s)
+  with open(p_filename_s, 'r') as json_file:
+    return json.load(json_file)
+
+def find_project_d(p_project_l, p_project_name_s):
+  r_project_d = None
+  for l_clubhouse_project_d in p_project_l:
+    if p_project_name_s == l_clubhouse_project_d['name']:
+      r_project_d = l_clubhouse_project_d
+  return r_project_d
+
+# The project the stories go to. Its first follower owns them.
+def set_project(p_project_d):
+  global g_project_d, g_project_follower_id_s
+  g_project_d = p_project_d
+  g_project_follower_id_s = None
+  if p_project_d.get('follower_ids'):
+    g_project_follower_id_s = p_project_d['follower_ids'][0]
+
+def find_list_d(p_trello_db_d, p_list_name_s):
+  for l_trello_list_d in p_trello_db_d['lists']:
+    if p_list_name_s == l_trello_list_d['name']:
+      return l_trello_list_d
+  return None
+
+# Translation label without the time stamp
+def label_prefix_s(p_trello_db_d, p_list_name_s=None):
+  r_label_s = 'from_trello_' + p_trello_db_d['name'].replace(" ", "_")
+  if p_list_name_s:
+    r_label_s += '_' + p_list_name_s.replace(" ", "_")
+  return r_label_s
+
 def main():
  
-  if (len(sys.argv) < 3) or (4 < len(sys.argv)):
+  l_argv_l = list(sys.argv)
+  l_stream_b = club_client.pop_flag_b(l_argv_l, '--stream')
+  l_resume_b = club_client.pop_flag_b(l_argv_l, '--resume')
+  l_journal_s = club_client.pop_option_s(l_argv_l, '--journal')
+  global g_jobs_n
+  try:
+    g_jobs_n = int(club_client.pop_option_s(l_argv_l, '--jobs', str(g_jobs_n)))
+  except ValueError:
+    g_jobs_n = 0
+
+  if (len(l_argv_l) < 3) or (4 < len(l_argv_l)) or (1 > g_jobs_n):
     # Message reflects the current name of the script
     print(g_usage_string_0_s + sys.argv[0] + g_usage_string_1_s)
     sys.exit(1)
 
-  l_clubhouse_project_name_s = sys.argv[1]
-  l_trello_db_filename_s = sys.argv[2]
-  l_trello_list_name_s = sys.argv[3] if (4 == len(sys.argv)) else None
-
-  if not os.getenv('CLUBHOUSE_API_TOKEN'):
-    print(g_env_usage_message_s)
-    sys.exit(1)
+  l_clubhouse_project_name_s = l_argv_l[1]
+  l_trello_db_filename_s = l_argv_l[2]
+  l_trello_list_name_s = l_argv_l[3] if (4 == len(l_argv_l)) else None
+  l_journal_s = l_journal_s or (l_trello_db_filename_s + '.journal.jsonl')
+
+  l_header_d, l_done_d = None, {}
+  if l_resume_b:
+    try:
+      l_header_d, l_done_d = read_journal_t(l_journal_s)
+    except FileNotFoundError:
+      print('No journal to resume from: ' + l_journal_s)
+      sys.exit(1)
+    if l_header_d is None:
+      print('Journal ' + l_journal_s + ' has no header line (its first line is missing or torn), it can\'t be resumed from.')
+      sys.exit(1)
+    if l_header_d['project'] != l_clubhouse_project_name_s or l_header_d['list'] != l_trello_list_name_s:
+      print('Journal ' + l_journal_s + ' is for a different project or list.')
+      sys.exit(1)
 
-  global g_token_s
-  g_token_s += os.getenv('CLUBHOUSE_API_TOKEN')
+  club_client.init_from_env()
+  if g_jobs_n > club_client.g_pool_size_n:
+    club_client.init_session(p_pool_size_n=g_jobs_n)
 
   # Load the trello export file
+  global g_trello_db_d
   try:
-    with open(l_trello_db_filename_s, 'r') as json_file:
-      global g_trello_db_d
-      g_trello_db_d = json.load(json_file)
+    g_trello_db_d = load_board_d(l_trello_db_filename_s, l_stream_b)
   except Exception as l_e_c: 
     print('Failure processing file named:', l_trello_db_filename_s)
     print(l_e_c)
@@ -196,64 +360,54 @@ def main():
   g_clubhouse_project_l = get_project_l()
 
   # Pick out the one I want this board to go to
-  global g_project_d
-  for l_clubhouse_project_d in g_clubhouse_project_l:
-    if l_clubhouse_project_name_s == l_clubhouse_project_d['name']:
-      g_project_d = l_clubhouse_project_d
-  
-  if None==g_project_d:
+  l_clubhouse_project_d = find_project_d(g_clubhouse_project_l, l_clubhouse_project_name_s)
+  if None==l_clubhouse_project_d:
     print( 'No Clubhouse Project Name match found for: ', l_clubhouse_project_name_s )
     sys.exit(1)
-
-  if 'follower_ids' in g_project_d: 
-    global g_project_follower_id_s
-    g_project_follower_id_s = g_project_d['follower_ids'][0]
-
-  # First part of creating a unique label name for translation
-  global g_translation_label_s
-  g_translation_label_s = 'from_trello_' + g_trello_db_d['name'].replace(" ", "_")
+  set_project(l_clubhouse_project_d)
 
   # Find the Trello source list if specified
+  l_trello_list_d = None
   if l_trello_list_name_s:
-    g_translation_label_s += '_' + l_trello_list_name_s.replace(" ", "_")
-    for l_trello_list_d in g_trello_db_d['lists']:
-      if l_trello_list_name_s == l_trello_list_d['name']:
-        break
-    if l_trello_list_name_s != l_trello_list_d['name']:
+    l_trello_list_d = find_list_d(g_trello_db_d, l_trello_list_name_s)
+    if None==l_trello_list_d:
       print( 'Could not find Trello List: ', l_trello_list_name_s )
       sys.exit(1)
 
+  # First part of creating a unique label name for translation
+  global g_translation_label_s
+  g_translation_label_s = label_prefix_s(g_trello_db_d, l_trello_list_name_s)
+
   # Complete the unique label identifying this translation
-  now = datetime.now()
-  g_translation_label_s += now.strftime("_%Y_%m_%d_%H_%M_%S")
+  if l_resume_b:
+    g_translation_label_s = l_header_d['label']
+  else:
+    now = datetime.now()
+    g_translation_label_s += now.strftime("_%Y_%m_%d_%H_%M_%S")
 
   print('Translation Label is:', g_translation_label_s)
 
   # Increment through the trello cards and create a story list
-  l_story_l = []
-  for l_card_d in g_trello_db_d['cards']:
-
-    # Exclude other lists if a specific list was specified.
-    if l_trello_list_name_s and (l_card_d['idList'] != l_trello_list_d['id']):
-      continue
-
-    # Will need to get all the "commentCards" to add as comments
-    l_trello_comment_l = []
-    for l_action_d in g_trello_db_d['actions']:
-      if 'commentCard' != l_action_d['type']: # We only care about comments
-        continue
-      if l_action_d['data']['card']['id'] == l_card_d['id']:
-        l_trello_comment_l.append(l_action_d)
-
-    # Now process the Checklists and add the stories to l_story_l
-    if [] == l_card_d['idChecklists']:
-      l_story_l.append(create_story_d(l_card_d, l_trello_comment_l)) # No checklist, one story per card.
-    else:
-      for l_checklist_id_s in l_card_d['idChecklists']:    # One story per checklist
-        for l_checklist_d in g_trello_db_d['checklists']:
-          if  l_checklist_id_s == l_checklist_d['id']:
-            l_story_l.append(create_story_d(l_card_d, l_trello_comment_l, l_checklist_d))
-            l_trello_comment_l = [] # Only put the comments on the first card when 
+  with club_metrics.phase('transform'):
+    l_story_l = translate_cards_l(g_trello_db_d, l_trello_list_d)
+
+  global g_journal_c
+  if l_resume_b:
+    g_journal_c = club_store.open_journal_c(l_journal_s)
+    settle_sent(l_done_d)
+    l_total_n = len(l_story_l)
+    l_story_l = [ l_story_d for l_story_d in l_story_l if l_story_d['external_id'] not in l_done_d ]
+    print('Resuming: ' + str(l_total_n - len(l_story_l)) + ' of ' + str(l_total_n) + ' stories already created')
+    if not l_story_l:
+      print('Nothing left to import.')
+      sys.exit(0)
+  else:
+    if os.path.exists(l_journal_s):
+      print('Starting a new journal, replacing: ' + l_journal_s)
+    g_journal_c = open(l_journal_s, 'w')
+    g_journal_c.write(json.dumps({ 'label': g_translation_label_s, 'project': l_clubhouse_project_name_s, 'list': l_trello_list_name_s }) + '\n')
+    g_journal_c.flush()
+    os.fsync(g_journal_c.fileno())
 
   if l_story_l:
     print(json.dumps(l_story_l, indent=2))
@@ -263,4 +417,4 @@ def main():
     print("No Board/List matches found.")
 
 if __name__ == "__main__":
-  main()  
\ No newline at end of file
+  club_metrics.run_main(main)  
\ No newline at end of file